@@ -0,0 +1,140 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+
+logger = logging.getLogger('adv_cache_tag')
+
+# The circuit breakers, by name of cache backend
+circuit_breakers = {}
+
+
+class CircuitBreaker(object):
+    """
+    Stop using a cache backend when it fails too often: after `threshold`
+    errors in `window` seconds, the circuit is "open" and the backend is not
+    used for `cooldown` seconds. Then the circuit is "half_open": one call is
+    allowed, to probe the backend. If it succeeds, the circuit is "closed"
+    again, else it's open for another `cooldown` seconds.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, threshold, window, cooldown):
+        super(CircuitBreaker, self).__init__()
+        self.name = name
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        # time of the last errors, in the window, while closed
+        self.failures = deque()
+        self.opened_at = None
+        self.probing = False
+        # number of calls not done because the circuit was open
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return `True` if the backend can be used
+        """
+        if self.state == self.CLOSED:
+            return True
+
+        with self._lock:
+            if self.state == self.OPEN and time.time() >= self.opened_at + self.cooldown:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            if self.state == self.CLOSED:
+                return True
+            self.skipped += 1
+            return False
+
+    def success(self):
+        """
+        Close the circuit after a successful call to probe the backend
+        """
+        if self.state == self.CLOSED:
+            return
+
+        with self._lock:
+            if self.state != self.HALF_OPEN:
+                return
+            self.state = self.CLOSED
+            self.failures.clear()
+            self.probing = False
+            logger.warning('Cache backend "%s" available again (%d calls skipped)',
+                           self.name, self.skipped)
+
+    def release(self):
+        """
+        Allow another call to probe the backend, when the probing call was
+        interrupted (cancelled...) without telling if the backend works
+        """
+        with self._lock:
+            self.probing = False
+
+    def failure(self):
+        """
+        Count an error, opening the circuit if needed
+        """
+        now = time.time()
+        with self._lock:
+            if self.state == self.OPEN:
+                return
+            if self.state == self.HALF_OPEN:
+                self.open(now, 'probe failed')
+                return
+            self.failures.append(now)
+            while self.failures[0] < now - self.window:
+                self.failures.popleft()
+            if len(self.failures) >= self.threshold:
+                self.open(now, '%d errors in %s seconds' % (len(self.failures), self.window))
+
+    def open(self, now, reason):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.failures.clear()
+        self.probing = False
+        # one line only, instead of a traceback for each fragment
+        logger.error('Cache backend "%s" unavailable (%s), not used for %s seconds',
+                     self.name, reason, self.cooldown)
+
+    def get_state(self):
+        """
+        Return a dict describing the state of the circuit breaker
+        """
+        return {
+            'state': self.state,
+            'failures': len(self.failures),
+            'opened_at': self.opened_at,
+            'skipped': self.skipped,
+        }
+
+
+def get_circuit_breaker(name, threshold, window, cooldown):
+    """
+    Return the circuit breaker of the given cache backend, created if needed
+    """
+    breaker = circuit_breakers.get(name)
+    if breaker is None:
+        breaker = circuit_breakers.setdefault(
+            name, CircuitBreaker(name, threshold, window, cooldown))
+    return breaker
+
+
+def get_circuit_breakers_states():
+    """
+    Return the state of the circuit breakers, by name of cache backend
+    """
+    return {name: breaker.get_state() for name, breaker in circuit_breakers.items()}
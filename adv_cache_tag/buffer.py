@@ -0,0 +1,84 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+from .compat import ContextVar, get_cache
+
+
+logger = logging.getLogger('adv_cache_tag')
+
+# The buffer of the current request, set by `WriteBehindMiddleware`
+current_write_behind_buffer = ContextVar('adv_cache_write_behind_buffer', default=None)
+
+
+class WriteBehindBuffer(object):
+    """
+    Contents to save in the cache, kept until the `flush` method is called,
+    to save them with one `set_many` call per cache backend and timeout.
+    It is bounded by a number of entries and/or a total size.
+    """
+
+    def __init__(self, max_entries=0, max_size=0, forced=False):
+        """
+        Define the limits of the buffer. A limit set to `0` means no limit.
+        If `forced` is `True`, the buffer is used by all the cache templatetags,
+        even without the `write_behind` option.
+        """
+        super(WriteBehindBuffer, self).__init__()
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.forced = forced
+        self.size = 0
+        # each value is a tuple with the name of the cache backend, the key, the data, the
+        # timeout and the size (not the cache object: they are not shared between threads)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def add(self, cache_backend, key, data, timeout):
+        """
+        Add the data to save in the given cache backend (by name) for the
+        given key. Return `False` if the buffer is full.
+        """
+        entry_key = (cache_backend, key)
+        size = len(data) if isinstance(data, (bytes, str)) else 0
+
+        with self._lock:
+            previous = self._data.get(entry_key)
+            new_size = self.size + size - (previous[4] if previous else 0)
+            if (self.max_entries and not previous and len(self._data) >= self.max_entries) or (
+                    self.max_size and new_size > self.max_size):
+                return False
+            self._data[entry_key] = (cache_backend, key, data, timeout, size)
+            self.size = new_size
+
+        return True
+
+    def flush(self):
+        """
+        Save all the contents in the cache, with one `set_many` call per
+        cache backend and timeout, and empty the buffer. The cache objects
+        are the ones of the current thread.
+        """
+        with self._lock:
+            entries = list(self._data.values())
+            self._data.clear()
+            self.size = 0
+
+        groups = OrderedDict()
+        for cache_backend, key, data, timeout, size in entries:
+            groups.setdefault((cache_backend, timeout), {})[key] = data
+
+        for (cache_backend, timeout), data in groups.items():
+            try:
+                get_cache(cache_backend).set_many(data, timeout)
+            except Exception:
+                logger.exception('Error when saving the buffered cached template fragments')
+
+    # used when passed to the response, to be called when it's closed
+    close = flush
@@ -0,0 +1,166 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import pickle
+import threading
+import zlib
+
+from django.utils.encoding import force_bytes, smart_str
+
+
+class Codec(object):
+    """
+    Base class of the codecs used to encode the html to be cached, and decode
+    it back. Each codec is identified by a short `id`, saved with the cached
+    content, so the content can be decoded even if the codec to use for new
+    content has changed.
+    """
+
+    # Short identifier, saved with the content
+    id = None
+
+    def encode(self, content, level):
+        """
+        Return the bytes to be cached for the given html. `level` is the
+        `compress_level` option, for codecs supporting it.
+        """
+        raise NotImplementedError
+
+    def decode(self, data):
+        """
+        Return the html from the given cached bytes
+        """
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """
+    Simply encode the html in utf-8, without any compression
+    """
+
+    id = 'raw'
+
+    def encode(self, content, level):
+        return force_bytes(content)
+
+    def decode(self, data):
+        return smart_str(data)
+
+
+class ZlibCodec(Codec):
+    """
+    Compress the html, encoded in utf-8, with `zlib`
+    """
+
+    id = 'zlib'
+
+    def encode(self, content, level):
+        return zlib.compress(force_bytes(content), level)
+
+    def decode(self, data):
+        return smart_str(zlib.decompress(data))
+
+
+class PickleZlibCodec(Codec):
+    """
+    Compress the pickled html with `zlib`. It's the format used when the
+    `compress` option is on and no codec is defined.
+    """
+
+    id = 'pz'
+
+    def encode(self, content, level):
+        return zlib.compress(pickle.dumps(content), level)
+
+    def decode(self, data):
+        return pickle.loads(zlib.decompress(data))
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+else:
+    class ZstdCodec(Codec):
+        """
+        Compress the html, encoded in utf-8, with `zstandard`
+        """
+
+        id = 'zstd'
+
+        def __init__(self):
+            # the (de)compressors are reused, but cannot be shared between threads
+            self.local = threading.local()
+
+        def get_compressor(self, level):
+            """
+            Return the compressor for the given level, created only once by thread
+            """
+            compressors = self.local.__dict__.setdefault('compressors', {})
+            try:
+                return compressors[level]
+            except KeyError:
+                # the zlib default level (-1) is not a good level for zstd
+                compressors[level] = zstandard.ZstdCompressor(level=level if level > 0 else 3)
+                return compressors[level]
+
+        def get_decompressor(self):
+            """
+            Return the decompressor, created only once by thread
+            """
+            try:
+                return self.local.decompressor
+            except AttributeError:
+                self.local.decompressor = zstandard.ZstdDecompressor()
+                return self.local.decompressor
+
+        def encode(self, content, level):
+            return self.get_compressor(level).compress(force_bytes(content))
+
+        def decode(self, data):
+            return smart_str(self.get_decompressor().decompress(data))
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+else:
+    class Lz4Codec(Codec):
+        """
+        Compress the html, encoded in utf-8, with `lz4`
+        """
+
+        id = 'lz4'
+
+        def encode(self, content, level):
+            return lz4.frame.compress(force_bytes(content), compression_level=max(level, 0))
+
+        def decode(self, data):
+            return smart_str(lz4.frame.decompress(data))
+
+
+# All the available codecs, by id
+codecs = {}
+
+
+def register_codec(codec):
+    """
+    Make the given codec (an instance of a `Codec` subclass) available, using
+    its `id`
+    """
+    codecs[codec.id] = codec
+
+
+def get_codec(codec_id):
+    """
+    Return the codec with the given id. Raise `KeyError` if not available.
+    """
+    return codecs[codec_id]
+
+
+register_codec(RawCodec())
+register_codec(ZlibCodec())
+register_codec(PickleZlibCodec())
+if zstandard is not None:
+    register_codec(ZstdCodec())
+if lz4 is not None:
+    register_codec(Lz4Codec())
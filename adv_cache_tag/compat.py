@@ -26,3 +26,51 @@ def get_template_libraries():
         libraries = engines['django'].engine.template_libraries
 
     return libraries
+
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8
+    from django.test.signals import setting_changed
+
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python < 3.7: a minimal equivalent, local to the current thread
+    import threading
+
+    class ContextVar(object):
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+
+        def get(self, *default):
+            try:
+                return self._local.value
+            except AttributeError:
+                return default[0] if default else self._default
+
+        def set(self, value):
+            token = getattr(self._local, 'value', self._default)
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            self._local.value = token
+
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    # Django < 3.0
+    sync_to_async = None
@@ -0,0 +1,89 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.db.models import Model, QuerySet
+
+from .compat import EmptyResultSet
+
+
+# The functions returning the value used in the cache key for an object, by type
+key_adapters = {}
+
+
+def register_key_adapter(klass, adapter):
+    """
+    Use the given function to get the value to use in the cache key for
+    instances of the given class (and its subclasses)
+    """
+    key_adapters[klass] = adapter
+
+
+def get_key_value(value):
+    """
+    Return the value to use in the cache key for the given object: the
+    result of its `__cache_key__` method if it has one, or of the adapter
+    registered for its class, or the object itself if none.
+    """
+    cache_key = getattr(type(value), '__cache_key__', None)
+    if cache_key is not None:
+        return cache_key(value)
+
+    for klass in type(value).__mro__:
+        adapter = key_adapters.get(klass)
+        if adapter is not None:
+            return adapter(value)
+
+    return value
+
+
+def model_label(model):
+    """
+    Return the "app_label.ModelName" label of a model (or model instance),
+    `_meta.label` only existing since django 1.9
+    """
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.object_name)
+
+
+def model_key_value(instance):
+    """
+    Identify a model instance by its model, its pk, and its `updated_at`
+    field if any, without calling its `__str__` method
+    """
+    parts = [model_label(instance), str(instance.pk)]
+    updated_at = getattr(instance, 'updated_at', None)
+    if updated_at is not None:
+        parts.append(get_key_value(updated_at))
+    return ':'.join(parts)
+
+
+def queryset_key_value(queryset):
+    """
+    Identify a queryset by its sql query and its parameters, without
+    evaluating it
+    """
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        sql, params = '', ()
+    return '%s:%s:%s' % (model_label(queryset.model), sql,
+                         ','.join(str(get_key_value(param)) for param in params))
+
+
+def date_key_value(value):
+    return value.isoformat()
+
+
+def decimal_key_value(value):
+    # the same for equal values, like `Decimal('1.10')` and `Decimal('1.1')`
+    return '{:f}'.format(value.normalize())
+
+
+register_key_adapter(Model, model_key_value)
+register_key_adapter(QuerySet, queryset_key_value)
+register_key_adapter(date, date_key_value)
+register_key_adapter(datetime, date_key_value)
+register_key_adapter(time, date_key_value)
+register_key_adapter(Decimal, decimal_key_value)
@@ -0,0 +1,89 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A simple in-memory "least recently used" store, bounded by a number of
+    entries and/or a total size, and safe to be shared between threads.
+    The size of each entry, and optionally its timeout, are given by the
+    caller when setting it.
+    """
+
+    def __init__(self, max_entries=0, max_size=0):
+        """
+        Define the limits of the store. A limit set to `0` means no limit.
+        """
+        super(LRUCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        # each value is a tuple with the real value, its size and its expire timestamp
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the value for the given key (or `default` if not found or
+        expired) and mark it as the most recently used one.
+        """
+        with self._lock:
+            try:
+                value, size, expires_at = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.size -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, size=0, timeout=None):
+        """
+        Save the value for the given key, for `timeout` seconds if defined,
+        then remove the least recently used entries until the limits are
+        respected.
+        Return `False` if the value is too big to be saved.
+        """
+        if self.max_size and size > self.max_size:
+            self.delete(key)
+            return False
+
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = (value, size, None if timeout is None else time.time() + timeout)
+            self.size += size
+            while self._data and (
+                    (self.max_entries and len(self._data) > self.max_entries) or
+                    (self.max_size and self.size > self.max_size)):
+                self.size -= self._data.popitem(last=False)[1][1]
+
+        return True
+
+    def delete(self, key):
+        """
+        Remove the given key from the store, if present.
+        """
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+
+    def clear(self):
+        """
+        Remove all entries from the store.
+        """
+        with self._lock:
+            self._data.clear()
+            self.size = 0
@@ -0,0 +1,162 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import json
+import os
+import time
+
+from itertools import islice
+
+from multiprocessing import Pool
+
+import django
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.template.loader import get_template
+from django.utils.module_loading import import_string
+
+from adv_cache_tag.buffer import WriteBehindBuffer, current_write_behind_buffer
+
+
+def load_spec(spec):
+    """
+    Return an iterable of `(template_name, context)` tuples from the given
+    spec: the path of a JSON (or YAML, if PyYAML is installed) file with a
+    list of `{"template": name, "contexts": [context, ...]}` entries, or the
+    python path of a callable returning such tuples.
+    """
+    if os.path.isfile(spec):
+        with open(spec) as spec_file:
+            if spec.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise CommandError('PyYAML is needed to read %s' % spec)
+                entries = yaml.safe_load(spec_file)
+            else:
+                entries = json.load(spec_file)
+        return (
+            (entry['template'], context)
+            for entry in entries
+            for context in entry.get('contexts') or [{}]
+        )
+
+    try:
+        func = import_string(spec.replace(':', '.'))
+    except ImportError:
+        raise CommandError('%s is not a file nor a python path to a callable' % spec)
+    return func()
+
+
+def get_worker_entries(spec, worker_index, workers):
+    """
+    Return the `(template_name, context)` tuples of the given spec handled by
+    this worker (one of each `workers` entries). If `spec` is not a string,
+    it's the list of the entries of this worker, prepared by the parent
+    process.
+    """
+    if not isinstance(spec, str):
+        return spec
+    return islice(load_spec(spec), worker_index, None, workers)
+
+
+def warm(spec, worker_index=0, workers=1, rate=0, batch_size=100):
+    """
+    Render, forcing the regeneration of their cache templatetags, the
+    templates of the given spec handled by this worker (see
+    `get_worker_entries`), at most `rate` per second if set, and save the
+    contents in the cache with one `set_many` call per cache backend and
+    timeout each `batch_size` rendered templates.
+    Return a tuple with the number of rendered templates and the list of
+    errors.
+    """
+    rendered, errors = 0, []
+    interval = 1.0 * workers / rate if rate else 0
+    next_time = time.time()
+
+    buffer = WriteBehindBuffer(forced=True)
+    token = current_write_behind_buffer.set(buffer)
+    try:
+        for template_name, context in get_worker_entries(spec, worker_index, workers):
+            if interval:
+                now = time.time()
+                if now < next_time:
+                    time.sleep(next_time - now)
+                next_time = max(now, next_time) + interval
+
+            try:
+                get_template(template_name).render(dict(context, __regenerate__=True))
+            except Exception as e:
+                errors.append('%s: %r' % (template_name, e))
+            else:
+                rendered += 1
+
+            if rendered and not rendered % batch_size:
+                buffer.flush()
+        buffer.flush()
+    finally:
+        current_write_behind_buffer.reset(token)
+        close_old_connections()
+
+    return rendered, errors
+
+
+def init_worker():
+    """
+    Prepare django in a worker process
+    """
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = ('Render templates to save their cache templatetags contents in the cache, for '
+            'the contexts defined in the given spec')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'spec',
+            help='The path of a JSON or YAML file with a list of {"template": name, '
+                 '"contexts": [context, ...]} entries, or the python path of a callable '
+                 'returning (template_name, context) tuples')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='The number of processes rendering the templates (default to 1)')
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='The maximum number of templates rendered per second, for all processes '
+                 '(default to 0: no limit)')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='The number of rendered templates whose contents are saved at once in each '
+                 'process (default to 100)')
+
+    def handle(self, *args, **options):
+        spec, workers = options['spec'], max(options['workers'], 1)
+        specs = [spec] * workers
+        if workers > 1 and os.path.isfile(spec):
+            # a file is read only once, its entries being split between the processes (a
+            # callable is called by each process, as it can return model instances...)
+            entries = list(load_spec(spec))
+            specs = [entries[index::workers] for index in range(workers)]
+        arguments = [
+            (specs[index], index, workers, options['rate'], max(options['batch_size'], 1))
+            for index in range(workers)
+        ]
+
+        start = time.time()
+        if workers == 1:
+            results = [warm(*arguments[0])]
+        else:
+            # the database connections must not be shared with the processes
+            connections.close_all()
+            with Pool(workers, initializer=init_worker) as pool:
+                results = pool.starmap(warm, arguments)
+        duration = time.time() - start
+
+        rendered = sum(result[0] for result in results)
+        errors = [error for result in results for error in result[1]]
+        for error in errors:
+            self.stderr.write('Error when rendering %s' % error)
+
+        self.stdout.write('%d templates rendered (%d errors) in %.2fs (%.1f per second)' % (
+            rendered, len(errors), duration, rendered / duration if duration else 0))
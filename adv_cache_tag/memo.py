@@ -0,0 +1,8 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+from .compat import ContextVar
+
+
+# The decoded contents loaded during the current request, by class, cache backend and cache
+# key, set by `middleware.RequestMemoMiddleware`
+current_request_memo = ContextVar('adv_cache_request_memo', default=None)
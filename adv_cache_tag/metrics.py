@@ -0,0 +1,174 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import bisect
+import logging
+import threading
+
+from django.http import HttpResponse
+
+from .breaker import CircuitBreaker, get_circuit_breakers_states
+
+logger = logging.getLogger('adv_cache_tag')
+
+# Events counted by label: the result of the lookup of a content ("hit", "local_hit", "miss",
+# "version_mismatch", "decode_error", "expired", "regenerate", "fallback"), and the errors
+# ("get", "set", "prefetch", "tags", "lock", "render", "regenerate", "chunks")
+COUNTER_EVENTS = ('lookup', 'error')
+
+# Events whose values are aggregated in histograms, with their buckets
+HISTOGRAM_BUCKETS = {
+    # time to render a content (on a miss), to encode it, to decode it, and to render its
+    # nocache parts, in seconds
+    'render_seconds': (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+    'nocache_seconds': (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+    'encode_seconds': (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+    'decode_seconds': (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+    # size of a content before encoding/compression, and when saved in the cache, in bytes
+    'size_bytes': (100, 1000, 10000, 100000, 1000000),
+    'stored_bytes': (100, 1000, 10000, 100000, 1000000),
+}
+
+
+class Histogram(object):
+    """
+    Count the values in buckets, and keep their sum
+    """
+
+    def __init__(self, buckets):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        # the last one is for values greater than the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsCollector(object):
+    """
+    Aggregate in memory the events sent by the cache templatetags, by class
+    and fragment name, in counters and histograms, and send them to the
+    registered callbacks.
+    """
+
+    def __init__(self):
+        super(MetricsCollector, self).__init__()
+        self.counters = {}
+        self.histograms = {}
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def register_callback(self, callback):
+        """
+        Call the given function for each event, with the class of the cache
+        templatetag, the fragment name, the event and its value
+        """
+        self.callbacks.append(callback)
+
+    def record(self, tag_class, fragment_name, event, value):
+        """
+        Aggregate the given event: `value` is a label for the counted events
+        (`COUNTER_EVENTS`), or a number for the others (`HISTOGRAM_BUCKETS`)
+        """
+        with self._lock:
+            if event in COUNTER_EVENTS:
+                key = (tag_class.__name__, fragment_name, event, value)
+                self.counters[key] = self.counters.get(key, 0) + 1
+            else:
+                key = (tag_class.__name__, fragment_name, event)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(HISTOGRAM_BUCKETS[event])
+                histogram.observe(value)
+
+        for callback in self.callbacks:
+            # a failing callback must not break the rendering, nor the other callbacks
+            try:
+                callback(tag_class, fragment_name, event, value)
+            except Exception:
+                logger.exception('Error when sending the event "%s" to a metrics callback', event)
+
+    def reset(self):
+        """
+        Forget all the aggregated events
+        """
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def export_prometheus(self):
+        """
+        Return the aggregated events in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        for event in COUNTER_EVENTS:
+            name = 'adv_cache_%ss_total' % event
+            lines.append('# TYPE %s counter' % name)
+            for (tag, fragment, counter_event, label), count in counters:
+                if counter_event == event:
+                    lines.append('%s{tag="%s",fragment="%s",%s="%s"} %d' % (
+                        name, self.escape(tag), self.escape(fragment),
+                        'result' if event == 'lookup' else 'kind', self.escape(label), count))
+
+        for event in sorted(HISTOGRAM_BUCKETS):
+            name = 'adv_cache_%s' % event
+            lines.append('# TYPE %s histogram' % name)
+            for (tag, fragment, histogram_event), histogram in histograms:
+                if histogram_event != event:
+                    continue
+                labels = 'tag="%s",fragment="%s"' % (self.escape(tag), self.escape(fragment))
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bucket, cumulative))
+                lines.append('%s_sum{%s} %s' % (name, labels, histogram.sum))
+                lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+# The collector used by the cache templatetags with the `metrics` option
+collector = MetricsCollector()
+
+
+def export_circuit_breakers_prometheus():
+    """
+    Return the state of the circuit breakers of the cache backends in the
+    Prometheus text format
+    """
+    states = sorted(get_circuit_breakers_states().items())
+
+    # all the samples of a metric must be grouped, after its type
+    lines = ['# TYPE adv_cache_circuit_breaker_state gauge']
+    for name, state in states:
+        for breaker_state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+            lines.append('adv_cache_circuit_breaker_state{backend="%s",state="%s"} %d' % (
+                MetricsCollector.escape(name), breaker_state, state['state'] == breaker_state))
+
+    lines.append('# TYPE adv_cache_circuit_breaker_skipped_total counter')
+    for name, state in states:
+        lines.append('adv_cache_circuit_breaker_skipped_total{backend="%s"} %d' % (
+            MetricsCollector.escape(name), state['skipped']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_view(request):
+    """
+    A django view returning the aggregated events, and the state of the
+    circuit breakers, in the Prometheus text format
+    """
+    return HttpResponse(collector.export_prometheus() + export_circuit_breakers_prometheus(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,140 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+import random
+import threading
+
+from django.conf import settings
+
+from .buffer import WriteBehindBuffer, current_write_behind_buffer
+from .memo import current_request_memo
+from .trace import RequestTrace, current_request_trace
+
+
+class WriteBehindMiddleware(object):
+    """
+    Keep the contents to save in the cache by the cache templatetags with the
+    `write_behind` option during a request, and save them, in batches, only
+    when the response is sent (in a background thread if the
+    `ADV_CACHE_WRITE_BEHIND_THREAD` setting is `True`).
+    The buffer is limited by the `ADV_CACHE_WRITE_BEHIND_MAX_ENTRIES` and
+    `ADV_CACHE_WRITE_BEHIND_MAX_BYTES` settings, and the number of buffers
+    waiting for a background thread by `ADV_CACHE_WRITE_BEHIND_MAX_PENDING`
+    (when reached, the buffer is saved without a background thread).
+    """
+
+    # number of buffers submitted to the background thread and not saved yet
+    pending_flushes = 0
+    pending_flushes_lock = threading.Lock()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        buffer = WriteBehindBuffer(
+            getattr(settings, 'ADV_CACHE_WRITE_BEHIND_MAX_ENTRIES', 1000),
+            getattr(settings, 'ADV_CACHE_WRITE_BEHIND_MAX_BYTES', 10485760),
+        )
+        token = current_write_behind_buffer.set(buffer)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            buffer.flush()
+            raise
+        finally:
+            current_write_behind_buffer.reset(token)
+
+        if not len(buffer):
+            return response
+
+        if hasattr(response, '_resource_closers'):
+            # django >= 3.0
+            if getattr(settings, 'ADV_CACHE_WRITE_BEHIND_THREAD', False):
+                response._resource_closers.append(lambda: self.flush_in_thread(buffer))
+            else:
+                response._resource_closers.append(buffer.flush)
+        else:
+            # `close` is called on these objects when the response is closed
+            response._closable_objects.append(buffer)
+
+        return response
+
+    @classmethod
+    def flush_in_thread(cls, buffer):
+        """
+        Save the contents of the buffer using the executor used to
+        regenerate stale contents in background threads, or now if too many
+        buffers are already waiting for it
+        """
+        from .tag import CacheTag
+
+        max_pending = getattr(settings, 'ADV_CACHE_WRITE_BEHIND_MAX_PENDING', 100)
+        with cls.pending_flushes_lock:
+            full = max_pending and cls.pending_flushes >= max_pending
+            if not full:
+                cls.pending_flushes += 1
+
+        if full:
+            buffer.flush()
+            return
+
+        def flush():
+            try:
+                buffer.flush()
+            finally:
+                with cls.pending_flushes_lock:
+                    cls.pending_flushes -= 1
+
+        CacheTag.get_regeneration_executor().submit(flush)
+
+
+class RequestMemoMiddleware(object):
+    """
+    Keep the decoded contents loaded by the cache templatetags with the
+    `request_memo` option during a request, to not load them again if the same
+    fragments are rendered many times in this request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = current_request_memo.set({})
+        try:
+            return self.get_response(request)
+        finally:
+            current_request_memo.reset(token)
+
+
+class ServerTimingMiddleware(object):
+    """
+    Trace the cache templatetags rendered during a request (result of the
+    lookup, time of each step), and add it in the `Server-Timing` header of
+    the response, to be seen in the developer tools of the browsers.
+    Only a part of the requests is traced if the `ADV_CACHE_TRACE_SAMPLE_RATE`
+    setting is lower than `1`, and only the `ADV_CACHE_TRACE_MAX_FRAGMENTS`
+    slowest fragments are detailed in the header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = getattr(settings, 'ADV_CACHE_TRACE_SAMPLE_RATE', 1)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return self.get_response(request)
+
+        trace = RequestTrace()
+        token = current_request_trace.set(trace)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request_trace.reset(token)
+
+        server_timing = trace.get_server_timing(
+            getattr(settings, 'ADV_CACHE_TRACE_MAX_FRAGMENTS', 10))
+        if server_timing:
+            if response.has_header('Server-Timing'):
+                server_timing = response['Server-Timing'] + ', ' + server_timing
+            response['Server-Timing'] = server_timing
+
+        return response
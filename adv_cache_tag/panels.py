@@ -0,0 +1,57 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+from debug_toolbar.panels import Panel
+from django.utils.html import format_html, format_html_join
+
+from .trace import RequestTrace, current_request_trace
+
+
+class CacheFragmentsPanel(Panel):
+    """
+    A django-debug-toolbar panel displaying the cache templatetags rendered
+    during the request: result of the lookup, errors, and time of each step
+    """
+
+    title = 'Cached fragments'
+
+    # the steps displayed in the table, in this order
+    steps = ('total', 'lookup', 'decode', 'render', 'encode', 'nocache')
+
+    @property
+    def nav_subtitle(self):
+        results = self.get_stats().get('results', {})
+        return ', '.join('%d %s' % (count, result) for result, count in sorted(results.items()))
+
+    def process_request(self, request):
+        self.trace = RequestTrace()
+        token = current_request_trace.set(self.trace)
+        try:
+            return super(CacheFragmentsPanel, self).process_request(request)
+        finally:
+            current_request_trace.reset(token)
+
+    def generate_stats(self, request, response):
+        self.record_stats({
+            'results': {str(result): count for result, count in self.trace.get_results().items()},
+            'fragments': [fragment.as_dict() for fragment in self.trace.fragments],
+        })
+
+    @property
+    def content(self):
+        return format_html(
+            '<table><thead><tr><th>Fragment</th><th>Result</th><th>Errors</th>{}</tr></thead>'
+            '<tbody>{}</tbody></table>',
+            format_html_join('', '<th>{} (ms)</th>', ((step, ) for step in self.steps)),
+            format_html_join('', '<tr><td title="{}">{}</td><td>{}</td><td>{}</td>{}</tr>', (
+                (
+                    fragment['cache_key'],
+                    fragment['fragment_name'],
+                    fragment['result'],
+                    ', '.join(fragment['errors']),
+                    format_html_join('', '<td>{}</td>', (
+                        ('%.3f' % fragment['timings'].get(step, 0), ) for step in self.steps
+                    )),
+                )
+                for fragment in self.get_stats().get('fragments', [])
+            )),
+        )
@@ -1,17 +1,47 @@
 # django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
 
+import asyncio
 import hashlib
+import json
 import logging
-import pickle
+import math
+import random
 import re
+import threading
+import time
 import zlib
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+
 from django import VERSION as django_version
 from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from django.template.defaulttags import (AutoEscapeControlNode, ForNode, IfNode, SpacelessNode,
+                                        WithNode)
+from django.template.loader_tags import BlockNode
 from django.utils.encoding import smart_str, force_bytes
 from django.utils.http import urlquote
+from django.utils.safestring import SafeText
+
+from .breaker import get_circuit_breaker
+from .buffer import current_write_behind_buffer
+from .codecs import get_codec
+from .compat import (get_cache, get_template_libraries, setting_changed, sync_to_async,
+                     template)
+from .keys import get_key_value
+from .lru import LRUCache
+from .memo import current_request_memo
+from .metrics import collector as metrics_collector
+from .trace import current_request_trace
 
-from .compat import get_cache, get_template_libraries, template
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 try:
@@ -31,7 +61,20 @@ else:
 logger = logging.getLogger('adv_cache_tag')
 
 
+# Result of `is_template_debug_activated`, computed only once (reset if settings are changed)
+_template_debug_activated = None
+
+
 def is_template_debug_activated():
+    global _template_debug_activated
+
+    if _template_debug_activated is None:
+        _template_debug_activated = _is_template_debug_activated()
+
+    return _template_debug_activated
+
+
+def _is_template_debug_activated():
     if django_version < (1, 8):
         return settings.TEMPLATE_DEBUG
 
@@ -43,6 +86,30 @@ def is_template_debug_activated():
     return False
 
 
+def reset_template_debug_activated(setting, **kwargs):
+    """
+    Forget the result of `is_template_debug_activated` when settings used to
+    compute it are changed (mainly in tests)
+    """
+    global _template_debug_activated
+
+    if setting in ('TEMPLATES', 'TEMPLATE_DEBUG'):
+        _template_debug_activated = None
+
+
+setting_changed.connect(reset_template_debug_activated)
+
+
+def check_async_support():
+    """
+    Raise `ImproperlyConfigured` if the async API cannot be used, as it
+    needs `asgiref` (installed with django >= 3.0)
+    """
+    if sync_to_async is None:
+        raise ImproperlyConfigured('The async API of django-adv-cache-tag needs '
+                                   'django >= 3.0 (or the "asgiref" package)')
+
+
 class Node(template.Node):
     """
     It's a normal template Node, with parameters defined in __init__ and rendering
@@ -61,6 +128,9 @@ class Node(template.Node):
 
         If the `include_pk` option is activated, the first argument in `vary_on`
         will be used as the `pk` (but not removed from `vary_on`.
+
+        A `depends=...` argument, anywhere in `vary_on`, is removed from it and
+        used to define the tags the fragment depends on.
         """
         super(Node, self).__init__()
         self.nodename = nodename
@@ -68,6 +138,8 @@ class Node(template.Node):
         self.expire_time = template.Variable(expire_time)
         self.fragment_name = template.Variable(fragment_name)
 
+        self.depends = self.pop_depends(vary_on)
+
         self.cache_backend = None
         if vary_on and vary_on[-1].startswith('using='):
             self.cache_backend = vary_on.pop()[len('using='):]
@@ -81,12 +153,345 @@ class Node(template.Node):
 
         self.vary_on = vary_on
 
+        # `vary_on` and `depends` compiled as `FilterExpression` objects, set by
+        # `compile_arguments`
+        self.vary_on_expressions = None
+        self.depends_expression = None
+
+        # the fragment name without its quotes, set the first time it's needed
+        self.literal_fragment_name = None
+
+    @staticmethod
+    def pop_depends(vary_on):
+        """
+        Remove the `depends=...` argument from `vary_on` and return its value,
+        or `None` if not found. A quoted value containing spaces, if split by
+        a custom `get_template_node_arguments`, is joined back.
+        """
+        for index, var in enumerate(vary_on):
+            if var.startswith('depends='):
+                break
+        else:
+            return None
+
+        depends = vary_on.pop(index)[len('depends='):]
+        quote = depends[:1]
+        if quote in ('"', "'"):
+            while index < len(vary_on) and (len(depends) < 2 or not depends.endswith(quote)):
+                depends += ' ' + vary_on.pop(index)
+        return depends
+
+    def compile_arguments(self, parser):
+        """
+        Compile, only once at parse time, the `vary_on` and `depends`
+        arguments, allowing the use of filters (like `obj.updated_at|date:"U"`)
+        """
+        self.vary_on_expressions = [parser.compile_filter(var) for var in self.vary_on]
+        if self.depends is not None:
+            self.depends_expression = parser.compile_filter(self.depends)
+
+    def resolve_depends(self, context):
+        """
+        Return the sorted list of the tags the fragment depends on. The
+        `depends` argument can be a string (tags separated by spaces or
+        commas), or a list of tags.
+        """
+        if self.depends is None:
+            return []
+
+        if self.depends_expression is None:
+            tags = template.Variable(self.depends).resolve(context)
+        else:
+            tags = self.depends_expression.resolve(context)
+
+        if not tags:
+            return []
+        if isinstance(tags, str):
+            tags = tags.replace(',', ' ').split()
+        return sorted(set(str(tag) for tag in tags))
+
+    def resolve_vary_on(self, context):
+        """
+        Return the resolved values of the `vary_on` arguments.
+        As for `template.Variable`, `VariableDoesNotExist` is raised for an
+        unknown variable without filters.
+        """
+        if self.vary_on_expressions is None:
+            return [template.Variable(var).resolve(context) for var in self.vary_on]
+
+        values = []
+        for expression in self.vary_on_expressions:
+            if expression.filters:
+                values.append(expression.resolve(context))
+            elif isinstance(expression.var, template.Variable):
+                values.append(expression.var.resolve(context))
+            else:
+                # a constant, already resolved
+                values.append(expression.var)
+        return values
+
     def render(self, context):
         """
         Render the template by calling the render method of the main
-        cache object.
+        cache object (the one created by the prefetch templatetag, if any)
         """
-        return self._cachetag_class_(self, context).render()
+        cache_tag = None
+        prefetched_tags = context.get(CacheTag.PREFETCHED_TAGS_CONTEXT_NAME)
+        if prefetched_tags:
+            cache_tag = prefetched_tags.pop(id(self), None)
+            if cache_tag is not None and not cache_tag.can_render_in(context):
+                cache_tag = None
+        if cache_tag is None:
+            cache_tag = self._cachetag_class_(self, context)
+        return cache_tag.render()
+
+
+class PrefetchNode(template.Node):
+    """
+    Node of the prefetch templatetag: before rendering its content, it looks
+    for all the cache templatetags it contains (including in `for` loops over
+    an already evaluated list), and fetch their cached content with only one
+    `get_many` call per cache backend. These contents will then be used by
+    the cache templatetags instead of fetching them one by one.
+    """
+
+    # Nodes not changing the context used by the nodes they contain: the `CacheTag` objects
+    # created for the cache templatetags they contain can be used to render them
+    transparent_nodes = (IfNode, BlockNode, SpacelessNode, AutoEscapeControlNode)
+
+    def __init__(self, nodelist):
+        super(PrefetchNode, self).__init__()
+        self.nodelist = nodelist
+
+    def get_cache_tags(self, nodelist, context, cache_tags, reusable=True):
+        """
+        Fill `cache_tags` with the `CacheTag` objects of all the cache
+        templatetags found in `nodelist` for which the cache key can be
+        computed with the given context, each with a boolean telling if it
+        can be used to render its templatetag (`False` in a `for` loop or in
+        a templatetag that may change the context).
+        """
+        for node in nodelist:
+            if isinstance(node, Node):
+                try:
+                    cache_tags.append((node._cachetag_class_(node, context), reusable))
+                except Exception:
+                    # cannot compute the key now, it will be fetched during rendering
+                    pass
+            elif isinstance(node, ForNode):
+                self.get_cache_tags_in_for_loop(node, context, cache_tags)
+            elif isinstance(node, WithNode):
+                try:
+                    values = {key: val.resolve(context) for key, val in node.extra_context.items()}
+                except Exception:
+                    continue
+                with context.push(**values):
+                    self.get_cache_tags(node.nodelist, context, cache_tags, reusable)
+            else:
+                for attr in node.child_nodelists:
+                    self.get_cache_tags(getattr(node, attr, None) or [], context, cache_tags,
+                                        reusable and isinstance(node, self.transparent_nodes))
+
+    def get_cache_tags_in_for_loop(self, node, context, cache_tags):
+        """
+        Fill `cache_tags` with the `CacheTag` objects of all the cache
+        templatetags found in the `for` loop defined by `node`, for each value
+        of the loop, if its iterable is already evaluated.
+        It mimics the `render` method of the `for` templatetag.
+        """
+        values = node.sequence.resolve(context, ignore_failures=True)
+        if not isinstance(values, (list, tuple)):
+            # we don't want to evaluate iterables, except querysets already evaluated
+            values = getattr(values, '_result_cache', None)
+            if values is None:
+                return
+        if not values:
+            return
+        if node.is_reversed:
+            values = values[::-1]
+
+        len_values = len(values)
+        unpack = len(node.loopvars) > 1
+        parentloop = context.get('forloop', {})
+
+        with context.push():
+            loop_dict = context['forloop'] = {'parentloop': parentloop}
+            for index, item in enumerate(values):
+                loop_dict['counter0'] = index
+                loop_dict['counter'] = index + 1
+                loop_dict['revcounter'] = len_values - index
+                loop_dict['revcounter0'] = len_values - index - 1
+                loop_dict['first'] = (index == 0)
+                loop_dict['last'] = (index == len_values - 1)
+
+                if unpack:
+                    try:
+                        if len(item) != len(node.loopvars):
+                            continue
+                    except TypeError:
+                        continue
+                    with context.push(**dict(zip(node.loopvars, item))):
+                        self.get_cache_tags(node.nodelist_loop, context, cache_tags, False)
+                else:
+                    context[node.loopvars[0]] = item
+                    self.get_cache_tags(node.nodelist_loop, context, cache_tags, False)
+
+    def prefetch(self, context):
+        """
+        Fetch the cached content of all the cache templatetags of the
+        content of this node, with one `get_many` call per cache backend.
+        Return a dict with the cache objects as keys, and for each a dict with
+        the cache keys as keys and the cached content (or `None`) as values.
+        """
+        prefetched = {}
+        for cache, (cache_tag, keys) in self.get_keys_to_prefetch(context).items():
+            try:
+                contents = cache_tag.cache_get_many(keys)
+                prefetched[cache] = {key: cache_tag.join_chunks(contents.get(key), key)
+                                     for key in keys}
+            except Exception:
+                if is_template_debug_activated():
+                    raise
+                logger.exception('Error when prefetching cached template fragments')
+                cache_tag.record_metric('error', 'prefetch')
+
+        return prefetched
+
+    def get_keys_to_prefetch(self, context):
+        """
+        Return a dict with the cache objects as keys, and for each a tuple with
+        one of the cache templatetags using it, and the set of the cache keys
+        to fetch (the ones not already in memory, and not to regenerate).
+        The `CacheTag` objects that can be used to render their templatetag
+        are saved in the context, if it has a place for them (see `render`).
+        """
+        cache_tags = []
+        with context.push(**{CacheTag.PREFETCHING_CONTEXT_NAME: True}):
+            self.get_cache_tags(self.nodelist, context, cache_tags)
+        self.prefetch_tags_generations(context, [cache_tag for cache_tag, __ in cache_tags])
+
+        prefetched_tags = context.get(CacheTag.PREFETCHED_TAGS_CONTEXT_NAME)
+        if prefetched_tags is not None:
+            seen = set()
+            for cache_tag, reusable in cache_tags:
+                node_id = id(cache_tag.node)
+                if node_id in seen:
+                    # many objects for the same templatetag: don't know which one to use
+                    prefetched_tags.pop(node_id, None)
+                elif reusable:
+                    prefetched_tags[node_id] = cache_tag
+                seen.add(node_id)
+
+        by_cache = {}
+        for cache_tag, __ in cache_tags:
+            if cache_tag.regenerate or cache_tag.load_local_content():
+                continue
+            by_cache.setdefault(cache_tag.cache, (cache_tag, set()))[1].add(cache_tag.cache_key)
+
+        return by_cache
+
+    def prefetch_tags_generations(self, context, cache_tags):
+        """
+        Fetch the generations of the tags the given `CacheTag` objects depend
+        on, unknown when they were created, with one `get_many` call per
+        cache backend, save them in the context (to be used during the
+        rendering), and compute the cache keys of these objects.
+        """
+        pending = [cache_tag for cache_tag in cache_tags if cache_tag.tags_generations_pending]
+        if not pending:
+            return
+
+        by_cache = {}
+        for cache_tag in pending:
+            by_cache.setdefault(cache_tag.cache, (cache_tag, set()))[1].update(
+                cache_tag.get_tag_key(tag) for tag in cache_tag.depends)
+
+        known = context.get(CacheTag.TAGS_GENERATIONS_CONTEXT_NAME)
+        if known is None:
+            known = {}
+        failed = set()
+        for cache, (cache_tag, keys) in by_cache.items():
+            try:
+                generations = cache_tag.call_cache(cache_tag.fetch_tags_generations, sorted(keys))
+            except Exception:
+                if is_template_debug_activated():
+                    raise
+                logger.exception('Error when getting the generations of the tags of cached '
+                                 'template fragments')
+                cache_tag.record_metric('error', 'tags')
+                generations = None
+            if generations is None:
+                failed.add(cache)
+            else:
+                known.setdefault(cache, {}).update(generations)
+
+        with context.push(**{CacheTag.TAGS_GENERATIONS_CONTEXT_NAME: known}):
+            for cache_tag in pending:
+                cache_tag.tags_generations_pending = False
+                if cache_tag.cache in failed:
+                    # rendered without using the cache, as in `get_tags_generations`
+                    cache_tag.regenerate = True
+                    cache_tag.write_to_cache = False
+                else:
+                    cache_tag.cache_key = cache_tag.get_cache_key()
+
+    async def aprefetch(self, context):
+        """
+        Async version of `prefetch`, fetching the contents from all the cache
+        backends concurrently, with the async cache API.
+        The cache templatetags are found in a thread, as resolving their
+        arguments may access the database.
+        """
+        check_async_support()
+        by_cache = await sync_to_async(self.get_keys_to_prefetch)(context)
+
+        caches = list(by_cache)
+        results = await asyncio.gather(*(
+            cache_tag.acache_get_many(keys) for cache_tag, keys in by_cache.values()
+        ), return_exceptions=True)
+
+        prefetched = {}
+        for cache, (cache_tag, keys), contents in zip(caches, by_cache.values(), results):
+            try:
+                if isinstance(contents, Exception):
+                    raise contents
+                prefetched[cache] = {key: await cache_tag.ajoin_chunks(contents.get(key), key)
+                                     for key in keys}
+            except Exception:
+                if is_template_debug_activated():
+                    raise
+                logger.exception('Error when prefetching cached template fragments')
+                cache_tag.record_metric('error', 'prefetch')
+
+        return prefetched
+
+    def render(self, context):
+        """
+        Prefetch the cached content of the cache templatetags, then render
+        the content of this node with the prefetched contents available in
+        the context.
+        """
+        outer = context.get(CacheTag.PREFETCH_CONTEXT_NAME)
+
+        with context.push(**{
+            # the generations of the tags are the same for the whole rendering
+            CacheTag.TAGS_GENERATIONS_CONTEXT_NAME:
+                context.get(CacheTag.TAGS_GENERATIONS_CONTEXT_NAME) or {},
+            CacheTag.PREFETCHED_TAGS_CONTEXT_NAME: {},
+        }):
+            prefetched = self.prefetch(context)
+
+            # keep what was prefetched by an outer prefetch templatetag
+            if outer:
+                for cache, contents in outer.items():
+                    prefetched.setdefault(cache, {}).update(
+                        (key, content)
+                        for key, content in contents.items()
+                        if key not in prefetched[cache]
+                    )
+
+            context[CacheTag.PREFETCH_CONTEXT_NAME] = prefetched
+            return self.nodelist.render(context)
 
 
 class CacheTagMetaClass(type):
@@ -113,11 +518,43 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         * ADV_CACHE_VERSIONING
         * ADV_CACHE_COMPRESS
         * ADV_CACHE_COMPRESS_LEVEL
+        * ADV_CACHE_CODEC
+        * ADV_CACHE_COMPRESS_MIN_SIZE
+        * ADV_CACHE_COMPRESS_MIN_RATIO
         * ADV_CACHE_COMPRESS_SPACES
         * ADV_CACHE_INCLUDE_PK
         * ADV_CACHE_BACKEND
         * ADV_CACHE_VERSION
         * ADV_CACHE_RESOLVE_NAME
+        * ADV_CACHE_NOCACHE_TEMPLATES_MAX_ENTRIES
+        * ADV_CACHE_NOCACHE_TEMPLATES_MAX_BYTES
+        * ADV_CACHE_SEGMENTED
+        * ADV_CACHE_LOCK
+        * ADV_CACHE_LOCK_TIMEOUT
+        * ADV_CACHE_LOCK_WAIT
+        * ADV_CACHE_LOCK_POLL_INTERVAL
+        * ADV_CACHE_LOCK_FALLBACK
+        * ADV_CACHE_STALE_TTL
+        * ADV_CACHE_REGENERATION_WORKERS
+        * ADV_CACHE_REGENERATION_QUEUE_SIZE
+        * ADV_CACHE_EARLY_EXPIRY_BETA
+        * ADV_CACHE_LOCAL_MAX_ENTRIES
+        * ADV_CACHE_LOCAL_MAX_BYTES
+        * ADV_CACHE_LOCAL_TTL
+        * ADV_CACHE_KEY_HASH
+        * ADV_CACHE_KEY_HASH_MEMO_MAX_ENTRIES
+        * ADV_CACHE_KEY_ADAPTERS
+        * ADV_CACHE_WRITE_BEHIND
+        * ADV_CACHE_WRITE_BEHIND_OVERFLOW
+        * ADV_CACHE_REQUEST_MEMO
+        * ADV_CACHE_METRICS
+        * ADV_CACHE_CIRCUIT_BREAKER_THRESHOLD
+        * ADV_CACHE_CIRCUIT_BREAKER_WINDOW
+        * ADV_CACHE_CIRCUIT_BREAKER_COOLDOWN
+        * ADV_CACHE_FALLBACK_TTL
+        * ADV_CACHE_FALLBACK_RETRY_DELAY
+        * ADV_CACHE_FALLBACK_RETRY_MAX_DELAY
+        * ADV_CACHE_CHUNK_SIZE
 
     Or inherit from this class and don't forget to register your tag :
 
@@ -133,8 +570,26 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
 
     # Will change if the algorithm changes
     INTERNAL_VERSION = '1'
+    # Used instead of INTERNAL_VERSION for the contents with metadata, so they are seen as
+    # a version mismatch by the code written before the metadata (during a deploy...)
+    METADATA_INTERNAL_VERSION = '2'
     # Used to separate internal version, template version, and the content
     VERSION_SEPARATOR = '::'
+    # Used to start the optional metadata part, between the version(s) and the content,
+    # and to separate the `key=value` entries of this metadata part
+    METADATA_MARKER = b'\x00'
+    METADATA_SEPARATOR = b';'
+    # Used to start the manifest saved instead of a content split in many chunks
+    CHUNKS_MARKER = b'\x01chunks'
+
+    # Name of the context variable holding the contents fetched by the prefetch templatetag
+    PREFETCH_CONTEXT_NAME = '__adv_cache_prefetched__'
+    # Names of the context variables holding the generations of the tags fetched by the
+    # prefetch templatetag (by cache object), the `CacheTag` objects it created to be used
+    # to render their templatetag (by id of node), and telling that it is creating them
+    TAGS_GENERATIONS_CONTEXT_NAME = '__adv_cache_tags_generations__'
+    PREFETCHED_TAGS_CONTEXT_NAME = '__adv_cache_prefetched_tags__'
+    PREFETCHING_CONTEXT_NAME = '__adv_cache_prefetching__'
 
     # Regex used to reduce spaces/blanks (many spaces into one)
     RE_SPACELESS = re.compile(r'\s\s+')
@@ -154,6 +609,29 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
     _templatetags = {}
     # internal use only: name of the templatetags module to load for this class and subclasses
     _templatetags_modules = {}
+    # internal use only: compiled templates used to render the nocache parts, for each class
+    _nocache_templates = {}
+    # internal use only: decoded contents kept in memory in front of the cache backend,
+    # for each class
+    _local_caches = {}
+    # internal use only: hashes of `vary_on` arguments kept in memory, for each class
+    _key_hash_memos = {}
+    # internal use only: types of the `vary_on` arguments for which the hash can be kept in
+    # memory (their string representation is enough to identify them)
+    _key_hash_memo_types = {str, SafeText, bytes, int, float, bool, type(None), Decimal,
+                            date, datetime}
+    # internal use only: ids of the unavailable codecs already reported, see `get_encoding_codec`
+    _unavailable_codecs = set()
+    # internal use only: final "INTERNAL_VERSION" of each class, see `get_internal_version`
+    _internal_versions = {}
+    # internal use only: executor (and its lock) used to regenerate stale content in the
+    # background, and regenerations queued or running, by cache key
+    _regeneration_executor = None
+    _regeneration_lock = threading.Lock()
+    _regenerations = {}
+    # internal use only: number of failed regenerations of the fragments returning their
+    # previous content, and time of the next try, by cache backend name and cache key
+    _fallback_retries = LRUCache(max_entries=10000)
 
     options = None
     Node = Node
@@ -172,6 +650,15 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         compress = getattr(settings, 'ADV_CACHE_COMPRESS', False)
         compress_level = getattr(settings, 'ADV_CACHE_COMPRESS_LEVEL', zlib.Z_DEFAULT_COMPRESSION)
 
+        # The id of the codec used to encode the content before caching (see `codecs.py`). If
+        # set, it's used instead of the `compress` option and saved with the content
+        codec = getattr(settings, 'ADV_CACHE_CODEC', None)
+
+        # When compressing, contents smaller than this size (in bytes), or compressed with a
+        # ratio (original size / compressed size) lower than this one, are cached uncompressed
+        compress_min_size = getattr(settings, 'ADV_CACHE_COMPRESS_MIN_SIZE', 0)
+        compress_min_ratio = getattr(settings, 'ADV_CACHE_COMPRESS_MIN_RATIO', 0)
+
         # If many spaces/blanks will be converted into one
         compress_spaces = getattr(settings, 'ADV_CACHE_COMPRESS_SPACES', False)
 
@@ -187,6 +674,89 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         # If the fragment name should be resolved or taken as is
         resolve_fragment = getattr(settings, 'ADV_CACHE_RESOLVE_NAME', False)
 
+        # Max number of compiled templates used to render the nocache parts to keep in memory
+        # (`0` to deactivate), and max total size of their source
+        nocache_templates_max_entries = getattr(settings,
+                                                'ADV_CACHE_NOCACHE_TEMPLATES_MAX_ENTRIES', 1000)
+        nocache_templates_max_bytes = getattr(settings,
+                                              'ADV_CACHE_NOCACHE_TEMPLATES_MAX_BYTES', 10485760)
+
+        # If the content is saved as a list of segments, static html and nocache parts, to
+        # only render the nocache parts when loaded from the cache
+        segmented = getattr(settings, 'ADV_CACHE_SEGMENTED', False)
+
+        # If only one process can regenerate a missing fragment, using a lock in the cache
+        # backend, the other ones waiting for the regenerated content
+        lock = getattr(settings, 'ADV_CACHE_LOCK', False)
+        # Expiry time of the lock (in seconds), in case the process holding it dies
+        lock_timeout = getattr(settings, 'ADV_CACHE_LOCK_TIMEOUT', 10)
+        # Max time to wait (in seconds) for the content regenerated by another process, and
+        # delay between two checks
+        lock_wait = getattr(settings, 'ADV_CACHE_LOCK_WAIT', 5)
+        lock_poll_interval = getattr(settings, 'ADV_CACHE_LOCK_POLL_INTERVAL', 0.1)
+        # What to do if the content is still not available after waiting: "render" to render
+        # it without saving it in the cache, "save" to render and save it
+        lock_fallback = getattr(settings, 'ADV_CACHE_LOCK_FALLBACK', 'render')
+
+        # Time (in seconds) a fragment is kept in the cache after its expiry time, to be
+        # returned while it is regenerated in the background (`0` to deactivate)
+        stale_ttl = getattr(settings, 'ADV_CACHE_STALE_TTL', 0)
+
+        # Weight of the probabilistic early expiry of fragments ("XFetch" algorithm), based on
+        # the time taken to render them (`0` to deactivate, `1` is a good default)
+        early_expiry_beta = getattr(settings, 'ADV_CACHE_EARLY_EXPIRY_BETA', 0)
+
+        # Max number of decoded fragments kept in the memory of the process, in front of the
+        # cache backend (`0` to deactivate), max total size of their content, and max time (in
+        # seconds) to keep them (never more than the expire time of the fragments)
+        local_cache_max_entries = getattr(settings, 'ADV_CACHE_LOCAL_MAX_ENTRIES', 0)
+        local_cache_max_bytes = getattr(settings, 'ADV_CACHE_LOCAL_MAX_BYTES', 10485760)
+        local_cache_ttl = getattr(settings, 'ADV_CACHE_LOCAL_TTL', 5)
+
+        # The algorithm used to hash the `vary_on` arguments in the cache key: "md5" (the
+        # historical one), "blake2b" or "xxhash" (if installed), the last two using a
+        # length-prefixed encoding of the arguments instead of `urlquote`
+        key_hash = getattr(settings, 'ADV_CACHE_KEY_HASH', 'md5')
+        # If positive, the maximum number of hashes kept in memory, by values of arguments (only
+        # with the "md5" key hash, the other ones being as fast as the memo)
+        key_hash_memo_max_entries = getattr(settings, 'ADV_CACHE_KEY_HASH_MEMO_MAX_ENTRIES', 0)
+
+        # If the `vary_on` arguments are converted to the values to use in the cache key with
+        # their `__cache_key__` method or an adapter (see `keys.py`) instead of being stringified
+        key_adapters = getattr(settings, 'ADV_CACHE_KEY_ADAPTERS', False)
+
+        # If the contents are saved in the cache only when the response is sent, in batches (needs
+        # `middleware.WriteBehindMiddleware`), and what to do when its buffer is full: "write" the
+        # content immediately, or "drop" it (it will not be cached)
+        write_behind = getattr(settings, 'ADV_CACHE_WRITE_BEHIND', False)
+        write_behind_overflow = getattr(settings, 'ADV_CACHE_WRITE_BEHIND_OVERFLOW', 'write')
+
+        # If the decoded contents are kept during a request, to not load them again if the same
+        # fragments are rendered many times (needs `middleware.RequestMemoMiddleware`)
+        request_memo = getattr(settings, 'ADV_CACHE_REQUEST_MEMO', False)
+
+        # If events (lookups results, errors, rendering time, sizes...) are sent to the metrics
+        # collector (`metrics.collector`), by class and fragment name
+        metrics = getattr(settings, 'ADV_CACHE_METRICS', False)
+
+        # Stop using a cache backend for `circuit_breaker_cooldown` seconds after
+        # `circuit_breaker_threshold` errors in `circuit_breaker_window` seconds (`0` to deactivate)
+        circuit_breaker_threshold = getattr(settings, 'ADV_CACHE_CIRCUIT_BREAKER_THRESHOLD', 0)
+        circuit_breaker_window = getattr(settings, 'ADV_CACHE_CIRCUIT_BREAKER_WINDOW', 10)
+        circuit_breaker_cooldown = getattr(settings, 'ADV_CACHE_CIRCUIT_BREAKER_COOLDOWN', 30)
+
+        # Time (in seconds) a fragment is kept in the cache after its expiry time, to be
+        # returned if it cannot be regenerated (`0` to deactivate). A new regeneration is then
+        # only tried after a delay, starting at `fallback_retry_delay` seconds and doubled after
+        # each failure, up to `fallback_retry_max_delay` seconds
+        fallback_ttl = getattr(settings, 'ADV_CACHE_FALLBACK_TTL', 0)
+        fallback_retry_delay = getattr(settings, 'ADV_CACHE_FALLBACK_RETRY_DELAY', 5)
+        fallback_retry_max_delay = getattr(settings, 'ADV_CACHE_FALLBACK_RETRY_MAX_DELAY', 300)
+
+        # Max size (in bytes) of the data saved in one cache entry, bigger contents being split
+        # in many chunks (`0` to deactivate). Can be a dict with a size by cache backend name
+        chunk_size = getattr(settings, 'ADV_CACHE_CHUNK_SIZE', 0)
+
     # Use a metaclass to use the right class in the Node class, and assign Meta to options
 
     def __init__(self, node, context):
@@ -214,25 +784,58 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         self.content = ''
         # the version used in the cached templatetag
         self.content_version = None
-
-        # Final "INTERNAL_VERSION"
-        if self.options.internal_version:
-            self.INTERNAL_VERSION = force_bytes('%s|%s' % (self.__class__.INTERNAL_VERSION,
-                                                           self.options.internal_version))
-        else:
-            self.INTERNAL_VERSION = force_bytes(self.__class__.INTERNAL_VERSION)
+        # the metadata saved with the content (format...)
+        self.content_metadata = {}
+        # indicate if the content created will be saved in the cache
+        self.write_to_cache = True
+        # the segments of the content, if segmented, when decoded
+        self.segments = None
+        # why the content got from the cache cannot be used, see `read_content`
+        self.read_failure = None
+        # the trace of the rendering, if the current request is traced
+        self.trace = None
+        # indicate if the content is created while holding the lock
+        self.holding_lock = False
+
+        # Final "INTERNAL_VERSION" (and the one for the contents with metadata)
+        self.INTERNAL_VERSION = self.get_internal_version()
+        self.METADATA_INTERNAL_VERSION = self.get_internal_version(metadata=True)
 
         self.VERSION_SEPARATOR = force_bytes(self.__class__.VERSION_SEPARATOR)
 
         # prepare all parameters passed to the templatetag
         self.expire_time = None
         self.version = None
+        self.depends = []
+        # if the generations of the tags are fetched later, by the prefetch templatetag
+        self.tags_generations_pending = False
         self.prepare_params()
 
         # get the cache and cache key
         self.cache = self.get_cache_object()
         self.cache_key = self.get_cache_key()
 
+    @classmethod
+    def get_internal_version(cls, metadata=False):
+        """
+        Return the final "INTERNAL_VERSION" (or "METADATA_INTERNAL_VERSION"
+        if `metadata` is `True`), as bytes, computed only once for a class
+        and its `internal_version` option
+        """
+        base = cls.METADATA_INTERNAL_VERSION if metadata else cls.INTERNAL_VERSION
+        key = (cls, base, cls.options.internal_version)
+        try:
+            return CacheTag._internal_versions[key]
+        except KeyError:
+            pass
+
+        if cls.options.internal_version:
+            internal_version = force_bytes('%s|%s' % (base, cls.options.internal_version))
+        else:
+            internal_version = force_bytes(base)
+
+        return CacheTag._internal_versions.setdefault(key, internal_version)
+
     def prepare_params(self):
         """
         Prepare the parameters passed to the templatetag
@@ -240,22 +843,49 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         if self.options.resolve_fragment:
             self.fragment_name = self.node.fragment_name.resolve(self.context)
         else:
-            self.fragment_name = str(self.node.fragment_name)
-            # Remove quotes that surround the name
-            for char in '\'\"':
-                if self.fragment_name.startswith(char) or self.fragment_name.endswith(char):
-                    if self.fragment_name.startswith(char) and self.fragment_name.endswith(char):
-                        self.fragment_name = self.fragment_name[1:-1]
-                        break
-                    else:
-                        raise ValueError('Number of quotes around the fragment name is incoherent')
+            if self.node.literal_fragment_name is None:
+                self.node.literal_fragment_name = self.get_literal_fragment_name()
+            self.fragment_name = self.node.literal_fragment_name
 
         self.expire_time = self.get_expire_time()
 
         if self.options.versioning:
             self.version = force_bytes(self.get_version())
 
-        self.vary_on = [template.Variable(var).resolve(self.context) for var in self.node.vary_on]
+        self.vary_on = self.node.resolve_vary_on(self.context)
+
+        self.depends = self.node.resolve_depends(self.context)
+
+    def can_render_in(self, context):
+        """
+        Return `True` if this object, created by the prefetch templatetag, can
+        be used to render its templatetag in the given context: if its
+        arguments still resolve to the same values (they may have been
+        changed by the templatetags rendered since).
+        """
+        try:
+            if self.options.versioning and self.node.version and (
+                    force_bytes('%s' % self.node.version.resolve(context)) != self.version):
+                return False
+            return (self.node.resolve_vary_on(context) == self.vary_on
+                    and self.node.resolve_depends(context) == self.depends)
+        except Exception:
+            return False
+
+    def get_literal_fragment_name(self):
+        """
+        Return the fragment name passed to the templatetag, without the quotes
+        that may surround it
+        """
+        fragment_name = str(self.node.fragment_name)
+        # Remove quotes that surround the name
+        for char in '\'\"':
+            if fragment_name.startswith(char) or fragment_name.endswith(char):
+                if fragment_name.startswith(char) and fragment_name.endswith(char):
+                    return fragment_name[1:-1]
+                else:
+                    raise ValueError('Number of quotes around the fragment name is incoherent')
+        return fragment_name
 
     def get_expire_time(self):
         """
@@ -299,15 +929,203 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
     def hash_args(self):
         """
         Take all the arguments passed after the fragment name and return a
-        hashed version which will be used in the cache key
+        hashed version which will be used in the cache key, kept in memory if
+        the `key_hash_memo_max_entries` option is set (with the "md5" key hash)
+        and all arguments are of simple types
+        """
+        values = self.get_key_values()
+
+        memo = self.get_key_hash_memo()
+        if memo is None or any(type(var) not in self._key_hash_memo_types for var in values):
+            return self.compute_hash_args(values)
+
+        # use the string representation, as equal values can have different ones (like
+        # `Decimal('1.0')` and `Decimal('1.00')`, or datetimes in different timezones)
+        memo_key = tuple((type(var), force_bytes(var)) for var in values)
+        hashed = memo.get(memo_key)
+        if hashed is None:
+            hashed = self.compute_hash_args(values)
+            memo.set(memo_key, hashed)
+        return hashed
+
+    def get_key_values(self):
+        """
+        Return the values of the arguments passed after the fragment name, to
+        be hashed. If the `key_adapters` option is set, each one is replaced by
+        the value returned by `keys.get_key_value`, to avoid stringifying
+        objects like querysets or model instances.
+        If the fragment depends on some tags, their generations are added.
+        """
+        if not self.options.key_adapters:
+            values = self.vary_on
+        else:
+            values = [get_key_value(var) for var in self.vary_on]
+
+        if self.depends:
+            values = list(values) + [
+                '%s=%s' % (tag, generation)
+                for tag, generation in zip(self.depends, self.get_tags_generations())
+            ]
+
+        return values
+
+    @classmethod
+    def get_tag_key(cls, tag):
+        """
+        Return the cache key of the generation counter of the given tag
+        """
+        return 'template.tag.%s' % tag
+
+    @staticmethod
+    def get_tag_initial_generation():
+        """
+        Return the generation of a tag without counter (never used or removed
+        from the cache): based on the current time, to not reuse the
+        generation of a removed counter
+        """
+        return int(time.time() * 1000)
+
+    def get_tags_generations(self):
+        """
+        Return the generations of the tags the fragment depends on, in the
+        same order, fetched with only one `get_many` call (or by the prefetch
+        templatetag). Missing counters are created.
+        If the counters cannot be fetched, the content will be rendered
+        without using the cache.
+        """
+        keys = [self.get_tag_key(tag) for tag in self.depends]
+
+        known = (self.context.get(self.TAGS_GENERATIONS_CONTEXT_NAME) or {}).get(self.cache)
+        if known and all(key in known for key in keys):
+            return [known[key] for key in keys]
+
+        if self.context.get(self.PREFETCHING_CONTEXT_NAME):
+            # fetched later, with the other fragments, by `PrefetchNode.prefetch_tags_generations`
+            self.tags_generations_pending = True
+            return ['' for key in keys]
+
+        try:
+            generations = self.call_cache(self.fetch_tags_generations, keys)
+        except Exception:
+            if is_template_debug_activated():
+                raise
+            logger.exception('Error when getting the generations of the tags of a '
+                             'cached template fragment')
+            self.record_metric('error', 'tags')
+            generations = None
+
+        if generations is None:
+            self.regenerate = True
+            self.write_to_cache = False
+            return ['' for key in keys]
+
+        return [generations[key] for key in keys]
+
+    def fetch_tags_generations(self, keys):
+        """
+        Return a dict with the generations of the given tags keys, creating
+        the missing counters
+        """
+        generations = self.cache.get_many(keys)
+        for key in keys:
+            if key not in generations:
+                generation = self.get_tag_initial_generation()
+                self.cache.add(key, generation, None)
+                generations[key] = self.cache.get(key, generation)
+        return generations
+
+    @staticmethod
+    def incr_tag_generation(cache, key):
+        """
+        Increment the generation counter with the given key, and return the
+        new generation, or `None` if there is no counter (a missing key is not
+        an error of the cache backend for its circuit breaker)
+        """
+        try:
+            return cache.incr(key)
+        except ValueError:
+            return None
+
+    @classmethod
+    def invalidate_tags(cls, *tags, cache_backend=None):
+        """
+        Invalidate all the fragments depending on the given tags (in the given
+        cache backend, or the one defined by the `cache_backend` option), by
+        incrementing the generation counter of each tag: the cache keys of
+        these fragments will change.
+        The counters are saved in the cache backend of the fragments, so the
+        fragments using another one (with `using=`) are only invalidated by
+        passing its name as `cache_backend`.
+        If the circuit breaker of the cache backend is open, the tags are not
+        invalidated, and a warning is logged.
+        """
+        cache_backend = cache_backend or cls.options.cache_backend
+        cache = get_cache(cache_backend)
+        breaker = cls.get_backend_circuit_breaker(cache_backend)
+        skipped = object()
+
+        for tag in tags:
+            key = cls.get_tag_key(tag)
+            result = cls.call_with_circuit_breaker(breaker, cls.incr_tag_generation, cache, key,
+                                                   default=skipped)
+            if result is None:
+                # no counter yet: the fragments depending on this tag will create it
+                result = cls.call_with_circuit_breaker(
+                    breaker, cache.add, key, cls.get_tag_initial_generation(), None,
+                    default=skipped)
+                if result is False:
+                    # created meanwhile by a fragment, maybe with the old generation
+                    result = cls.call_with_circuit_breaker(
+                        breaker, cls.incr_tag_generation, cache, key, default=skipped)
+            if result is skipped:
+                logger.warning('Tag "%s" not invalidated: the cache backend "%s" is not '
+                               'available', tag, cache_backend)
+
+    def compute_hash_args(self, values):
+        """
+        Return the hash of the given values of the arguments passed after the
+        fragment name, using the algorithm defined by the `key_hash` option
+        """
+        if self.options.key_hash == 'md5':
+            return hashlib.md5(force_bytes(':'.join([urlquote(force_bytes(var)) for var in values]))).hexdigest()
+
+        parts = []
+        for var in values:
+            var = force_bytes(var)
+            parts.append(b'%d:%s' % (len(var), var))
+        data = b''.join(parts)
+
+        if self.options.key_hash == 'blake2b':
+            return hashlib.blake2b(data, digest_size=16).hexdigest()
+        if self.options.key_hash == 'xxhash':
+            if xxhash is None:
+                raise ImportError('The "xxhash" package is needed for the "xxhash" key hash')
+            return xxhash.xxh3_128_hexdigest(data)
+        raise ValueError('Unknown key hash: %r' % self.options.key_hash)
+
+    @classmethod
+    def get_key_hash_memo(cls):
         """
-        return hashlib.md5(force_bytes(':'.join([urlquote(force_bytes(var)) for var in self.vary_on]))).hexdigest()
+        Return the `LRUCache` object holding the hashes of the arguments
+        for the current class, or `None` if this feature is deactivated, or
+        if the key hash is not "md5": computing the other ones costs as much
+        as looking for them in memory.
+        """
+        if not cls.options.key_hash_memo_max_entries or cls.options.key_hash != 'md5':
+            return None
+        if cls not in CacheTag._key_hash_memos:
+            CacheTag._key_hash_memos.setdefault(cls, LRUCache(
+                cls.options.key_hash_memo_max_entries,
+            ))
+        return CacheTag._key_hash_memos[cls]
 
     def get_pk(self):
         """
         Return the pk to use in the cache key. It's the first version of the
         templatetag arguments after the fragment name
         """
+        if self.options.key_adapters:
+            return get_key_value(self.vary_on[0])
         return self.vary_on[0]
 
     def get_base_cache_key(self):
@@ -353,19 +1171,324 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         every object with a `get` and a `set` method (or not, if `cache_get`
         and `cache_set` methods are overridden)
         """
-        return get_cache(self.node.cache_backend or self.options.cache_backend)
+        return get_cache(self.get_cache_backend_name())
+
+    def get_cache_backend_name(self):
+        """
+        Return the name of the cache backend to use: the one passed to the
+        templatetag with `using=`, or the `cache_backend` option
+        """
+        return self.node.cache_backend or self.options.cache_backend
+
+    @classmethod
+    def get_backend_circuit_breaker(cls, cache_backend):
+        """
+        Return the circuit breaker of the given cache backend, or `None` if
+        the `circuit_breaker_threshold` option is not set
+        """
+        if not cls.options.circuit_breaker_threshold:
+            return None
+        return get_circuit_breaker(cache_backend,
+                                   cls.options.circuit_breaker_threshold,
+                                   cls.options.circuit_breaker_window,
+                                   cls.options.circuit_breaker_cooldown)
+
+    def get_circuit_breaker(self):
+        """
+        Return the circuit breaker of the cache backend, or `None` if the
+        `circuit_breaker_threshold` option is not set
+        """
+        return self.get_backend_circuit_breaker(self.get_cache_backend_name())
+
+    def call_cache(self, func, *args, default=None):
+        """
+        Call the given function using the cache backend, through its circuit
+        breaker if any: if the circuit is open, the function is not called
+        and `default` is returned.
+        """
+        return self.call_with_circuit_breaker(self.get_circuit_breaker(), func, *args,
+                                              default=default)
+
+    @staticmethod
+    def call_with_circuit_breaker(breaker, func, *args, default=None):
+        """
+        Call the given function through the given circuit breaker (if not
+        `None`), see `call_cache`
+        """
+        if breaker is None:
+            return func(*args)
+        if not breaker.allow():
+            return default
+        try:
+            result = func(*args)
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            # not a failure of the backend, but another call must be able to probe it
+            breaker.release()
+            raise
+        breaker.success()
+        return result
+
+    async def acall_cache(self, func, *args, default=None):
+        """
+        Async version of `call_cache`, for a coroutine function
+        """
+        breaker = self.get_circuit_breaker()
+        if breaker is None:
+            return await func(*args)
+        if not breaker.allow():
+            return default
+        try:
+            result = await func(*args)
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            # not a failure of the backend, but another call must be able to probe it
+            breaker.release()
+            raise
+        breaker.success()
+        return result
 
     def cache_get(self):
         """
-        Get content from the cache
+        Get content from the cache (joining its chunks if it was split)
+        """
+        return self.join_chunks(self.call_cache(self.cache.get, self.cache_key))
+
+    def cache_get_many(self, keys):
+        """
+        Get many contents from the cache, used by the prefetch templatetag
+        """
+        return self.call_cache(self.cache.get_many, keys, default={})
+
+    def get_prefetched_content(self):
+        """
+        Return a tuple with a boolean telling if the content was fetched by a
+        prefetch templatetag, and this content (`None` if not in the cache).
+        A prefetched content is only used once, so a fragment regenerated in
+        the same template is fetched again when needed.
         """
-        return self.cache.get(self.cache_key)
+        prefetched = self.context.get(self.PREFETCH_CONTEXT_NAME)
+        if prefetched:
+            contents = prefetched.get(self.cache)
+            if contents and self.cache_key in contents:
+                return True, contents.pop(self.cache_key)
+        return False, None
 
     def cache_set(self, to_cache):
         """
-        Set content into the cache
+        Set content into the cache, or in the buffer of the current request
+        if the `write_behind` option is set
         """
-        self.cache.set(self.cache_key, to_cache, self.expire_time)
+        data = self.get_data_to_cache(to_cache)
+        if len(data) > 1:
+            # a content split in chunks is not buffered, to save all its chunks at once
+            self.call_cache(self.cache.set_many, data, self.get_cache_timeout())
+            return
+
+        if self.buffer_content(to_cache):
+            return
+
+        self.call_cache(self.cache.set, self.cache_key, to_cache, self.get_cache_timeout())
+
+    def buffer_content(self, to_cache):
+        """
+        If the `write_behind` option is set, add the content in the buffer of
+        the current request, if any (or in any forced buffer). Return `True`
+        if the content must not be set into the cache now (buffered, or
+        dropped because the buffer is full). Never buffered when created
+        while holding the lock.
+        """
+        buffer = current_write_behind_buffer.get()
+        if buffer is None or not (self.options.write_behind or buffer.forced):
+            return False
+        # the processes waiting for the lock need the content in the cache before it's released
+        if self.holding_lock:
+            return False
+        # the buffer saves the contents in the cache backend by name, so not for a cache
+        # object returned by an overridden `get_cache_object`
+        if self.cache is not get_cache(self.get_cache_backend_name()):
+            return False
+        if buffer.add(self.get_cache_backend_name(), self.cache_key, to_cache,
+                      self.get_cache_timeout()):
+            return True
+        return self.options.write_behind_overflow == 'drop'
+
+    async def acache_get(self):
+        """
+        Async version of `cache_get`, using the async cache API (django >= 4.0)
+        or running the sync one in a thread
+        """
+        check_async_support()
+        if hasattr(self.cache, 'aget'):
+            content = await self.acall_cache(self.cache.aget, self.cache_key)
+        else:
+            content = await self.acall_cache(sync_to_async(self.cache.get), self.cache_key)
+        return await self.ajoin_chunks(content)
+
+    async def acache_get_many(self, keys):
+        """
+        Async version of `cache_get_many`
+        """
+        check_async_support()
+        if hasattr(self.cache, 'aget_many'):
+            return await self.acall_cache(self.cache.aget_many, keys, default={})
+        return await self.acall_cache(sync_to_async(self.cache.get_many), keys, default={})
+
+    async def acache_set(self, to_cache):
+        """
+        Async version of `cache_set`
+        """
+        check_async_support()
+        data = self.get_data_to_cache(to_cache)
+        if len(data) > 1:
+            if hasattr(self.cache, 'aset_many'):
+                await self.acall_cache(self.cache.aset_many, data, self.get_cache_timeout())
+            else:
+                await self.acall_cache(sync_to_async(self.cache.set_many), data,
+                                       self.get_cache_timeout())
+            return
+
+        if self.buffer_content(to_cache):
+            return
+
+        if hasattr(self.cache, 'aset'):
+            await self.acall_cache(self.cache.aset, self.cache_key, to_cache,
+                                   self.get_cache_timeout())
+        else:
+            await self.acall_cache(sync_to_async(self.cache.set), self.cache_key, to_cache,
+                                   self.get_cache_timeout())
+
+    def get_chunk_size(self):
+        """
+        Return the max size of the data saved in one cache entry for the
+        cache backend, from the `chunk_size` option (`0` for no limit)
+        """
+        chunk_size = self.options.chunk_size
+        if isinstance(chunk_size, dict):
+            return chunk_size.get(self.get_cache_backend_name(), 0)
+        return chunk_size
+
+    @staticmethod
+    def get_chunk_key(cache_key, index):
+        # always the same keys for a fragment, so the chunks of a previous save are overwritten
+        return '%s.chunk.%d' % (cache_key, index)
+
+    def get_data_to_cache(self, to_cache):
+        """
+        Return a dict with the cache keys and the data to save: only the
+        content for the cache key, or, if it's bigger than the chunk size,
+        the chunks of the content, and, for the cache key, a manifest with
+        the number of chunks, a checksum (to not mix chunks of different
+        saves) and the size of the content
+        """
+        chunk_size = self.get_chunk_size()
+        if not chunk_size or len(to_cache) <= chunk_size:
+            return {self.cache_key: to_cache}
+
+        to_cache = force_bytes(to_cache)
+        count = (len(to_cache) + chunk_size - 1) // chunk_size
+        data = {
+            self.get_chunk_key(self.cache_key, index):
+                to_cache[index * chunk_size:(index + 1) * chunk_size]
+            for index in range(count)
+        }
+        data[self.cache_key] = self.VERSION_SEPARATOR.join([
+            self.CHUNKS_MARKER,
+            force_bytes('%d:%08x:%d' % (count, zlib.crc32(to_cache), len(to_cache))),
+        ])
+        return data
+
+    def parse_chunks_manifest(self, content, cache_key):
+        """
+        Return a tuple with the keys of the chunks, the checksum and the size
+        of the content described by the given manifest, or `None` if the
+        content is not a manifest (or an invalid one)
+        """
+        if not isinstance(content, bytes) or not content.startswith(self.CHUNKS_MARKER):
+            return None
+        try:
+            count, checksum, size = smart_str(
+                content.split(self.VERSION_SEPARATOR, 1)[1]).split(':')
+            return ([self.get_chunk_key(cache_key, index) for index in range(int(count))],
+                    int(checksum, 16), int(size))
+        except (IndexError, ValueError):
+            return None
+
+    def assemble_chunks(self, manifest, chunks):
+        """
+        Return the content made of the given chunks, or `None` if one is
+        missing, or if the content doesn't match the manifest
+        """
+        keys, checksum, size = manifest
+        try:
+            content = b''.join(chunks[key] for key in keys)
+        except (KeyError, TypeError):
+            content = None
+        if content is None or len(content) != size or zlib.crc32(content) != checksum:
+            self.record_metric('error', 'chunks')
+            return None
+        return content
+
+    def join_chunks(self, content, cache_key=None):
+        """
+        If the given content got from the cache (for `cache_key`, default to
+        the one of the fragment) is a manifest, return the content made of
+        its chunks, fetched with one `get_many` call (`None` if a chunk is
+        missing or not matching). Else return the content as is.
+        """
+        if not isinstance(content, bytes) or not content.startswith(self.CHUNKS_MARKER):
+            return content
+        manifest = self.parse_chunks_manifest(content, cache_key or self.cache_key)
+        if manifest is None:
+            return None
+        return self.assemble_chunks(
+            manifest, self.call_cache(self.cache.get_many, manifest[0], default={}))
+
+    async def ajoin_chunks(self, content, cache_key=None):
+        """
+        Async version of `join_chunks`
+        """
+        if not isinstance(content, bytes) or not content.startswith(self.CHUNKS_MARKER):
+            return content
+        manifest = self.parse_chunks_manifest(content, cache_key or self.cache_key)
+        if manifest is None:
+            return None
+        return self.assemble_chunks(manifest, await self.acache_get_many(manifest[0]))
+
+    def get_cache_timeout(self):
+        """
+        Return the time the content will be kept in the cache: the expire time,
+        plus the `stale_ttl` or `fallback_ttl` options if set (the longest
+        one, the expire time being saved in the metadata of the content)
+        """
+        if (self.options.stale_ttl or self.options.fallback_ttl) and self.expire_time:
+            return self.expire_time + max(self.options.stale_ttl, self.options.fallback_ttl)
+        return self.expire_time
+
+    def get_lock_key(self):
+        """
+        Return the key used to lock the regeneration of the content
+        """
+        return '%s.lock' % self.cache_key
+
+    def cache_lock(self):
+        """
+        Try to take the lock to regenerate the content, using the atomic `add`
+        of the cache backend. Return `True` if the lock was taken (or if the
+        cache backend is not used, see `call_cache`).
+        """
+        return self.call_cache(self.cache.add, self.get_lock_key(), 1, self.options.lock_timeout,
+                               default=True)
+
+    def cache_unlock(self):
+        """
+        Release the lock taken to regenerate the content
+        """
+        self.call_cache(self.cache.delete, self.get_lock_key())
 
     def join_content_version(self, to_cache):
         """
@@ -374,10 +1497,17 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         Each version, and the content, are separated with `VERSION_SEPARATOR`.
         This method is called after the encoding (if "compress" or
         "compress_spaces" options are on)
+        If there is some metadata, it is added between the version(s) and
+        the content, and the internal version is "METADATA_INTERNAL_VERSION".
         """
-        parts = [self.INTERNAL_VERSION]
+        if self.content_metadata:
+            parts = [self.METADATA_INTERNAL_VERSION]
+        else:
+            parts = [self.INTERNAL_VERSION]
         if self.options.versioning:
             parts.append(force_bytes(self.version))
+        if self.content_metadata:
+            parts.append(self.encode_metadata())
         parts.append(force_bytes(to_cache))
 
         return self.VERSION_SEPARATOR.join(parts)
@@ -390,7 +1520,9 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         The content saved is the encoded one (if "compress" or
         "compress_spaces" options are on). By doing so, we avoid decoding if
         the versions didn't match, to save some cpu cycles.
+        The metadata, if any, is extracted from the content.
         """
+        self.content_metadata = {}
         try:
             nb_parts = 2
             if self.options.versioning:
@@ -404,21 +1536,89 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
                 self.content_version = parts[1]
 
             self.content = parts[-1]
+
+            if self.content.startswith(self.METADATA_MARKER):
+                metadata, self.content = self.content.split(self.VERSION_SEPARATOR, 1)
+                self.decode_metadata(metadata)
         except Exception:
             self.content = None
 
+    def encode_metadata(self):
+        """
+        Return the metadata to be saved with the content, starting with
+        `METADATA_MARKER` and with `key=value` entries separated by
+        `METADATA_SEPARATOR`.
+        Used keys are:
+            * f : the format of the content ("s" for segments)
+            * h : "1" if the segmented content has nocache parts, else "0"
+            * e : the timestamp after which the content is stale
+            * c : the timestamp of the creation of the content
+            * d : the time taken to render the content, in seconds
+            * z : the id of the codec used to encode the content
+        """
+        return self.METADATA_MARKER + self.METADATA_SEPARATOR.join(
+            force_bytes('%s=%s' % (key, value))
+            for key, value in sorted(self.content_metadata.items())
+        )
+
+    def decode_metadata(self, metadata):
+        """
+        Save in `content_metadata` the metadata extracted from the cached content
+        """
+        self.content_metadata = dict(
+            smart_str(entry).split('=', 1)
+            for entry in metadata[len(self.METADATA_MARKER):].split(self.METADATA_SEPARATOR)
+        )
+
     def decode_content(self):
         """
         Decode (decompress...) the content got from the cache, to the final
-        html
+        html, using the codec saved in the metadata, or the pickle+zlib one
+        if none (when only the `compress` option is on)
+        """
+        self.content = get_codec(self.content_metadata.get('z', 'pz')).decode(self.content)
+
+    def get_encoding_codec(self):
         """
-        self.content = pickle.loads(zlib.decompress(self.content))
+        Return the codec defined by the `codec` option, or the pickle+zlib one
+        if not defined. If this codec is not available (unknown id, package
+        not installed), the pickle+zlib one is used, with a warning logged
+        only once.
+        """
+        codec_id = self.options.codec or 'pz'
+        try:
+            return get_codec(codec_id)
+        except KeyError:
+            if codec_id not in CacheTag._unavailable_codecs:
+                CacheTag._unavailable_codecs.add(codec_id)
+                logger.warning('The codec "%s" is not available, using "pz" instead', codec_id)
+            return get_codec('pz')
 
     def encode_content(self):
         """
-        Encode (compress...) the html to the data to be cached
+        Encode (compress...) the html to the data to be cached, using the
+        codec defined by the `codec` option (saved in the metadata), or the
+        pickle+zlib one if not defined.
+        If the content is too small, or not compressed enough, according to
+        the `compress_min_size` and `compress_min_ratio` options, it's
+        encoded with the `raw` codec instead.
         """
-        return zlib.compress(pickle.dumps(self.content), self.options.compress_level)
+        codec = self.get_encoding_codec()
+
+        if not (self.options.compress_min_size or self.options.compress_min_ratio):
+            if self.options.codec:
+                self.content_metadata['z'] = codec.id
+            return codec.encode(self.content, self.options.compress_level)
+
+        raw = get_codec('raw').encode(self.content, self.options.compress_level)
+        if codec.id != 'raw' and len(raw) >= self.options.compress_min_size:
+            encoded = codec.encode(self.content, self.options.compress_level)
+            if len(raw) >= len(encoded) * self.options.compress_min_ratio:
+                self.content_metadata['z'] = codec.id
+                return encoded
+
+        self.content_metadata['z'] = 'raw'
+        return raw
 
     def render_node(self):
         """
@@ -430,24 +1630,158 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         """
         Render the template, apply options on it, and save it to the cache.
         """
+        start = time.time()
         self.render_node()
+        duration = time.time() - start
+        self.record_metric('render_seconds', duration)
+
+        to_cache = self.prepare_content(duration)
+
+        if not self.write_to_cache:
+            return
+
+        try:
+            self.cache_set(to_cache)
+        except Exception:
+            if is_template_debug_activated():
+                raise
+            logger.exception('Error when saving the cached template fragment')
+            self.record_metric('error', 'set')
+        else:
+            self.save_local_content()
 
+    def prepare_content(self, duration=0):
+        """
+        Apply options on the rendered content and return the data to save
+        in the cache (or `None` if it will not be saved). `duration` is the
+        time taken to render the content.
+        """
         if self.options.compress_spaces:
             self.content = self.RE_SPACELESS.sub(' ', self.content)
 
-        if self.options.compress:
+        self.content_metadata = {}
+        if (self.options.stale_ttl or self.options.early_expiry_beta
+                or self.options.fallback_ttl) and self.expire_time:
+            now = time.time()
+            self.content_metadata['e'] = '%.3f' % (now + self.expire_time)
+            if self.options.early_expiry_beta:
+                self.content_metadata['c'] = '%.3f' % now
+                self.content_metadata['d'] = '%.4f' % duration
+        self.segments = None
+        if self.options.segmented:
+            self.segments = self.split_segments(self.content)
+            self.content = self.encode_segments(self.segments)
+
+        if not self.write_to_cache:
+            return None
+
+        if self.options.metrics:
+            self.record_metric('size_bytes', len(force_bytes(self.content)))
+
+        if self.options.compress or self.options.codec:
+            start = time.time()
             to_cache = self.encode_content()
+            self.record_metric('encode_seconds', time.time() - start)
         else:
             to_cache = self.content
 
         to_cache = self.join_content_version(to_cache)
 
+        if self.options.metrics:
+            self.record_metric('stored_bytes', len(to_cache))
+
+        return to_cache
+
+    def read_content(self):
+        """
+        Get the versions from the content got from the cache and decode it.
+        Return `False` (with the content set to `None`) if it cannot be used,
+        with the reason in `read_failure`: no content ("miss"), versions not
+        matching ("version_mismatch"), or decoding failure ("decode_error").
+        """
+        self.read_failure = 'miss'
         try:
-            self.cache_set(to_cache)
+
+            assert self.content
+
+            self.read_failure = 'decode_error'
+
+            self.split_content_version()
+
+            assert self.content
+
+            if self.content_metadata:
+                internal_version = self.METADATA_INTERNAL_VERSION
+            else:
+                internal_version = self.INTERNAL_VERSION
+
+            if self.content_internal_version != internal_version or (
+                    self.options.versioning and self.content_version != self.version):
+                self.read_failure = 'version_mismatch'
+                self.content = None
+
+            assert self.content
+
+            if self.options.compress or 'z' in self.content_metadata:
+                start = time.time()
+                self.decode_content()
+                self.record_metric('decode_seconds', time.time() - start)
+
+        except Exception:
+            self.content = None
+            return False
+
+        self.read_failure = None
+        return True
+
+    def create_content_with_lock(self):
+        """
+        Create the content only if the lock can be taken. If not, another
+        process is already creating it, so we wait for it to be in the cache,
+        at most `lock_wait` seconds. If still not available, depending on the
+        `lock_fallback` option, render it, saving it in the cache or not.
+        """
+        try:
+            locked = self.cache_lock()
         except Exception:
             if is_template_debug_activated():
                 raise
-            logger.exception('Error when saving the cached template fragment')
+            logger.exception('Error when locking the cached template fragment')
+            self.record_metric('error', 'lock')
+            locked = True
+
+        if locked:
+            self.holding_lock = True
+            try:
+                self.create_content()
+            finally:
+                self.holding_lock = False
+                try:
+                    self.cache_unlock()
+                except Exception:
+                    if is_template_debug_activated():
+                        raise
+                    logger.exception('Error when unlocking the cached template fragment')
+                    self.record_metric('error', 'lock')
+            return
+
+        deadline = time.time() + self.options.lock_wait
+        while time.time() < deadline:
+            time.sleep(self.options.lock_poll_interval)
+            try:
+                self.content = self.cache_get()
+            except Exception:
+                if is_template_debug_activated():
+                    raise
+                logger.exception('Error when getting the cached template fragment')
+                self.record_metric('error', 'get')
+                break
+            if self.read_content():
+                return
+
+        if self.options.lock_fallback != 'save':
+            self.write_to_cache = False
+        self.create_content()
 
     def load_content(self):
         """
@@ -456,41 +1790,388 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         content.
         If something was wrong during this process (or if we had a
         `__regenerate__` value to True in the context), create new content and
-        save it in cache.
+        save it in cache (only by one process at a time if the `lock` option
+        is on).
         """
 
         self.content = None
 
+        if not self.regenerate and self.load_local_content():
+            self.record_metric('lookup', 'local_hit')
+            return
+
         if not self.regenerate:
             try:
-                self.content = self.cache_get()
+                prefetched, self.content = self.get_prefetched_content()
+                if not prefetched:
+                    self.content = self.cache_get()
             except Exception:
                 if is_template_debug_activated():
                     raise
                 logger.exception('Error when getting the cached template fragment')
+                self.record_metric('error', 'get')
+
+        self.use_content(self.get_content_state())
+
+    def get_content_state(self):
+        """
+        Read the content got from the cache and return its state: "miss" if
+        it cannot be used, "expired" if it must be regenerated (stale or
+        expiring early), or "hit"
+        """
+        if not self.read_content():
+            self.record_metric('lookup', 'regenerate' if self.regenerate else self.read_failure)
+            return 'miss'
+        if self.is_stale() or self.is_expiring_early():
+            self.record_metric('lookup', 'expired')
+            return 'expired'
+        self.record_metric('lookup', 'hit')
+        return 'hit'
+
+    def use_content(self, state):
+        """
+        Depending on the state of the content got from the cache (see
+        `get_content_state`), create it (only by one process at a time if the
+        `lock` option is on), regenerate it (in the background if the
+        `stale_ttl` option is set, keeping the expired content if it fails and
+        the `fallback_ttl` option is set), or use it.
+        """
+        if state == 'miss':
+            if self.options.lock and not self.regenerate:
+                self.create_content_with_lock()
+            else:
+                self.create_content()
+        elif state == 'expired':
+            if self.options.fallback_ttl and self.is_fallback_retry_delayed():
+                self.record_metric('lookup', 'fallback')
+            elif self.options.stale_ttl and self.is_in_stale_window():
+                self.schedule_regeneration()
+            elif self.options.fallback_ttl:
+                self.create_content_with_fallback()
+            else:
+                self.create_content()
+        else:
+            self.content = smart_str(self.content)
+            self.save_local_content()
+
+        self.content = smart_str(self.content)
+
+    async def aload_content(self):
+        """
+        Async version of `load_content`, getting the content with the async
+        cache API. If the content must be created, it's done in a thread, as
+        rendering the template may access the database.
+        """
+        check_async_support()
+        self.content = None
+
+        if not self.regenerate and self.load_local_content():
+            self.record_metric('lookup', 'local_hit')
+            return
+
+        if not self.regenerate:
+            try:
+                prefetched, self.content = self.get_prefetched_content()
+                if not prefetched:
+                    self.content = await self.acache_get()
+            except Exception:
+                if is_template_debug_activated():
+                    raise
+                logger.exception('Error when getting the cached template fragment')
+                self.record_metric('error', 'get')
+
+        state = self.get_content_state()
+        if state == 'hit':
+            self.use_content(state)
+        else:
+            await sync_to_async(self.use_content)(state)
+
+    def record_metric(self, event, value):
+        """
+        Send the event to the trace of the rendering, if any, and to the
+        metrics collector if the `metrics` option is set. See
+        `metrics.COUNTER_EVENTS` and `metrics.HISTOGRAM_BUCKETS` for the
+        events and their values.
+        """
+        if self.trace is not None:
+            self.trace.record(event, value)
+        if self.options.metrics:
+            metrics_collector.record(self.__class__, self.fragment_name, event, value)
+
+    @classmethod
+    def get_local_cache(cls):
+        """
+        Return the `LRUCache` object holding the decoded contents kept in
+        memory for the current class, or `None` if this feature is
+        deactivated.
+        """
+        if not cls.options.local_cache_max_entries:
+            return None
+        if cls not in CacheTag._local_caches:
+            CacheTag._local_caches.setdefault(cls, LRUCache(
+                cls.options.local_cache_max_entries,
+                cls.options.local_cache_max_bytes,
+            ))
+        return CacheTag._local_caches[cls]
+
+    @classmethod
+    def invalidate_local_cache(cls, cache_key=None, cache_backend=None):
+        """
+        Remove from the memory of the process the content of the fragment with
+        the given cache key (in the given cache backend, or the one defined
+        by the `cache_backend` option), or all the contents if no cache key is
+        given.
+        """
+        local_cache = CacheTag._local_caches.get(cls)
+        if local_cache is None:
+            return
+        if cache_key is None:
+            local_cache.clear()
+        else:
+            local_cache.delete((cache_backend or cls.options.cache_backend, cache_key))
+
+    def get_request_memo(self):
+        """
+        Return the dict holding the decoded contents loaded during the current
+        request, or `None` if this feature is deactivated or if not in a
+        request going through `middleware.RequestMemoMiddleware`.
+        """
+        if not self.options.request_memo:
+            return None
+        return current_request_memo.get()
+
+    def load_local_content(self):
+        """
+        Load the decoded content from the contents loaded during the current
+        request, or from the memory of the process, if present and if the
+        versions match. Return `True` if it was loaded.
+        """
+        key = (self.get_cache_backend_name(), self.cache_key)
+
+        entry = None
+        request_memo = self.get_request_memo()
+        if request_memo is not None:
+            entry = request_memo.get((self.__class__, ) + key)
+
+        if entry is None:
+            local_cache = self.get_local_cache()
+            if local_cache is None:
+                return False
+            entry = local_cache.get(key)
+            if entry is None:
+                return False
+            if request_memo is not None:
+                request_memo[(self.__class__, ) + key] = entry
+
+        internal_version, version, content, metadata, segments = entry
+        if internal_version != self.INTERNAL_VERSION or (
+                self.options.versioning and version != self.version):
+            return False
+
+        self.content, self.content_metadata, self.segments = content, metadata, segments
+        return True
+
+    def save_local_content(self):
+        """
+        Keep the decoded content (and its segments, if segmented) during the
+        current request, and in the memory of the process, at most for
+        `local_cache_ttl` seconds, and never after the expire time of the
+        fragment.
+        """
+        request_memo = self.get_request_memo()
+        local_cache = self.get_local_cache()
+        if request_memo is None and local_cache is None:
+            return
+
+        key = (self.get_cache_backend_name(), self.cache_key)
+        entry = (self.INTERNAL_VERSION, self.version, self.content, self.content_metadata,
+                 self.get_segments() if self.is_segmented() else None)
 
+        if request_memo is not None:
+            request_memo[(self.__class__, ) + key] = entry
+
+        if local_cache is None:
+            return
+
+        timeout = self.options.local_cache_ttl
+        if self.expire_time:
+            timeout = min(timeout, self.expire_time)
+        if 'e' in self.content_metadata:
+            timeout = min(timeout, float(self.content_metadata['e']) - time.time())
+        if timeout <= 0:
+            return
+
+        local_cache.set(key, entry, len(force_bytes(self.content)), timeout)
+
+    def is_stale(self):
+        """
+        Return `True` if the content got from the cache is after its expire
+        time, saved in its metadata
+        """
+        expiry = self.content_metadata.get('e')
+        return expiry is not None and float(expiry) < time.time()
+
+    def is_expiring_early(self):
+        """
+        Return `True` if the content got from the cache must be regenerated
+        before its expire time, using the "XFetch" algorithm: the probability
+        grows as the expire time approaches, weighted by the time taken to
+        render the content and the `early_expiry_beta` option. This way, an
+        expensive fragment is regenerated by only one request before it
+        expires, without any lock.
+        """
+        if not self.options.early_expiry_beta:
+            return False
         try:
+            expiry = float(self.content_metadata['e'])
+            duration = float(self.content_metadata['d'])
+        except (KeyError, ValueError):
+            return False
+        return time.time() - duration * self.options.early_expiry_beta * math.log(
+            1.0 - random.random()) >= expiry
+
+    def is_in_stale_window(self):
+        """
+        Return `True` if the expired content can be returned while it is
+        regenerated in the background: less than `stale_ttl` seconds after
+        its expire time (the content can be kept longer in the cache with
+        the `fallback_ttl` option)
+        """
+        expiry = self.content_metadata.get('e')
+        return expiry is None or float(expiry) + self.options.stale_ttl > time.time()
 
-            assert self.content
+    def get_fallback_retry_key(self):
+        return self.get_cache_backend_name(), self.cache_key
 
-            self.split_content_version()
+    def is_fallback_retry_delayed(self):
+        """
+        Return `True` if the regeneration of the content failed recently, so
+        the expired content must be used without trying again
+        """
+        retry = CacheTag._fallback_retries.get(self.get_fallback_retry_key())
+        return retry is not None and retry[1] > time.time()
 
-            assert self.content
+    def delay_fallback_retry(self):
+        """
+        Save the failure of the regeneration of the content, to not try
+        again before a delay, doubled after each failure
+        """
+        key = self.get_fallback_retry_key()
+        retry = CacheTag._fallback_retries.get(key)
+        failures = retry[0] + 1 if retry else 1
+        delay = min(self.options.fallback_retry_delay * 2 ** (failures - 1),
+                    self.options.fallback_retry_max_delay)
+        # keep the number of failures after the delay, to compute the next one
+        CacheTag._fallback_retries.set(key, (failures, time.time() + delay),
+                                       timeout=delay + self.options.fallback_retry_max_delay)
+
+    def create_content_with_fallback(self):
+        """
+        Create the content, and if it fails, use the expired one got from
+        the cache (and not try again before a delay)
+        """
+        content, metadata, segments = self.content, self.content_metadata, self.segments
+        try:
+            self.create_content()
+        except template.TemplateSyntaxError:
+            raise
+        except Exception:
+            if is_template_debug_activated():
+                raise
+            logger.exception('Error when rendering template fragment, using the expired one')
+            self.record_metric('error', 'render')
+            self.record_metric('lookup', 'fallback')
+            self.content, self.content_metadata, self.segments = content, metadata, segments
+            self.delay_fallback_retry()
+        else:
+            CacheTag._fallback_retries.delete(self.get_fallback_retry_key())
 
-            if self.content_internal_version != self.INTERNAL_VERSION or (
-                    self.options.versioning and self.content_version != self.version):
-                self.content = None
+    @classmethod
+    def get_regeneration_executor(cls):
+        """
+        Return the executor, shared by all the classes of the process, used to
+        regenerate stale content in background threads. Its number of threads
+        is defined by the `ADV_CACHE_REGENERATION_WORKERS` setting.
+        """
+        with CacheTag._regeneration_lock:
+            if CacheTag._regeneration_executor is None:
+                CacheTag._regeneration_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ADV_CACHE_REGENERATION_WORKERS', 2)
+                )
+            return CacheTag._regeneration_executor
 
-            assert self.content
+    def get_regeneration_context(self):
+        """
+        Return a copy of the context, safe to be used to create the content
+        in another thread (without `__regenerate__`, to not force the
+        regeneration of the nested fragments)
+        """
+        values = self.context.flatten()
+        values.pop(self.PREFETCH_CONTEXT_NAME, None)
+        values.pop('__regenerate__', None)
+        context = template.Context(
+            values,
+            autoescape=self.context.autoescape,
+            use_l10n=self.context.use_l10n,
+            use_tz=self.context.use_tz,
+        )
+        context.template = getattr(self.context, 'template', None)
+        return context
 
-            if self.options.compress:
-                self.decode_content()
+    def schedule_regeneration(self):
+        """
+        Queue the regeneration of the content in a background thread, except
+        if a regeneration of the same key is already queued, or if the queue,
+        limited by the `ADV_CACHE_REGENERATION_QUEUE_SIZE` setting, is full.
+        Return the future of the regeneration, or `None` if not queued.
+        """
+        executor = self.get_regeneration_executor()
+        key = (self.get_cache_backend_name(), self.cache_key)
+        if key in CacheTag._regenerations:
+            return None
 
+        # created without the lock, as it may use the cache backend (for `depends`)
+        try:
+            regenerator = self.__class__(self.node, self.get_regeneration_context())
         except Exception:
-            self.create_content()
+            logger.exception('Error when preparing the regeneration of the cached template '
+                             'fragment')
+            self.record_metric('error', 'regenerate')
+            return None
+        regenerator.regenerate = True
 
-        self.content = smart_str(self.content)
+        with CacheTag._regeneration_lock:
+            if key in CacheTag._regenerations or len(CacheTag._regenerations) >= getattr(
+                    settings, 'ADV_CACHE_REGENERATION_QUEUE_SIZE', 100):
+                return None
+            future = executor.submit(regenerator.regenerate_in_background)
+            CacheTag._regenerations[key] = future
 
+        def done(future):
+            with CacheTag._regeneration_lock:
+                CacheTag._regenerations.pop(key, None)
+
+        future.add_done_callback(done)
+        return future
+
+    def regenerate_in_background(self):
+        """
+        Create the content, in a background thread, and close the database
+        connections that may have been opened for it.
+        """
+        close_old_connections()
+        try:
+            self.create_content()
+        except Exception:
+            logger.exception('Error when regenerating the cached template fragment')
+            self.record_metric('error', 'regenerate')
+            if self.options.fallback_ttl:
+                self.delay_fallback_retry()
+        else:
+            if self.options.fallback_ttl:
+                CacheTag._fallback_retries.delete(self.get_fallback_retry_key())
+        finally:
+            close_old_connections()
 
     def render(self):
         """
@@ -501,6 +2182,23 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         {% nocache %} blocks, but only if we have have this tag and if we don't
         have `__partial__` to True in the context (in this case we simple
         return the html with the {% nocache %} block not parsed.
+        If the current request is traced (see `middleware.ServerTimingMiddleware`),
+        what happens is saved in the trace.
+        """
+        request_trace = current_request_trace.get()
+        if request_trace is None:
+            return self.render_content()
+
+        self.trace = request_trace.add(self.__class__, self.fragment_name, self.cache_key)
+        start = time.time()
+        try:
+            return self.render_content()
+        finally:
+            self.trace.record('total_seconds', time.time() - start)
+
+    def render_content(self):
+        """
+        Load the content and return the final html, see `render`
         """
         try:
             self.load_content()
@@ -510,12 +2208,91 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
             if is_template_debug_activated():
                 raise
             logger.exception('Error when rendering template fragment')
+            self.record_metric('error', 'render')
             return ''
 
-        if self.partial or self.RAW_TOKEN_START not in self.content:
+        if not self.is_segmented() and (
+                self.partial or self.RAW_TOKEN_START not in self.content):
             return self.content
 
-        return self.render_nocache()
+        start = time.time()
+        if self.is_segmented():
+            content = self.render_segments()
+        else:
+            content = self.render_nocache()
+        self.record_metric('nocache_seconds', time.time() - start)
+
+        return content
+
+    def split_segments(self, content):
+        """
+        Split the rendered html in a list of segments: static html at even
+        indexes, and source of the nocache parts (with the `{% load %}` of
+        needed libraries) at odd indexes.
+        """
+        parts = content.split(self.RAW_TOKEN_END)
+        segments = [parts[0]]
+        for part in parts[1:]:
+            segments.extend(part.split(self.RAW_TOKEN_START, 1))
+        return segments
+
+    def encode_segments(self, segments):
+        """
+        Return the content to cache for the given segments, and mark it as
+        segmented in the metadata. If there is no nocache parts, the content
+        is the html itself, else the json of the segments.
+        """
+        self.content_metadata['f'] = 's'
+        if len(segments) == 1:
+            self.content_metadata['h'] = '0'
+            return segments[0]
+        self.content_metadata['h'] = '1'
+        return json.dumps(segments)
+
+    def decode_segments(self):
+        """
+        Return the list of segments saved in the (decoded) content
+        """
+        if self.content_metadata.get('h') == '0':
+            return [self.content]
+        return json.loads(self.content)
+
+    def get_segments(self):
+        """
+        Return the list of segments of the content, decoded only once
+        """
+        if self.segments is None:
+            self.segments = self.decode_segments()
+        return self.segments
+
+    def is_segmented(self):
+        """
+        Return `True` if the content was saved as segments
+        """
+        return self.content_metadata.get('f') == 's'
+
+    def render_segments(self):
+        """
+        Return the final html from the segmented content: static html is used
+        as is and only the nocache parts are rendered.
+        If `__partial__` is set in the context, return the html with the
+        nocache parts not rendered, as for a not segmented content.
+        """
+        segments = self.get_segments()
+        if len(segments) == 1:
+            return segments[0]
+
+        if self.partial:
+            return ''.join(
+                segment if not index % 2 else self.RAW_TOKEN_END + segment + self.RAW_TOKEN_START
+                for index, segment in enumerate(segments)
+            )
+
+        return ''.join(
+            segment if not index % 2
+            else self.get_nocache_template(segment, segment=True).render(self.context)
+            for index, segment in enumerate(segments)
+        )
 
     @staticmethod
     def get_all_tags_and_filters_by_function():
@@ -572,22 +2349,213 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
             CacheTag._templatetags_modules[cls] = all_tags[CacheTag._templatetags[cls]['cache']][0]
         return CacheTag._templatetags_modules[cls]
 
-    def render_nocache(self):
+    @classmethod
+    def get_nocache_templates_cache(cls):
         """
-        Render the `nocache` blocks of the content and return the whole
-        html
+        Return the `LRUCache` object holding the compiled templates used to
+        render the nocache parts for the current class, or `None` if this
+        feature is deactivated.
         """
-        tmpl = template.Template(''.join([
+        if not cls.options.nocache_templates_max_entries:
+            return None
+        if cls not in CacheTag._nocache_templates:
+            CacheTag._nocache_templates.setdefault(cls, LRUCache(
+                cls.options.nocache_templates_max_entries,
+                cls.options.nocache_templates_max_bytes,
+            ))
+        return CacheTag._nocache_templates[cls]
+
+    def get_nocache_template_source(self, content, segment=False):
+        """
+        Return the source of the template to render to get the final html
+        from the given cached content, or from the given nocache part if
+        `segment` is True
+        """
+        if segment:
+            return ''.join([
+                # only load the cache library, the segment is the nocache part
+                template.BLOCK_TAG_START,
+                'load %s' % self.get_templatetag_module(),
+                template.BLOCK_TAG_END,
+                content,
+            ])
+
+        return ''.join([
             # start by loading the cache library
             template.BLOCK_TAG_START,
             'load %s' % self.get_templatetag_module(),
             template.BLOCK_TAG_END,
             # and surround the cached template by "raw" tags
             self.RAW_TOKEN_START,
-            self.content,
+            content,
             self.RAW_TOKEN_END,
-        ]))
-        return tmpl.render(self.context)
+        ])
+
+    def get_nocache_template(self, content, segment=False):
+        """
+        Return the compiled template to render to get the final html from the
+        given cached content (or nocache part if `segment` is True). As the
+        cached content only changes when regenerated, compiled templates are
+        kept in a LRU cache, using the templatetag module and a digest of the
+        content as key, to avoid parsing it again each time.
+        """
+        templates = self.get_nocache_templates_cache()
+        if templates is None:
+            return template.Template(self.get_nocache_template_source(content, segment))
+
+        key = (
+            self.get_templatetag_module(),
+            self.RAW_TOKEN,
+            segment,
+            hashlib.md5(force_bytes(content)).hexdigest(),
+        )
+        tmpl = templates.get(key)
+        if tmpl is None:
+            tmpl = template.Template(self.get_nocache_template_source(content, segment))
+            templates.set(key, tmpl, len(content))
+        return tmpl
+
+    def render_nocache(self):
+        """
+        Render the `nocache` blocks of the content and return the whole
+        html
+        """
+        return self.get_nocache_template(self.content).render(self.context)
+
+    @classmethod
+    async def aprefetch(cls, template_obj, context):
+        """
+        Fetch concurrently, with the async cache API, the cached contents of
+        all the cache templatetags (of all classes) of the given template (a
+        django template, or a template from the django template backend), to
+        be awaited by an async view or middleware before rendering it with
+        the given context (a dict or a `Context`), in which the fetched
+        contents (and the generations of the tags the fragments depend on)
+        are saved.
+        """
+        nodelist = getattr(template_obj, 'template', template_obj).nodelist
+        if isinstance(context, template.Context):
+            render_context = context
+        else:
+            render_context = template.Context(context)
+
+        generations = {}
+        with render_context.push(**{cls.TAGS_GENERATIONS_CONTEXT_NAME: generations}):
+            prefetched = await PrefetchNode(nodelist).aprefetch(render_context)
+        context[cls.PREFETCH_CONTEXT_NAME] = prefetched
+        context[cls.TAGS_GENERATIONS_CONTEXT_NAME] = generations
+        return prefetched
+
+    @classmethod
+    def get_fragment(cls, fragment_name, *vary_on, version=None, expire_time=DEFAULT_TIMEOUT,
+                     nodename='cache', using=None, depends=None):
+        """
+        Return an instance of the current class for the fragment defined by
+        the given arguments, as if it was rendered by the templatetag
+        `{% nodename expire_time fragment_name vary_on... [version] %}`, to
+        get its cache key, or set or delete its content, outside templates.
+        If `expire_time` is not given, the default timeout of the cache
+        backend is used (`None` to keep the content forever).
+        Only for classes using the default `get_template_node_arguments`.
+        """
+        context_dict = {
+            'adv_cache_expire_time': None if expire_time is DEFAULT_TIMEOUT else expire_time,
+        }
+        tokens = [nodename, 'adv_cache_expire_time', '"%s"' % fragment_name]
+        for index, value in enumerate(vary_on):
+            context_dict['adv_cache_arg_%d' % index] = value
+            tokens.append('adv_cache_arg_%d' % index)
+        if depends is not None:
+            context_dict['adv_cache_depends'] = depends
+            tokens.append('depends=adv_cache_depends')
+        if cls.options.versioning:
+            context_dict['adv_cache_version'] = version
+            tokens.append('adv_cache_version')
+        if using is not None:
+            tokens.append('using=%s' % using)
+
+        node = cls.Node(nodename, template.NodeList(), *cls.get_template_node_arguments(tokens))
+        fragment = cls(node, template.Context(context_dict))
+        if expire_time is DEFAULT_TIMEOUT:
+            fragment.expire_time = getattr(fragment.cache, 'default_timeout', None)
+        return fragment
+
+    @classmethod
+    def key_for(cls, fragment_name, *vary_on, **kwargs):
+        """
+        Return the cache key of the fragment defined by the given arguments
+        (see `get_fragment`)
+        """
+        return cls.get_fragment(fragment_name, *vary_on, **kwargs).cache_key
+
+    @classmethod
+    def delete_many(cls, fragments):
+        """
+        Delete the contents of the given fragments (results of `get_fragment`)
+        from the cache, with one `delete_many` call per cache backend (after
+        one `get_many` call to find their chunks if the `chunk_size` option is
+        set), and from the memory of the process.
+        """
+        fragments_by_backend = {}
+        for fragment in fragments:
+            backend = fragment.get_cache_backend_name()
+            fragments_by_backend.setdefault(backend, []).append(fragment)
+            fragment.invalidate_local_cache(fragment.cache_key, backend)
+
+        for backend_fragments in fragments_by_backend.values():
+            # all the fragments use the same cache backend, and circuit breaker
+            fragment = backend_fragments[0]
+            keys = [backend_fragment.cache_key for backend_fragment in backend_fragments]
+            if fragment.get_chunk_size():
+                for key, content in fragment.cache_get_many(keys).items():
+                    manifest = fragment.parse_chunks_manifest(content, key)
+                    if manifest is not None:
+                        keys.extend(manifest[0])
+            fragment.call_cache(fragment.cache.delete_many, keys)
+
+    def get_content_to_cache(self, html):
+        """
+        Return the data to save in the cache for the given html, as
+        rendered by the content of the templatetag
+        """
+        self.content = html
+        return self.prepare_content()
+
+    @classmethod
+    def set_rendered(cls, html, fragment_name, *vary_on, **kwargs):
+        """
+        Save in the cache, for the fragment defined by the given arguments (see
+        `get_fragment`), the given html, as rendered by the content of the
+        templatetag. Return the fragment.
+        """
+        fragment = cls.get_fragment(fragment_name, *vary_on, **kwargs)
+        cls.set_many([(fragment, html)])
+        return fragment
+
+    @classmethod
+    def set_many(cls, items):
+        """
+        Save in the cache the html of each given `(fragment, html)` pair (the
+        fragment being a result of `get_fragment`), with one `set_many` call
+        per cache backend and timeout (skipped if the circuit breaker of the
+        cache backend is open).
+        """
+        data_by_backend = {}
+        for fragment, html in items:
+            to_cache = fragment.get_content_to_cache(html)
+            if to_cache is None:
+                continue
+            backend = fragment.get_cache_backend_name()
+            timeout = fragment.get_cache_timeout()
+            data, fragments = data_by_backend.setdefault((backend, timeout), ({}, []))
+            data.update(fragment.get_data_to_cache(to_cache))
+            fragments.append(fragment)
+
+        for (backend, timeout), (data, fragments) in data_by_backend.items():
+            # all the fragments use the same cache backend, and circuit breaker
+            fragments[0].call_cache(fragments[0].cache.set_many, data, timeout)
+            for fragment in fragments:
+                fragment.save_local_content()
 
     @classmethod
     def get_template_node_arguments(cls, tokens):
@@ -603,6 +2571,28 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
                 "'%r' tag requires at least 2 arguments." % tokens[0])
         return tokens[1], tokens[2], tokens[3:]
 
+    @classmethod
+    def register_prefetch(cls, library_register, nodename='cache_prefetch'):
+        """
+        Register the prefetch templatetag, that will fetch in one call per
+        cache backend the contents of all the cache templatetags (of all
+        classes) it contains, with these parameters :
+            * library_register : the `register` object (result of
+                `template.Library()`) in your templatetag module
+            * nodename : the node to use for the prefetch templatetag (the
+                default is "cache_prefetch")
+        """
+
+        def templatetag_prefetch(parser, token):
+            """
+            Return a new PrefetchNode object for the prefetch templatetag
+            """
+            nodelist = parser.parse(('end%s' % nodename,))
+            parser.delete_first_token()
+            return PrefetchNode(nodelist)
+
+        library_register.tag(nodename, templatetag_prefetch)
+
     @classmethod
     def register(cls, library_register, nodename='cache', nocache_nodename='nocache'):
         """
@@ -625,8 +2615,10 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
             """
             nodelist = parser.parse(('end%s' % nodename,))
             parser.delete_first_token()
-            args = cls.get_template_node_arguments(token.contents.split())
-            return cls.Node(nodename, nodelist, *args)
+            args = cls.get_template_node_arguments(token.split_contents())
+            node = cls.Node(nodename, nodelist, *args)
+            node.compile_arguments(parser)
+            return node
 
         library_register.tag(nodename, templatetag_cache)
         CacheTag._templatetags[cls]['cache'] = templatetag_cache
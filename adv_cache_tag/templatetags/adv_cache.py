@@ -8,3 +8,6 @@ register = template.Library()
 
 # Register the default class with the "cache" and "nocache" block names
 CacheTag.register(register)
+
+# And the "cache_prefetch" block to fetch all the cached fragments it contains at once
+CacheTag.register_prefetch(register)
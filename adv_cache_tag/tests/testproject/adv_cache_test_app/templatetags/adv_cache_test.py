@@ -59,3 +59,39 @@ class InternalVersionTag(CacheTag):
 
 
 InternalVersionTag.register(register, 'cache_with_version')
+
+
+class LockCacheTag(CacheTag):
+    class Meta(CacheTag.Meta):
+        lock = True
+        lock_wait = 2
+        lock_poll_interval = 0.01
+
+
+LockCacheTag.register(register, 'cache_lock')
+
+
+class StaleCacheTag(CacheTag):
+    class Meta(CacheTag.Meta):
+        stale_ttl = 60
+
+
+StaleCacheTag.register(register, 'cache_stale')
+
+
+class EarlyExpiryCacheTag(CacheTag):
+    class Meta(CacheTag.Meta):
+        early_expiry_beta = 1.0
+
+
+EarlyExpiryCacheTag.register(register, 'cache_early')
+
+
+class LocalCacheTag(CacheTag):
+    class Meta(CacheTag.Meta):
+        local_cache_max_entries = 100
+        local_cache_ttl = 60
+        segmented = True
+
+
+LocalCacheTag.register(register, 'cache_local', 'nocache_local')
@@ -1,12 +1,24 @@
+import asyncio
 import hashlib
+import json
 import pickle
+import tempfile
+import threading
 import time
 import zlib
 
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from decimal import Decimal
+from unittest import mock
 
 from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory
 from django.utils.encoding import force_bytes
 from django.utils.safestring import SafeText
 
@@ -14,12 +26,27 @@ from django import VERSION as django_version
 from django.test.utils import override_settings
 from django.utils.http import urlquote
 
+from adv_cache_tag.breaker import CircuitBreaker, circuit_breakers, get_circuit_breakers_states
+from adv_cache_tag.codecs import Codec, codecs, register_codec
 from adv_cache_tag.compat import get_cache, template
+from adv_cache_tag.lru import LRUCache
+from adv_cache_tag.management.commands.adv_cache_warm import load_spec
+from adv_cache_tag.metrics import (MetricsCollector, export_circuit_breakers_prometheus,
+                                   prometheus_view)
+from adv_cache_tag.middleware import (RequestMemoMiddleware, ServerTimingMiddleware,
+                                      WriteBehindMiddleware)
 from adv_cache_tag.tag import CacheTag
+from adv_cache_tag.trace import RequestTrace
 
 from .compat import TestCase
 
 
+def warm_spec():
+    """Spec used to test the ``adv_cache_warm`` management command."""
+    for pk in range(5):
+        yield 'adv_cache_test/warm.html', {'pk': pk, 'name': 'foo %d' % pk}
+
+
 # Force some settings to not depend on the external ones
 @override_settings(
 
@@ -50,6 +77,22 @@ from .compat import TestCase
     ADV_CACHE_BACKEND = 'default',
     ADV_CACHE_VERSION = '',
     ADV_CACHE_RESOLVE_NAME = False,
+    ADV_CACHE_NOCACHE_TEMPLATES_MAX_ENTRIES = 1000,
+    ADV_CACHE_NOCACHE_TEMPLATES_MAX_BYTES = 10485760,
+    ADV_CACHE_SEGMENTED = False,
+    ADV_CACHE_CODEC = None,
+    ADV_CACHE_COMPRESS_MIN_SIZE = 0,
+    ADV_CACHE_COMPRESS_MIN_RATIO = 0,
+    ADV_CACHE_KEY_HASH = 'md5',
+    ADV_CACHE_KEY_HASH_MEMO_MAX_ENTRIES = 0,
+    ADV_CACHE_KEY_ADAPTERS = False,
+    ADV_CACHE_WRITE_BEHIND = False,
+    ADV_CACHE_WRITE_BEHIND_OVERFLOW = 'write',
+    ADV_CACHE_REQUEST_MEMO = False,
+    ADV_CACHE_METRICS = False,
+    ADV_CACHE_CIRCUIT_BREAKER_THRESHOLD = 0,
+    ADV_CACHE_FALLBACK_TTL = 0,
+    ADV_CACHE_CHUNK_SIZE = 0,
 
     # For django >= 1.8 (RemovedInDjango110Warning appears in 1.9)
     TEMPLATES = [
@@ -75,6 +118,27 @@ class BasicTestCase(TestCase):
         CacheTag.options.include_pk = getattr(settings, 'ADV_CACHE_INCLUDE_PK', False)
         CacheTag.options.cache_backend = getattr(settings, 'ADV_CACHE_BACKEND', 'default')
         CacheTag.options.resolve_fragment = getattr(settings, 'ADV_CACHE_RESOLVE_NAME', False)
+        CacheTag.options.nocache_templates_max_entries = getattr(
+            settings, 'ADV_CACHE_NOCACHE_TEMPLATES_MAX_ENTRIES', 1000)
+        CacheTag.options.nocache_templates_max_bytes = getattr(
+            settings, 'ADV_CACHE_NOCACHE_TEMPLATES_MAX_BYTES', 10485760)
+        CacheTag.options.segmented = getattr(settings, 'ADV_CACHE_SEGMENTED', False)
+        CacheTag.options.codec = getattr(settings, 'ADV_CACHE_CODEC', None)
+        CacheTag.options.compress_min_size = getattr(settings, 'ADV_CACHE_COMPRESS_MIN_SIZE', 0)
+        CacheTag.options.compress_min_ratio = getattr(settings, 'ADV_CACHE_COMPRESS_MIN_RATIO', 0)
+        CacheTag.options.key_hash = getattr(settings, 'ADV_CACHE_KEY_HASH', 'md5')
+        CacheTag.options.key_hash_memo_max_entries = getattr(
+            settings, 'ADV_CACHE_KEY_HASH_MEMO_MAX_ENTRIES', 0)
+        CacheTag.options.key_adapters = getattr(settings, 'ADV_CACHE_KEY_ADAPTERS', False)
+        CacheTag.options.write_behind = getattr(settings, 'ADV_CACHE_WRITE_BEHIND', False)
+        CacheTag.options.write_behind_overflow = getattr(
+            settings, 'ADV_CACHE_WRITE_BEHIND_OVERFLOW', 'write')
+        CacheTag.options.request_memo = getattr(settings, 'ADV_CACHE_REQUEST_MEMO', False)
+        CacheTag.options.metrics = getattr(settings, 'ADV_CACHE_METRICS', False)
+        CacheTag.options.circuit_breaker_threshold = getattr(
+            settings, 'ADV_CACHE_CIRCUIT_BREAKER_THRESHOLD', 0)
+        CacheTag.options.fallback_ttl = getattr(settings, 'ADV_CACHE_FALLBACK_TTL', 0)
+        CacheTag.options.chunk_size = getattr(settings, 'ADV_CACHE_CHUNK_SIZE', 0)
 
         # generate a token for this site, based on the secret_key
         CacheTag.RAW_TOKEN = 'RAW_' + hashlib.sha1(
@@ -100,6 +164,9 @@ class BasicTestCase(TestCase):
         # Reset CacheTag config with default value (from the ``override_settings``)
         self.reload_config()
 
+        # Forget the compiled templates of the nocache parts
+        CacheTag._nocache_templates.clear()
+
         # And an object to cache in template
         self.obj = {
             'pk': 42,
@@ -654,6 +721,1528 @@ class BasicTestCase(TestCase):
         self.assertEqual(self.get_name_called, 1)  # Still 1
         self.assertEqual(self.get_foo_called, 2)  # One more call to the non-cached part
 
+    def test_nocache_templates_cache(self):
+        """Test that the compiled templates of the nocache parts are reused."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+                {% nocache %}
+                    {{ obj.get_foo }}
+                {% endnocache %}
+            {% endcache %}
+        """
+
+        # Render a first time, should miss the cache and compile the template
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '1'])
+        templates = CacheTag._nocache_templates[CacheTag]
+        self.assertEqual(len(templates), 1)
+        compiled = list(templates._data.values())[0][0]
+
+        # Render a second time, should hit the cache and reuse the compiled template
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '2'])
+        self.assertEqual(len(templates), 1)
+        self.assertIs(list(templates._data.values())[0][0], compiled)
+        self.assertEqual(self.get_name_called, 1)
+
+        # Nothing is kept if the feature is deactivated
+        CacheTag._nocache_templates.clear()
+        CacheTag.options.nocache_templates_max_entries = 0
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '3'])
+        self.assertNotIn(CacheTag, CacheTag._nocache_templates)
+
+    @override_settings(
+        ADV_CACHE_COMPRESS_SPACES = True,
+        ADV_CACHE_SEGMENTED = True,
+    )
+    def test_segmented_content(self):
+        """Test with ``ADV_CACHE_SEGMENTED`` set to ``True``."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        expected = "foobar  foo 1  !!"
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+                {% nocache %}
+                    {{ obj.get_foo }}
+                {% endnocache %}
+                !!
+            {% endcache %}
+        """
+
+        # Render a first time, should miss the cache
+        self.assertStripEqual(self.render(t), expected)
+        self.assertEqual(self.get_name_called, 1)
+        self.assertEqual(self.get_foo_called, 1)
+
+        # It should be in the cache, as segments, with the "has holes" flag
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']])
+        cache_expected = b'2::\x00f=s;h=1::[" foobar ", " {{obj.get_foo}} ", " !! "]'
+        self.assertEqual(get_cache('default').get(key), cache_expected)
+
+        # Render a second time, should hit the cache but not for ``get_foo``
+        expected = "foobar  foo 2  !!"
+        self.assertStripEqual(self.render(t), expected)
+        self.assertEqual(self.get_name_called, 1)  # Still 1
+        self.assertEqual(self.get_foo_called, 2)  # One more call to the non-cached part
+
+        # With ``__partial__``, the nocache part is not rendered
+        self.assertStripEqual(
+            self.render(t, {'__partial__': True}),
+            "foobar {%endRAW_38a11088962625eb8c913e791931e2bc2e3c7228%} {{obj.get_foo}} "
+            "{%RAW_38a11088962625eb8c913e791931e2bc2e3c7228%} !!"
+        )
+        self.assertEqual(self.get_foo_called, 2)
+
+        # Without nocache part, the html is saved as is
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        self.assertStripEqual(self.render(t), "foobar")
+        key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']])
+        self.assertEqual(get_cache('default').get(key), b'2::\x00f=s;h=0:: foobar ')
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 2)
+
+    @override_settings(
+        ADV_CACHE_COMPRESS = True,
+        ADV_CACHE_SEGMENTED = True,
+    )
+    def test_segmented_compressed_content(self):
+        """Test segments with ``ADV_CACHE_COMPRESS`` set to ``True``."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = "{% load adv_cache %}{% cache 1 test_cached_template obj.pk obj.updated_at %}" \
+            "{{ obj.get_name }} {% nocache %}{{ obj.get_foo }}{% endnocache %}{% endcache %}"
+
+        self.assertEqual(self.render(t), "foobar foo 1")
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']])
+        compressed = zlib.compress(pickle.dumps('["foobar ", "{{obj.get_foo}}", ""]'), -1)
+        self.assertEqual(get_cache('default').get(key), b'2::\x00f=s;h=1::' + compressed)
+
+        self.assertEqual(self.render(t), "foobar foo 2")
+        self.assertEqual(self.get_name_called, 1)
+
+    def test_segmented_content_reads_old_format(self):
+        """Test that content cached before activating segments can still be read."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+                {% nocache %}
+                    {{ obj.get_foo }}
+                {% endnocache %}
+            {% endcache %}
+        """
+
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '1'])
+
+        CacheTag.options.segmented = True
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '2'])
+        self.assertEqual(self.get_name_called, 1)  # Still 1
+
+        # And segmented content can still be read when deactivated
+        get_cache('default').clear()
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '3'])
+        CacheTag.options.segmented = False
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '4'])
+        self.assertEqual(self.get_name_called, 2)
+
+    def test_prefetch(self):
+        """Test that the ``cache_prefetch`` templatetag fetches all fragments at once."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache_prefetch %}
+                {% for item in items %}
+                    {% cache 1 test_prefetch item.pk %}{{ item.name }}{% endcache %}
+                {% endfor %}
+                {% with foo=obj %}
+                    {% cache 1 test_prefetch_with foo.pk %}{{ foo.get_name }}{% endcache %}
+                {% endwith %}
+                {% cache 1 test_prefetch_using obj.pk using=foo %}{{ obj.get_name }}{% endcache %}
+            {% endcache_prefetch %}
+        """
+        items = [{'pk': 1, 'name': 'one'}, {'pk': 2, 'name': 'two'}]
+        expected = ['one', 'two', 'foobar', 'foobar']
+
+        default_cache, foo_cache = get_cache('default'), get_cache('foo')
+
+        with mock.patch.object(default_cache, 'get_many', wraps=default_cache.get_many) as \
+                default_get_many, \
+                mock.patch.object(foo_cache, 'get_many', wraps=foo_cache.get_many) as \
+                foo_get_many, \
+                mock.patch.object(CacheTag, 'cache_get', autospec=True,
+                                  side_effect=CacheTag.cache_get) as cache_get:
+
+            # Render a first time, should miss the cache, with only one call per backend
+            self.assertEqual(self.render(t, {'items': items}).split(), expected)
+            self.assertEqual(self.get_name_called, 2)
+            self.assertEqual(default_get_many.call_count, 1)
+            self.assertEqual(len(default_get_many.call_args[0][0]), 3)
+            self.assertEqual(foo_get_many.call_count, 1)
+            self.assertEqual(cache_get.call_count, 0)
+
+            # Render a second time, should hit the cache, still with one call per backend
+            self.assertEqual(self.render(t, {'items': items}).split(), expected)
+            self.assertEqual(self.get_name_called, 2)  # Still 2
+            self.assertEqual(default_get_many.call_count, 2)
+            self.assertEqual(foo_get_many.call_count, 2)
+            self.assertEqual(cache_get.call_count, 0)
+
+            # Fragments in a loop over a not evaluated iterable are fetched as usual
+            t = """
+                {% load adv_cache %}
+                {% cache_prefetch %}
+                    {% for item in items %}
+                        {% cache 1 test_prefetch item.pk %}{{ item.name }}{% endcache %}
+                    {% endfor %}
+                {% endcache_prefetch %}
+            """
+            self.assertEqual(self.render(t, {'items': iter(items)}).split(), ['one', 'two'])
+            self.assertEqual(cache_get.call_count, 2)
+
+    def test_prefetch_depends(self):
+        """Test that the prefetch templatetag fetches the generations of the tags at once."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache_prefetch %}
+                {% cache 1 test_prefetch obj.pk depends="product:42" %}{{ obj.get_name }}{% endcache %}
+                {% if obj %}
+                    {% cache 1 test_prefetch obj.pk depends="category:7" %}{{ obj.get_name }}{% endcache %}
+                {% endif %}
+            {% endcache_prefetch %}
+        """
+        self.assertEqual(self.render(t).split(), ['foobar', 'foobar'])
+        self.assertEqual(self.get_name_called, 2)
+
+        cache = get_cache('default')
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many, \
+                mock.patch.object(CacheTag, '__init__', autospec=True,
+                                  side_effect=CacheTag.__init__) as init:
+            self.assertEqual(self.render(t).split(), ['foobar', 'foobar'])
+        self.assertEqual(self.get_name_called, 2)
+        # one call for the generations of the tags, one for the contents
+        self.assertEqual(get_many.call_count, 2)
+        self.assertEqual(sorted(get_many.call_args_list[0][0][0]),
+                         ['template.tag.category:7', 'template.tag.product:42'])
+        # the `CacheTag` objects created by the prefetch templatetag are used to render
+        self.assertEqual(init.call_count, 2)
+
+        # Not if an argument changed between the prefetch and the rendering
+        t = """
+            {% load adv_cache %}
+            {% cache_prefetch %}
+                {% cycle "one" "two" as name silent %}
+                {% cache 1 test_prefetch name|default:"none" %}{{ name }}{% endcache %}
+            {% endcache_prefetch %}
+        """
+        self.assertEqual(self.render(t).split(), ['one'])
+        self.assertEqual(cache.get(self.get_template_key('test_prefetch', vary_on=['one'])),
+                         b'1::one')
+        self.assertIsNone(cache.get(self.get_template_key('test_prefetch', vary_on=['none'])))
+
+    def test_lock(self):
+        """Test that only one thread renders a missing fragment when the lock is used."""
+
+        t = """
+            {% load adv_cache_test %}
+            {% cache_lock 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_slow_name }}
+            {% endcache_lock %}
+        """
+
+        calls = []
+
+        def get_slow_name():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'slow foobar'
+
+        self.obj['get_slow_name'] = get_slow_name
+
+        results = []
+        compiled = template.Template(t)
+
+        def render():
+            results.append(compiled.render(template.Context({'obj': self.obj})).strip())
+
+        threads = [threading.Thread(target=render) for __ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['slow foobar'] * 5)
+
+        # The lock is released
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']],
+                                    prefix='template.cache_lock')
+        self.assertIsNone(get_cache('default').get(key + '.lock'))
+
+    def test_lock_fallback(self):
+        """Test what happens when the content is still missing after waiting for the lock."""
+
+        from .testproject.adv_cache_test_app.templatetags.adv_cache_test import LockCacheTag
+
+        t = """
+            {% load adv_cache_test %}
+            {% cache_lock 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+            {% endcache_lock %}
+        """
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']],
+                                    prefix='template.cache_lock')
+
+        # Simulate another process holding the lock
+        get_cache('default').add(key + '.lock', 1)
+
+        with mock.patch.object(LockCacheTag.options, 'lock_wait', 0):
+            # By default, the content is rendered but not saved
+            self.assertStripEqual(self.render(t), 'foobar')
+            self.assertEqual(self.get_name_called, 1)
+            self.assertIsNone(get_cache('default').get(key))
+
+            # But it can be saved
+            with mock.patch.object(LockCacheTag.options, 'lock_fallback', 'save'):
+                self.assertStripEqual(self.render(t), 'foobar')
+                self.assertEqual(self.get_name_called, 2)
+                self.assertStripEqual(get_cache('default').get(key), b"1::\n                foobar")
+
+    @staticmethod
+    def wait_regenerations():
+        """Wait for the end of the regenerations of stale fragments."""
+        for future in list(CacheTag._regenerations.values()):
+            future.result()
+
+    def test_stale_while_revalidate(self):
+        """Test that a stale fragment is returned while regenerated in the background."""
+
+        t = """
+            {% load adv_cache_test %}
+            {% cache_stale 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+            {% endcache_stale %}
+        """
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']],
+                                    prefix='template.cache_stale')
+
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 1)
+
+        # The expire time is saved with the content, which is kept longer in the cache
+        self.assertEqual(get_cache('default').get(key),
+                         b'2::\x00e=%.3f::\n                foobar\n            ' % (now + 1))
+        cache = get_cache('default')
+        expire_at = cache._expire_info[cache.make_key(key, version=None)]
+        self.assertTrue(now + 60 < expire_at < now + 62)
+
+        # Not expired: the content is returned
+        self.obj['name'] = 'new foobar'
+        self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 1)
+
+        # Expired: the stale content is returned, and regenerated in the background,
+        # only once even if asked many times
+        event = threading.Event()
+
+        def get_name():
+            event.wait(5)
+            self.get_name_called += 1
+            return self.obj['name']
+
+        self.obj['get_name'] = get_name
+
+        with mock.patch('time.time', return_value=now + 2):
+            self.assertStripEqual(self.render(t), 'foobar')
+            self.assertStripEqual(self.render(t), 'foobar')
+            self.assertEqual(len(CacheTag._regenerations), 1)
+            event.set()
+            self.wait_regenerations()
+
+            self.assertEqual(self.get_name_called, 2)
+            self.assertStripEqual(self.render(t), 'new foobar')
+            self.assertEqual(self.get_name_called, 2)
+
+        # Only the stale fragment is forced to be regenerated, not the nested ones
+        self.addCleanup(CacheTag._regenerations.clear)
+        with mock.patch('time.time', return_value=now + 4), \
+                mock.patch.object(CacheTag, 'get_regeneration_executor') as get_executor:
+            self.assertStripEqual(self.render(t, {'__regenerate__': False}), 'new foobar')
+        regenerator = get_executor.return_value.submit.call_args[0][0].__self__
+        self.assertTrue(regenerator.regenerate)
+        self.assertNotIn('__regenerate__', regenerator.context)
+        self.assertEqual(list(CacheTag._regenerations), [('default', key)])
+        CacheTag._regenerations.clear()
+
+        # An error when preparing the regeneration doesn't break the rendering
+        with mock.patch('time.time', return_value=now + 4), \
+                mock.patch.object(CacheTag, 'get_regeneration_context', side_effect=ValueError), \
+                self.assertLogs('adv_cache_tag', 'ERROR'):
+            self.assertStripEqual(self.render(t), 'new foobar')
+        self.assertEqual(CacheTag._regenerations, {})
+
+    def test_early_expiry(self):
+        """Test the probabilistic early expiry of fragments."""
+
+        t = """
+            {% load adv_cache_test %}
+            {% cache_early 10 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+            {% endcache_early %}
+        """
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']],
+                                    prefix='template.cache_early')
+
+        # The creation time and the rendering duration are saved with the content
+        self.assertStripEqual(self.render(t), 'foobar')
+        metadata = get_cache('default').get(key).split(b'::')[1]
+        self.assertRegex(metadata, b'^\x00c=[0-9.]+;d=[0-9.]+;e=[0-9.]+$')
+
+        # Simulate a content that took 2 seconds to render, expiring in 5 seconds
+        now = time.time()
+        get_cache('default').set(
+            key, b'2::\x00c=%.3f;d=2;e=%.3f::old foobar' % (now - 5, now + 5), 10)
+
+        # Far enough from the expire time, the content is used
+        with mock.patch('random.random', return_value=0.5):  # -log(0.5) * 2 < 5
+            self.assertStripEqual(self.render(t), 'old foobar')
+        self.assertEqual(self.get_name_called, 1)
+
+        # Unlucky request: the content is regenerated
+        with mock.patch('random.random', return_value=0.99):  # -log(0.01) * 2 > 5
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 2)
+
+    def test_local_cache(self):
+        """Test the decoded fragments kept in memory in front of the cache backend."""
+
+        from .testproject.adv_cache_test_app.templatetags.adv_cache_test import LocalCacheTag
+        LocalCacheTag.invalidate_local_cache()
+
+        t = """
+            {% load adv_cache_test %}
+            {% cache_local 10 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+                {% nocache_local %}{{ obj.get_foo }}{% endnocache_local %}
+            {% endcache_local %}
+        """
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']],
+                                    prefix='template.cache_local')
+
+        # Render a first time, should miss the cache, and keep the content in memory
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '1'])
+        self.assertEqual(self.get_name_called, 1)
+
+        # Even without the cache backend, the content is found in memory
+        get_cache('default').clear()
+        with mock.patch.object(LocalCacheTag, 'cache_get') as cache_get:
+            self.assertEqual(self.render(t).split(), ['foobar', 'foo', '2'])
+        self.assertEqual(cache_get.call_count, 0)
+        self.assertEqual(self.get_name_called, 1)
+
+        # But not after being invalidated
+        LocalCacheTag.invalidate_local_cache(key)
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '3'])
+        self.assertEqual(self.get_name_called, 2)
+
+        # Content from the cache backend is kept in memory too
+        LocalCacheTag.invalidate_local_cache()
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '4'])
+        get_cache('default').clear()
+        self.assertEqual(self.render(t).split(), ['foobar', 'foo', '5'])
+        self.assertEqual(self.get_name_called, 2)
+
+        # Never longer than the expire time of the fragment
+        now = time.time()
+        with mock.patch('time.time', return_value=now + 11):
+            self.assertEqual(self.render(t).split(), ['foobar', 'foo', '6'])
+        self.assertEqual(self.get_name_called, 3)
+
+        # The size of a content is counted in bytes
+        LocalCacheTag.invalidate_local_cache()
+        self.render("{% load adv_cache_test %}{% cache_local 10 test_utf8 %}\u00e9t\u00e9"
+                    "{% endcache_local %}")
+        self.assertEqual(CacheTag._local_caches[LocalCacheTag].size, 5)
+
+    @override_settings(
+        ADV_CACHE_CODEC = 'zlib',
+    )
+    def test_codec(self):
+        """Test with ``ADV_CACHE_CODEC`` set to encode the content."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = "{% load adv_cache %}{% cache 1 test_cached_template obj.pk obj.updated_at %}" \
+            "  {{ obj.get_name }}  {% endcache %}"
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']])
+
+        # Render a first time, should miss the cache
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 1)
+
+        # The id of the codec is saved with the encoded content
+        self.assertEqual(get_cache('default').get(key),
+                         b'2::\x00z=zlib::' + zlib.compress(b"  foobar  ", -1))
+
+        # Render a second time, should hit the cache
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 1)
+
+        # Changing the codec should not invalidate the cache
+        CacheTag.options.codec = 'raw'
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 1)
+
+        # But if the cache is invalidated, the new one will use this new codec
+        get_cache('default').delete(key)
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 2)
+        self.assertEqual(get_cache('default').get(key), b'2::\x00z=raw::  foobar  ')
+
+        # A content encoded with an unknown codec is a cache miss
+        get_cache('default').set(key, b'2::\x00z=foo::  foobar  ')
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 3)
+
+        # New codecs can be registered
+        class ReversedCodec(Codec):
+            id = 'rev'
+
+            def encode(self, content, level):
+                return force_bytes(content[::-1])
+
+            def decode(self, data):
+                return data.decode('utf-8')[::-1]
+
+        register_codec(ReversedCodec())
+        try:
+            CacheTag.options.codec = 'rev'
+            get_cache('default').delete(key)
+            self.assertStripEqual(self.render(t), "foobar")
+            self.assertEqual(self.get_name_called, 4)
+            self.assertEqual(get_cache('default').get(key), b'2::\x00z=rev::  raboof  ')
+            self.assertStripEqual(self.render(t), "foobar")
+            self.assertEqual(self.get_name_called, 4)
+        finally:
+            del codecs['rev']
+
+        # An unavailable codec falls back to the pickle+zlib one, with only one warning
+        CacheTag.options.codec = 'unknown'
+        CacheTag._unavailable_codecs.discard('unknown')
+        try:
+            with mock.patch('adv_cache_tag.tag.logger') as logger:
+                for index in range(2):
+                    get_cache('default').delete(key)
+                    self.assertStripEqual(self.render(t), "foobar")
+                    self.assertTrue(get_cache('default').get(key).startswith(b'2::\x00z=pz::'))
+                    self.assertStripEqual(self.render(t), "foobar")
+                    self.assertEqual(self.get_name_called, 5 + index)
+            self.assertEqual(logger.warning.call_count, 1)
+        finally:
+            CacheTag._unavailable_codecs.discard('unknown')
+
+    @override_settings(
+        ADV_CACHE_COMPRESS = True,
+        ADV_CACHE_COMPRESS_MIN_SIZE = 100,
+        ADV_CACHE_COMPRESS_MIN_RATIO = 2,
+    )
+    def test_adaptive_compression(self):
+        """Test that only big and compressible contents are compressed."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = "{% load adv_cache %}{% cache 1 test_cached_template obj.pk %}" \
+            "{{ obj.get_name }}{{ text }}{% endcache %}"
+        key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']])
+
+        # A small content is not compressed
+        self.assertEqual(self.render(t), "foobar")
+        self.assertEqual(get_cache('default').get(key), b'2::\x00z=raw::foobar')
+        self.assertEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 1)
+
+        # A big one is compressed
+        get_cache('default').delete(key)
+        text = " foo bar" * 20
+        self.assertEqual(self.render(t, {'text': text}), "foobar" + text)
+        compressed = zlib.compress(pickle.dumps(SafeText("foobar" + text)), -1)
+        self.assertEqual(get_cache('default').get(key), b'2::\x00z=pz::' + compressed)
+        self.assertEqual(self.render(t), "foobar" + text)
+        self.assertEqual(self.get_name_called, 2)
+
+        # But not if it's not compressed enough
+        get_cache('default').delete(key)
+        text = hashlib.sha512(b'foo').hexdigest()
+        self.assertEqual(self.render(t, {'text': text}), "foobar" + text)
+        self.assertEqual(get_cache('default').get(key), force_bytes('2::\x00z=raw::foobar' + text))
+        self.assertEqual(self.render(t), "foobar" + text)
+        self.assertEqual(self.get_name_called, 3)
+
+    def test_vary_on_filters(self):
+        """Test that ``vary_on`` arguments are compiled once and can use filters."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at|date:"Y-m-d" 'foo' %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        compiled = template.Template(t)
+        node = [n for n in compiled.nodelist if isinstance(n, CacheTag.Node)][0]
+        self.assertEqual([expression.token for expression in node.vary_on_expressions],
+                         ['obj.pk', 'obj.updated_at|date:"Y-m-d"', "'foo'"])
+
+        # Nothing is compiled again when rendering
+        with mock.patch.object(template.Variable, '__init__', autospec=True,
+                               side_effect=template.Variable.__init__) as variable_init:
+            self.assertStripEqual(compiled.render(template.Context({'obj': self.obj})), "foobar")
+        self.assertEqual(variable_init.call_count, 0)
+
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], '2015-10-27', 'foo'])
+        self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+        self.assertEqual(node.literal_fragment_name, 'test_cached_template')
+
+        # An unknown variable without filters still raises
+        with self.assertRaises(template.VariableDoesNotExist):
+            compiled.render(template.Context({'obj': {}}))
+
+        # A quoted filter argument can contain spaces
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at|date:"Y m d" %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        self.assertStripEqual(self.render(t), "foobar")
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], '2015 10 27'])
+        self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+
+    @override_settings(
+        ADV_CACHE_KEY_HASH = 'blake2b',
+        ADV_CACHE_KEY_HASH_MEMO_MAX_ENTRIES = 10,
+    )
+    def test_key_hash(self):
+        """Test the ``ADV_CACHE_KEY_HASH`` and ``ADV_CACHE_KEY_HASH_MEMO_MAX_ENTRIES`` settings."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+        CacheTag._key_hash_memos.clear()
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+
+        with mock.patch.object(CacheTag, 'compute_hash_args', autospec=True,
+                               side_effect=CacheTag.compute_hash_args) as compute_hash_args:
+            self.assertStripEqual(self.render(t), "foobar")
+            self.assertStripEqual(self.render(t), "foobar")
+
+        # The hash is not kept in memory, as it costs as much as the memo
+        self.assertEqual(compute_hash_args.call_count, 2)
+        self.assertEqual(self.get_name_called, 1)
+        self.assertNotIn(CacheTag, CacheTag._key_hash_memos)
+
+        # Arguments are encoded with their length, not quoted
+        key = 'template.cache.test_cached_template.%s' % hashlib.blake2b(
+            b'2:4219:2015-10-27 00:00:00', digest_size=16).hexdigest()
+        self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+
+        # With md5, the hash is computed only once, then kept in memory
+        CacheTag.options.key_hash = 'md5'
+        with mock.patch.object(CacheTag, 'compute_hash_args', autospec=True,
+                               side_effect=CacheTag.compute_hash_args) as compute_hash_args:
+            self.assertStripEqual(self.render(t), "foobar")
+            self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(compute_hash_args.call_count, 1)
+        self.assertEqual(self.get_name_called, 2)
+
+        # Arguments of other types are not kept in memory
+        with mock.patch.object(CacheTag, 'compute_hash_args', autospec=True,
+                               side_effect=CacheTag.compute_hash_args) as compute_hash_args:
+            self.render(t, {'obj': dict(self.obj, pk=[42])})
+            self.render(t, {'obj': dict(self.obj, pk=[42])})
+        self.assertEqual(compute_hash_args.call_count, 2)
+
+        # Equal values with different representations don't share their hash
+        utc_date = datetime(2015, 10, 27, 12, tzinfo=timezone.utc)
+        for first, second in (
+            ({'pk': Decimal('1.0')}, {'pk': Decimal('1.00')}),
+            ({'updated_at': utc_date},
+             {'updated_at': utc_date.astimezone(timezone(timedelta(hours=2)))}),
+        ):
+            self.render(t, {'obj': dict(self.obj, **first)})
+            self.render(t, {'obj': dict(self.obj, **second)})
+            key = self.get_template_key('test_cached_template', vary_on=[
+                second.get('pk', self.obj['pk']),
+                second.get('updated_at', self.obj['updated_at'])])
+            self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+
+        CacheTag.options.key_hash = 'foo'
+        with self.assertRaises(ValueError):
+            self.render(t)
+
+    @override_settings(
+        ADV_CACHE_KEY_ADAPTERS = True,
+    )
+    def test_key_adapters(self):
+        """Test the values used in the cache key with ``ADV_CACHE_KEY_ADAPTERS``."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        class Obj(object):
+            def __str__(self):
+                raise AssertionError('Should not be stringified')
+
+            def __cache_key__(self):
+                return 'custom'
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template group groups price obj.updated_at custom %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        context = {
+            'group': Group(pk=12, name='foo'),
+            'groups': Group.objects.filter(name='foo'),
+            'price': Decimal('1.10'),
+            'custom': Obj(),
+        }
+
+        # No query is done to compose the key
+        with self.assertNumQueries(0):
+            self.assertStripEqual(self.render(t, context), "foobar")
+
+        sql, params = Group.objects.filter(name='foo').query.sql_with_params()
+        key = self.get_template_key('test_cached_template', vary_on=[
+            'auth.Group:12',
+            'auth.Group:%s:%s' % (sql, ','.join(params)),
+            '1.1',
+            '2015-10-27T00:00:00',
+            'custom',
+        ])
+        self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+
+        # Values of other types are used as before
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk 'foo' %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        self.assertStripEqual(self.render(t), "foobar")
+        key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk'], 'foo'])
+        self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+
+    def test_depends(self):
+        """Test the invalidation of fragments by the tags they depend on."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk depends="product:42 category:7" obj.updated_at %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        t2 = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template2 obj.pk depends=tags %}
+                {{ obj.get_foo }}
+            {% endcache %}
+        """
+
+        # Render a first time, should miss the cache and create the counters
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertStripEqual(self.render(t2, {'tags': ['category:7']}), "foo 1")
+        generation = get_cache('default').get('template.tag.product:42')
+        self.assertIsNotNone(generation)
+        self.assertIsNotNone(get_cache('default').get('template.tag.category:7'))
+
+        # The generations are part of the key
+        key = self.get_template_key('test_cached_template', vary_on=[
+            self.obj['pk'], self.obj['updated_at'],
+            'category:7=%s' % get_cache('default').get('template.tag.category:7'),
+            'product:42=%s' % generation,
+        ])
+        self.assertEqual(get_cache('default').get(key).split(), [b"1::", b"foobar"])
+
+        # Render a second time, should hit the cache, with only one call for the counters
+        with mock.patch.object(get_cache('default'), 'get_many',
+                               wraps=get_cache('default').get_many) as get_many:
+            self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(self.get_name_called, 1)
+
+        # Invalidating a tag invalidates only the fragments depending on it
+        CacheTag.invalidate_tags('product:42')
+        self.assertEqual(get_cache('default').get('template.tag.product:42'), generation + 1)
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 2)
+        self.assertStripEqual(self.render(t2, {'tags': ['category:7']}), "foo 1")
+
+        CacheTag.invalidate_tags('category:7', 'foo')
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 3)
+        self.assertStripEqual(self.render(t2, {'tags': 'category:7'}), "foo 2")
+
+        # A removed counter doesn't give old contents back
+        get_cache('default').delete('template.tag.product:42')
+        with mock.patch('time.time', return_value=time.time() + 1):
+            self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 4)
+
+        # A counter created by a fragment while invalidating is incremented
+        cache = get_cache('default')
+        with mock.patch.object(cache, 'add', side_effect=lambda key, *args: (
+                cache.set(key, 5, None), False)[1]):
+            CacheTag.invalidate_tags('bar')
+        self.assertEqual(cache.get('template.tag.bar'), 6)
+
+        # The counters are updated through the circuit breaker, a missing one not being an error
+        self.addCleanup(circuit_breakers.clear)
+        generation = cache.get('template.tag.product:42')
+        with mock.patch.object(CacheTag.options, 'circuit_breaker_threshold', 1):
+            CacheTag.invalidate_tags('baz')
+            self.assertEqual(get_circuit_breakers_states()['default']['state'], 'closed')
+            circuit_breakers['default'].failure()
+            with mock.patch('adv_cache_tag.tag.logger') as logger:
+                CacheTag.invalidate_tags('product:42')
+        self.assertEqual(cache.get('template.tag.product:42'), generation)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_fragments_api(self):
+        """Test the API to get keys, and set or delete contents, outside templates."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 1)
+
+        # Same key as the templatetag
+        key = self.get_template_key('test_cached_template',
+                                    vary_on=[self.obj['pk'], self.obj['updated_at']])
+        self.assertEqual(CacheTag.key_for('test_cached_template', 42, self.obj['updated_at']), key)
+        self.assertEqual(CacheTag.key_for('test_cached_template', 42, self.obj['updated_at'],
+                                          nodename='foo'), key.replace('.cache.', '.foo.'))
+
+        # Delete the content
+        fragment = CacheTag.get_fragment('test_cached_template', 42, self.obj['updated_at'])
+        CacheTag.delete_many([fragment])
+        self.assertIsNone(get_cache('default').get(key))
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 2)
+
+        # Set the content, used by the templatetag
+        CacheTag.set_rendered(' foo bar ', 'test_cached_template', 42, self.obj['updated_at'],
+                              expire_time=1)
+        self.assertEqual(get_cache('default').get(key), b'1:: foo bar ')
+        self.assertStripEqual(self.render(t), "foo bar")
+        self.assertEqual(self.get_name_called, 2)
+
+        # Set many contents, in many backends
+        CacheTag.set_many([
+            (CacheTag.get_fragment('test_cached_template', 42, self.obj['updated_at']), 'foo'),
+            (CacheTag.get_fragment('test_cached_template', 43, using='foo'), 'bar'),
+        ])
+        self.assertEqual(get_cache('default').get(key), b'1::foo')
+        self.assertEqual(
+            get_cache('foo').get(self.get_template_key('test_cached_template', vary_on=[43])),
+            b'1::bar')
+
+        # Without expire time, the default timeout of the cache backend is used
+        self.assertEqual(CacheTag.get_fragment('test_cached_template', 42).get_cache_timeout(),
+                         get_cache('default').default_timeout)
+        self.assertIsNone(CacheTag.get_fragment('test_cached_template', 42,
+                                                expire_time=None).get_cache_timeout())
+
+        # The chunks of a content are deleted too
+        with mock.patch.object(CacheTag.options, 'chunk_size', 5):
+            fragment = CacheTag.set_rendered('foo bar baz', 'test_cached_template', 42,
+                                             self.obj['updated_at'], expire_time=1)
+            chunk_keys = ['%s.chunk.%d' % (key, index) for index in range(3)]
+            self.assertEqual(len(get_cache('default').get_many(chunk_keys)), 3)
+            CacheTag.delete_many([fragment])
+        self.assertIsNone(get_cache('default').get(key))
+        self.assertEqual(get_cache('default').get_many(chunk_keys), {})
+
+        # The cache backend is not used when its circuit breaker is open
+        fragment = CacheTag.get_fragment('test_cached_template', 42, self.obj['updated_at'])
+        with mock.patch.object(CacheTag, 'call_cache', autospec=True) as call_cache:
+            CacheTag.set_many([(fragment, 'foo')])
+            CacheTag.delete_many([fragment])
+        self.assertEqual([call[0][1] for call in call_cache.call_args_list],
+                         [fragment.cache.set_many, fragment.cache.delete_many])
+
+    @override_settings(
+        ADV_CACHE_VERSIONING = True,
+        ADV_CACHE_COMPRESS = True,
+    )
+    def test_fragments_api_with_options(self):
+        """Test the API to set contents, with options changing the cached data."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk obj.updated_at depends="foo" %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+        CacheTag.set_rendered('foo bar', 'test_cached_template', 42, version=self.obj['updated_at'],
+                              depends='foo', expire_time=1)
+        self.assertStripEqual(self.render(t), "foo bar")
+        self.assertEqual(self.get_name_called, 0)
+
+        CacheTag.invalidate_tags('foo')
+        self.assertStripEqual(self.render(t), "foobar")
+        self.assertEqual(self.get_name_called, 1)
+
+    @override_settings(
+        ADV_CACHE_WRITE_BEHIND = True,
+    )
+    def test_write_behind(self):
+        """Test that contents are saved in the cache only when the response is sent."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}{{ obj.get_name }}{% endcache %}
+            {% cache 1 test_cached_template obj.updated_at %}{{ obj.get_name }}{% endcache %}
+        """
+        key1 = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']])
+        key2 = self.get_template_key('test_cached_template', vary_on=[self.obj['updated_at']])
+
+        def view(request):
+            return HttpResponse(self.render(t))
+
+        cache = get_cache('default')
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as cache_set_many:
+            response = WriteBehindMiddleware(view)(RequestFactory().get('/'))
+            self.assertEqual(response.content.split(), [b'foobar', b'foobar'])
+
+            # Nothing is saved until the response is sent
+            self.assertIsNone(cache.get(key1))
+            self.assertIsNone(cache.get(key2))
+
+            response.close()
+            self.assertEqual(cache.get(key1), b'1::foobar')
+            self.assertEqual(cache.get(key2), b'1::foobar')
+
+        self.assertEqual(cache_set_many.call_count, 1)
+
+        # Without the middleware, contents are saved immediately
+        cache.clear()
+        self.render(t)
+        self.assertEqual(cache.get(key1), b'1::foobar')
+
+        # When the buffer is full, contents are saved immediately...
+        cache.clear()
+        with override_settings(ADV_CACHE_WRITE_BEHIND_MAX_ENTRIES=1):
+            response = WriteBehindMiddleware(view)(RequestFactory().get('/'))
+            self.assertIsNone(cache.get(key1))
+            self.assertEqual(cache.get(key2), b'1::foobar')
+            response.close()
+            self.assertEqual(cache.get(key1), b'1::foobar')
+
+        # ... or not saved at all
+        cache.clear()
+        CacheTag.options.write_behind_overflow = 'drop'
+        with override_settings(ADV_CACHE_WRITE_BEHIND_MAX_ENTRIES=1):
+            response = WriteBehindMiddleware(view)(RequestFactory().get('/'))
+            response.close()
+            self.assertEqual(cache.get(key1), b'1::foobar')
+            self.assertIsNone(cache.get(key2))
+
+        # In a background thread, with the cache object of this thread
+        cache.clear()
+        CacheTag.options.write_behind_overflow = 'write'
+        with override_settings(ADV_CACHE_WRITE_BEHIND_THREAD=True,
+                               ADV_CACHE_WRITE_BEHIND_MAX_PENDING=1), \
+                mock.patch.object(CacheTag, 'get_regeneration_executor') as get_executor:
+            response = WriteBehindMiddleware(view)(RequestFactory().get('/'))
+            response.close()
+            self.assertIsNone(cache.get(key1))
+            self.assertEqual(WriteBehindMiddleware.pending_flushes, 1)
+
+            # Too many buffers are waiting: saved without the background thread
+            response = WriteBehindMiddleware(view)(RequestFactory().get('/'))
+            response.close()
+            self.assertEqual(cache.get(key1), b'1::foobar')
+            self.assertEqual(get_executor.return_value.submit.call_count, 1)
+
+            caches = []
+
+            def flush():
+                get_executor.return_value.submit.call_args[0][0]()
+                caches.append(get_cache('default'))
+
+            cache.clear()
+            thread = threading.Thread(target=flush)
+            thread.start()
+            thread.join()
+            self.assertEqual(cache.get(key1), b'1::foobar')
+            self.assertIsNot(caches[0], cache)
+            self.assertEqual(WriteBehindMiddleware.pending_flushes, 0)
+
+        # Contents created with the lock are saved before releasing it
+        from .testproject.adv_cache_test_app.templatetags.adv_cache_test import LockCacheTag
+
+        t = """
+            {% load adv_cache_test %}
+            {% cache_lock 1 test_cached_template obj.pk %}{{ obj.get_name }}{% endcache_lock %}
+        """
+        key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']],
+                                    prefix='template.cache_lock')
+        cache.clear()
+        with mock.patch.object(LockCacheTag.options, 'write_behind', True):
+            response = WriteBehindMiddleware(
+                lambda request: HttpResponse(self.render(t)))(RequestFactory().get('/'))
+            self.assertEqual(cache.get(key), b'1::foobar')
+            self.assertIsNone(cache.get(key + '.lock'))
+            response.close()
+
+    @override_settings(
+        ADV_CACHE_REQUEST_MEMO = True,
+    )
+    def test_request_memo(self):
+        """Test that the same fragment is loaded only once during a request."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = """
+            {% load adv_cache %}
+            {% for i in "123" %}
+                {% cache 1 test_cached_template obj.pk %}
+                    {{ obj.get_name }} {% nocache %}{{ obj.get_foo }}{% endnocache %}
+                {% endcache %}
+            {% endfor %}
+        """
+
+        def view(request):
+            return HttpResponse(self.render(t))
+
+        # Render a first time, should miss the cache only once
+        with mock.patch.object(CacheTag, 'cache_get', autospec=True,
+                               side_effect=CacheTag.cache_get) as cache_get:
+            response = RequestMemoMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(response.content.split(),
+                         [b'foobar', b'foo', b'1', b'foobar', b'foo', b'2', b'foobar', b'foo', b'3'])
+        self.assertEqual(cache_get.call_count, 1)
+        self.assertEqual(self.get_name_called, 1)
+
+        # In a new request, the content is loaded once from the cache
+        with mock.patch.object(CacheTag, 'cache_get', autospec=True,
+                               side_effect=CacheTag.cache_get) as cache_get:
+            response = RequestMemoMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(response.content.split()[-1], b'6')
+        self.assertEqual(cache_get.call_count, 1)
+        self.assertEqual(self.get_name_called, 1)
+
+        # Outside a request, it's loaded each time
+        with mock.patch.object(CacheTag, 'cache_get', autospec=True,
+                               side_effect=CacheTag.cache_get) as cache_get:
+            self.render(t)
+        self.assertEqual(cache_get.call_count, 3)
+
+    def test_async(self):
+        """Test the async API to prefetch, load and save contents."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}{{ obj.get_name }}{% endcache %}
+            {% cache 1 test_cached_template obj.updated_at using=foo %}{{ obj.get_name }}{% endcache %}
+        """
+        self.assertEqual(self.render(t).split(), ['foobar', 'foobar'])
+        self.assertEqual(self.get_name_called, 2)
+
+        # Prefetch the contents of the fragments, from both backends, before rendering
+        compiled = template.Template(t)
+        context = {'obj': self.obj}
+        prefetched = asyncio.run(CacheTag.aprefetch(compiled, context))
+        self.assertEqual(prefetched, {
+            get_cache('default'): {
+                self.get_template_key('test_cached_template', vary_on=[self.obj['pk']]):
+                    b'1::foobar'},
+            get_cache('foo'): {
+                self.get_template_key('test_cached_template', vary_on=[self.obj['updated_at']]):
+                    b'1::foobar'},
+        })
+        with mock.patch.object(CacheTag, 'cache_get') as cache_get:
+            self.assertEqual(compiled.render(template.Context(context)).split(),
+                             ['foobar', 'foobar'])
+        self.assertEqual(cache_get.call_count, 0)
+        self.assertEqual(self.get_name_called, 2)
+
+        # Load and save contents
+        fragment = CacheTag.get_fragment('test_cached_template', 42)
+        asyncio.run(fragment.aload_content())
+        self.assertEqual(fragment.content, 'foobar')
+
+        fragment = CacheTag.get_fragment('test_cached_template', 43)
+        asyncio.run(fragment.acache_set(b'1::foo'))
+        asyncio.run(fragment.aload_content())
+        self.assertEqual(fragment.content, 'foo')
+
+        # A missing content is created
+        fragment = CacheTag.get_fragment('test_cached_template', 44)
+        asyncio.run(fragment.aload_content())
+        self.assertEqual(fragment.content, '')
+        self.assertEqual(get_cache('default').get(fragment.cache_key), b'1::')
+
+        # Errors when prefetching are logged and counted
+        with mock.patch.object(CacheTag, 'acache_get_many',
+                               new=mock.AsyncMock(side_effect=ValueError)), \
+                mock.patch.object(CacheTag, 'record_metric') as record_metric, \
+                self.assertLogs('adv_cache_tag', 'ERROR'):
+            self.assertEqual(asyncio.run(CacheTag.aprefetch(compiled, context)), {})
+        record_metric.assert_any_call('error', 'prefetch')
+
+        # The async API needs asgiref (django >= 3.0)
+        with mock.patch('adv_cache_tag.tag.sync_to_async', None):
+            with self.assertRaises(ImproperlyConfigured):
+                asyncio.run(CacheTag.aprefetch(compiled, context))
+            with self.assertRaises(ImproperlyConfigured):
+                asyncio.run(fragment.aload_content())
+            with self.assertRaises(ImproperlyConfigured):
+                asyncio.run(fragment.acache_set(b'1::foo'))
+
+    def test_warm_command(self):
+        """Test the ``adv_cache_warm`` management command."""
+
+        cache = get_cache('default')
+
+        def key(pk):
+            return self.get_template_key('warm_test', vary_on=[pk])
+
+        # Existing contents are regenerated
+        cache.set(key(0), b'1::bar')
+
+        # With a python callable, saving the contents by batches
+        out = StringIO()
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as cache_set_many:
+            call_command('adv_cache_warm', 'adv_cache_tag.tests.tests.warm_spec',
+                         batch_size=2, stdout=out)
+        self.assertEqual(cache_set_many.call_count, 3)
+        self.assertIn('5 templates rendered (0 errors)', out.getvalue())
+        for pk in range(5):
+            self.assertEqual(cache.get(key(pk)), force_bytes('1::foo %d' % pk))
+
+        # With a json file
+        cache.clear()
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as spec_file:
+            json.dump([
+                {'template': 'adv_cache_test/warm.html', 'contexts': [{'pk': 1, 'name': 'bar'}]},
+                {'template': 'adv_cache_test/unknown.html'},
+            ], spec_file)
+            spec_file.flush()
+            out, err = StringIO(), StringIO()
+            call_command('adv_cache_warm', spec_file.name, rate=1000, stdout=out, stderr=err)
+        self.assertIn('1 templates rendered (1 errors)', out.getvalue())
+        self.assertIn('adv_cache_test/unknown.html', err.getvalue())
+        self.assertEqual(cache.get(key(1)), b'1::bar')
+
+        # With many workers, a file is read only once, and split between them
+        cache.clear()
+        pool = mock.MagicMock()
+        pool.return_value.__enter__.return_value.starmap.side_effect = (
+            lambda func, arguments: [func(*args) for args in arguments])
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as spec_file, \
+                mock.patch('adv_cache_tag.management.commands.adv_cache_warm.Pool', pool), \
+                mock.patch('adv_cache_tag.management.commands.adv_cache_warm.connections'), \
+                mock.patch('adv_cache_tag.management.commands.adv_cache_warm.load_spec',
+                           wraps=load_spec) as load_spec_mock:
+            json.dump([{'template': 'adv_cache_test/warm.html',
+                        'contexts': [{'pk': pk, 'name': 'foo %d' % pk} for pk in range(5)]}],
+                      spec_file)
+            spec_file.flush()
+            out = StringIO()
+            call_command('adv_cache_warm', spec_file.name, workers=2, stdout=out)
+        self.assertEqual(load_spec_mock.call_count, 1)
+        arguments = pool.return_value.__enter__.return_value.starmap.call_args[0][1]
+        self.assertEqual([[context['pk'] for __, context in args[0]] for args in arguments],
+                         [[0, 2, 4], [1, 3]])
+        self.assertIn('5 templates rendered (0 errors)', out.getvalue())
+        for pk in range(5):
+            self.assertEqual(cache.get(key(pk)), force_bytes('1::foo %d' % pk))
+
+    @override_settings(
+        ADV_CACHE_METRICS = True,
+        ADV_CACHE_COMPRESS = True,
+    )
+    def test_metrics(self):
+        """Test the events sent to the metrics collector."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+
+        collector = MetricsCollector()
+        events = []
+        # a failing callback doesn't stop the other ones
+        collector.register_callback(mock.Mock(side_effect=ValueError))
+        collector.register_callback(lambda *args: events.append(args))
+
+        with mock.patch('adv_cache_tag.tag.metrics_collector', collector), \
+                mock.patch('adv_cache_tag.metrics.logger') as logger:
+            # A miss, then a hit
+            self.render(t)
+            self.render(t)
+
+            # A content saved by another version of the class
+            key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']])
+            get_cache('default').set(key, b'2::foobar')
+            self.render(t)
+
+            # A content that cannot be decoded
+            get_cache('default').set(key, b'1::foobar')
+            self.render(t)
+
+            # An error from the cache backend
+            with mock.patch.object(CacheTag, 'cache_get', side_effect=Exception):
+                self.render(t)
+
+        self.assertEqual(
+            [(event, value) for tag_class, fragment_name, event, value in events
+             if event in ('lookup', 'error')],
+            [('lookup', 'miss'), ('lookup', 'hit'), ('lookup', 'version_mismatch'),
+             ('lookup', 'decode_error'), ('error', 'get'), ('lookup', 'miss')])
+        self.assertEqual({(tag_class, fragment_name) for tag_class, fragment_name, *__ in events},
+                         {(CacheTag, 'test_cached_template')})
+        self.assertEqual(logger.exception.call_count, len(events))
+
+        self.assertEqual(collector.counters[
+            ('CacheTag', 'test_cached_template', 'lookup', 'miss')], 2)
+        histograms = collector.histograms
+        self.assertEqual(histograms[('CacheTag', 'test_cached_template', 'render_seconds')].count, 4)
+        self.assertEqual(histograms[('CacheTag', 'test_cached_template', 'encode_seconds')].count, 4)
+        self.assertEqual(histograms[('CacheTag', 'test_cached_template', 'decode_seconds')].count, 1)
+        size = histograms[('CacheTag', 'test_cached_template', 'size_bytes')]
+        stored = histograms[('CacheTag', 'test_cached_template', 'stored_bytes')]
+        self.assertEqual(size.count, 4)
+        self.assertEqual(stored.count, 4)
+        self.assertEqual(size.sum, 4 * len('\n                foobar\n            '))
+
+        # Exported in the prometheus format
+        with mock.patch('adv_cache_tag.metrics.collector', collector):
+            response = prometheus_view(RequestFactory().get('/'))
+        content = response.content.decode()
+        self.assertIn('adv_cache_lookups_total{tag="CacheTag",fragment="test_cached_template",'
+                      'result="hit"} 1\n', content)
+        self.assertIn('adv_cache_errors_total{tag="CacheTag",fragment="test_cached_template",'
+                      'kind="get"} 1\n', content)
+        self.assertIn('adv_cache_render_seconds_bucket{tag="CacheTag",'
+                      'fragment="test_cached_template",le="+Inf"} 4\n', content)
+
+        collector.reset()
+        self.assertEqual(collector.counters, {})
+
+    @override_settings(
+        ADV_CACHE_CIRCUIT_BREAKER_THRESHOLD = 2,
+    )
+    def test_circuit_breaker(self):
+        """Test that a failing cache backend is not used for some time."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+        self.addCleanup(circuit_breakers.clear)
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+
+        cache = get_cache('default')
+        with mock.patch.object(cache, 'get', side_effect=ConnectionError) as cache_get, \
+                mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+
+            # Errors are logged until the threshold is reached
+            with self.assertLogs('adv_cache_tag', 'ERROR') as logs:
+                self.assertStripEqual(self.render(t), 'foobar')
+                self.assertStripEqual(self.render(t), 'foobar')
+            self.assertEqual(len(logs.records), 3)
+            self.assertEqual(logs.records[1].getMessage(),
+                             'Cache backend "default" unavailable (2 errors in 10 seconds), '
+                             'not used for 30 seconds')
+            self.assertEqual(cache_get.call_count, 2)
+            # the circuit was open before saving the second content
+            self.assertEqual(cache_set.call_count, 1)
+            self.assertEqual(get_circuit_breakers_states()['default']['state'], 'open')
+
+            # Then the backend is not used, without logs
+            with mock.patch('adv_cache_tag.tag.logger') as logger:
+                self.assertStripEqual(self.render(t), 'foobar')
+            self.assertFalse(logger.exception.called)
+            self.assertEqual(cache_get.call_count, 2)
+            self.assertEqual(cache_set.call_count, 1)
+            self.assertEqual(self.get_name_called, 3)
+            self.assertEqual(get_circuit_breakers_states()['default']['skipped'], 3)
+
+            # After the cooldown, a failing probe opens it again
+            circuit_breakers['default'].opened_at -= 30
+            self.render(t)
+            self.assertEqual(cache_get.call_count, 3)
+            self.assertEqual(cache_set.call_count, 1)
+            self.assertEqual(get_circuit_breakers_states()['default']['state'], 'open')
+
+        # An interrupted probe (cancelled...) lets another call probe the backend
+        circuit_breakers['default'].opened_at -= 30
+        with mock.patch.object(cache, 'get', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.render(t)
+        self.assertEqual(get_circuit_breakers_states()['default']['state'], 'half_open')
+
+        # A successful probe closes it
+        cache.clear()
+        circuit_breakers['default'].opened_at -= 30
+        self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(get_circuit_breakers_states()['default']['state'], 'closed')
+        self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 5)
+
+        # Exported in the prometheus format
+        content = prometheus_view(RequestFactory().get('/')).content.decode()
+        self.assertIn('adv_cache_circuit_breaker_state{backend="default",state="closed"} 1\n',
+                      content)
+
+        # With all the samples of each metric grouped after its type
+        with mock.patch.dict(circuit_breakers, {'other': CircuitBreaker('other', 5, 60, 30)}):
+            lines = export_circuit_breakers_prometheus().splitlines()
+        self.assertEqual([line.split('{')[0] for line in lines],
+                         ['# TYPE adv_cache_circuit_breaker_state gauge']
+                         + ['adv_cache_circuit_breaker_state'] * 6
+                         + ['# TYPE adv_cache_circuit_breaker_skipped_total counter']
+                         + ['adv_cache_circuit_breaker_skipped_total'] * 2)
+
+    @override_settings(
+        ADV_CACHE_FALLBACK_TTL = 3600,
+    )
+    def test_fallback(self):
+        """Test that the expired content is used if it cannot be regenerated."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+        self.addCleanup(CacheTag._fallback_retries.clear)
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}
+                {{ obj.get_name }}
+            {% endcache %}
+        """
+
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            self.assertStripEqual(self.render(t), 'foobar')
+
+        # The content is kept in the cache after its expire time
+        cache = get_cache('default')
+        key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']])
+        expire_at = cache._expire_info[cache.make_key(key, version=None)]
+        self.assertTrue(now + 3600 < expire_at < now + 3602)
+
+        def get_name():
+            self.get_name_called += 1
+            raise ValueError('boom')
+
+        self.obj['get_name'] = get_name
+
+        # Expired and failing: the expired content is used
+        with mock.patch('time.time', return_value=now + 2), \
+                self.assertLogs('adv_cache_tag', 'ERROR'):
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 2)
+
+        # Not tried again before 5 seconds
+        with mock.patch('time.time', return_value=now + 6):
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 2)
+
+        # Then the delay is doubled after each failure
+        with mock.patch('time.time', return_value=now + 8):
+            self.assertStripEqual(self.render(t), 'foobar')
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 3)
+        with mock.patch('time.time', return_value=now + 17):
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 3)
+        with mock.patch('time.time', return_value=now + 19):
+            self.assertStripEqual(self.render(t), 'foobar')
+        self.assertEqual(self.get_name_called, 4)
+
+        # When it works again, the new content is used
+        self.obj['get_name'] = self.get_name
+        self.obj['name'] = 'new foobar'
+        with mock.patch('time.time', return_value=now + 40):
+            self.assertStripEqual(self.render(t), 'new foobar')
+            self.assertStripEqual(self.render(t), 'new foobar')
+        self.assertEqual(self.get_name_called, 5)
+        self.assertEqual(len(CacheTag._fallback_retries), 0)
+
+    @override_settings(
+        ADV_CACHE_CHUNK_SIZE = {'default': 20},
+    )
+    def test_chunks(self):
+        """Test that big contents are split in many chunks."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}{{ obj.get_name }}{% endcache %}
+        """
+        self.obj['name'] = 'foobar' * 10
+
+        self.assertStripEqual(self.render(t), 'foobar' * 10)
+        self.assertEqual(self.get_name_called, 1)
+
+        # A manifest is saved instead of the content, and the chunks in other keys
+        cache = get_cache('default')
+        key = self.get_template_key('test_cached_template', vary_on=[self.obj['pk']])
+        content = force_bytes('1::' + 'foobar' * 10)
+
+        def get_chunks_keys():
+            manifest = cache.get(key)
+            self.assertTrue(manifest.startswith(b'\x01chunks::'))
+            count, checksum, size = manifest.split(b'::')[1].decode().split(':')
+            self.assertEqual(int(count), 4)
+            self.assertEqual(int(checksum, 16), zlib.crc32(content))
+            self.assertEqual(int(size), len(content))
+            return ['%s.chunk.%d' % (key, index) for index in range(4)]
+
+        chunks_keys = get_chunks_keys()
+        chunks = cache.get_many(chunks_keys)
+        self.assertEqual(b''.join(chunks[chunk_key] for chunk_key in chunks_keys), content)
+
+        # The chunks are fetched with one ``get_many`` call
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as cache_get_many:
+            self.assertStripEqual(self.render(t), 'foobar' * 10)
+        self.assertEqual(self.get_name_called, 1)
+        self.assertEqual(cache_get_many.call_count, 1)
+
+        # Also when prefetched
+        t_prefetch = """
+            {% load adv_cache %}
+            {% cache_prefetch %}{% cache 1 test_cached_template obj.pk %}{{ obj.get_name }}{% endcache %}{% endcache_prefetch %}
+        """
+        self.assertStripEqual(self.render(t_prefetch), 'foobar' * 10)
+        self.assertEqual(self.get_name_called, 1)
+
+        # An invalid or missing chunk is a miss
+        cache.set(chunks_keys[2], b'barfoo')
+        self.assertStripEqual(self.render(t), 'foobar' * 10)
+        self.assertEqual(self.get_name_called, 2)
+
+        cache.delete(get_chunks_keys()[0])
+        self.assertStripEqual(self.render(t), 'foobar' * 10)
+        self.assertEqual(self.get_name_called, 3)
+
+        # The chunks of the previous saves are overwritten, not kept in the cache
+        self.assertEqual(get_chunks_keys(), chunks_keys)
+        self.assertEqual(len(cache._cache), 5)
+
+        # Small contents, or for other backends, are not split
+        self.obj['name'] = 'foo'
+        self.assertStripEqual(self.render(t.replace('obj.pk', 'obj.pk "small"')), 'foo')
+        self.assertEqual(
+            cache.get(self.get_template_key('test_cached_template', vary_on=[self.obj['pk'], 'small'])),
+            b'1::foo')
+
+    def test_server_timing(self):
+        """Test the trace of the fragments in the ``Server-Timing`` header."""
+
+        t = """
+            {% load adv_cache %}
+            {% cache 1 test_cached_template obj.pk %}
+                {{ obj.get_name }} {% nocache %}{{ obj.get_foo }}{% endnocache %}
+            {% endcache %}
+            {% cache 1 test_other obj.pk %}
+                foo
+            {% endcache %}
+        """
+
+        def view(request):
+            return HttpResponse(self.render(t))
+
+        middleware = ServerTimingMiddleware(view)
+
+        # A first request, with two misses
+        header = middleware(RequestFactory().get('/'))['Server-Timing']
+        metrics = header.split(', ')
+        self.assertEqual(len(metrics), 3)
+        self.assertTrue(metrics[0].startswith('adv-cache;desc="2 miss";dur='))
+        self.assertTrue(metrics[1].startswith('adv-cache-0;desc="test_cached_template miss '))
+        self.assertIn('nocache=', metrics[1])
+        self.assertIn('render=', metrics[1])
+        self.assertTrue(metrics[2].startswith('adv-cache-1;desc="test_other miss '))
+        self.assertEqual(RequestTrace.quote('a "b"'), '"a \\"b\\""')
+
+        # A fragment without a lookup result (failing before the lookup)
+        trace = RequestTrace()
+        trace.add(CacheTag, 'foo', 'key1').result = 'hit'
+        trace.add(CacheTag, 'bar', 'key2')
+        self.assertTrue(trace.get_server_timing().startswith('adv-cache;desc="1 None, 1 hit";'))
+
+        # Then two hits, only the slowest one detailed
+        with override_settings(ADV_CACHE_TRACE_MAX_FRAGMENTS=1):
+            header = middleware(RequestFactory().get('/'))['Server-Timing']
+        metrics = header.split(', ')
+        self.assertEqual(len(metrics), 2)
+        self.assertTrue(metrics[0].startswith('adv-cache;desc="2 hit";dur='))
+        self.assertNotIn('render=', metrics[1])
+
+        # Not traced
+        with override_settings(ADV_CACHE_TRACE_SAMPLE_RATE=0):
+            self.assertFalse(middleware(RequestFactory().get('/')).has_header('Server-Timing'))
+        self.assertEqual(self.get_foo_called, 3)
+
     @override_settings(
         ADV_CACHE_VERSIONING = True,
     )
@@ -975,3 +2564,53 @@ class BasicTestCase(TestCase):
             with self.assertRaises(ValueError) as raise_context:
                 self.render(t)
             self.assertIn('boom get', str(raise_context.exception))
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-memory store used by ``CacheTag``."""
+
+    def test_max_entries(self):
+        """Test that the least recently used entries are removed first."""
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # "b" is now the least recently used
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_max_size(self):
+        """Test that entries are removed to respect the total size."""
+        cache = LRUCache(max_size=10)
+        self.assertTrue(cache.set('a', 1, 4))
+        self.assertTrue(cache.set('b', 2, 4))
+        self.assertTrue(cache.set('c', 3, 4))
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 8)
+
+        # Too big to be saved
+        self.assertFalse(cache.set('d', 4, 11))
+        self.assertNotIn('d', cache)
+
+        # Replacing an entry updates the size
+        cache.set('b', 5, 1)
+        self.assertEqual(cache.size, 5)
+        cache.delete('b')
+        self.assertEqual(cache.size, 4)
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(len(cache), 0)
+
+    def test_timeout(self):
+        """Test that expired entries are not returned."""
+        cache = LRUCache()
+        now = time.time()
+        cache.set('a', 1, 2, timeout=10)
+        cache.set('b', 2, 3)
+        with mock.patch('time.time', return_value=now + 11):
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('b'), 2)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 3)
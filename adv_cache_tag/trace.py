@@ -0,0 +1,120 @@
+# django-adv-cache-tag / Copyright Stephane "Twidi" Angel <s.angel@twidi.com> / MIT License
+
+from .compat import ContextVar
+
+
+# The trace of the current request, set by `middleware.ServerTimingMiddleware` (or by the
+# debug toolbar panel)
+current_request_trace = ContextVar('adv_cache_request_trace', default=None)
+
+
+class FragmentTrace(object):
+    """
+    What happened when rendering a cache templatetag: the result of the
+    lookup, the errors, and the time taken by each step, in seconds
+    """
+
+    __slots__ = ('tag_class', 'fragment_name', 'cache_key', 'result', 'errors', 'timings')
+
+    def __init__(self, tag_class, fragment_name, cache_key):
+        super(FragmentTrace, self).__init__()
+        self.tag_class = tag_class
+        self.fragment_name = fragment_name
+        self.cache_key = cache_key
+        self.result = None
+        self.errors = []
+        # "total", "render", "decode", "encode", "nocache"
+        self.timings = {}
+
+    def record(self, event, value):
+        """
+        Save an event sent by the cache templatetag (see `metrics.record`)
+        """
+        if event == 'lookup':
+            self.result = value
+        elif event == 'error':
+            self.errors.append(value)
+        elif event.endswith('_seconds'):
+            step = event[:-len('_seconds')]
+            self.timings[step] = self.timings.get(step, 0) + value
+
+    @property
+    def lookup_time(self):
+        """
+        The time taken to get the content, without rendering, encoding and
+        decoding it (nor rendering its nocache parts)
+        """
+        return max(0, self.timings.get('total', 0) - sum(
+            self.timings.get(step, 0) for step in ('render', 'encode', 'decode', 'nocache')))
+
+    def as_dict(self):
+        timings = dict(self.timings, lookup=self.lookup_time)
+        return {
+            'tag': self.tag_class.__name__,
+            'fragment_name': self.fragment_name,
+            'cache_key': self.cache_key,
+            'result': self.result,
+            'errors': self.errors,
+            'timings': {step: duration * 1000 for step, duration in timings.items()},
+        }
+
+
+class RequestTrace(object):
+    """
+    The traces of all the cache templatetags rendered during a request
+    """
+
+    def __init__(self):
+        super(RequestTrace, self).__init__()
+        self.fragments = []
+
+    def add(self, tag_class, fragment_name, cache_key):
+        """
+        Start the trace of a cache templatetag, and return it
+        """
+        fragment = FragmentTrace(tag_class, fragment_name, cache_key)
+        self.fragments.append(fragment)
+        return fragment
+
+    def get_results(self):
+        """
+        Return a dict with the number of fragments by lookup result
+        """
+        results = {}
+        for fragment in self.fragments:
+            results[fragment.result] = results.get(fragment.result, 0) + 1
+        return results
+
+    @staticmethod
+    def quote(value):
+        return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    def get_server_timing(self, max_fragments=10):
+        """
+        Return the value of the `Server-Timing` header: one metric with the
+        number of fragments by result and their total time (the time of a
+        fragment included in another one is counted in both), then one for
+        each of the `max_fragments` slowest fragments.
+        """
+        if not self.fragments:
+            return ''
+
+        metrics = ['adv-cache;desc=%s;dur=%.3f' % (
+            # sorted as strings, as the result is `None` if the lookup was not done
+            self.quote(', '.join('%d %s' % (count, result) for result, count in sorted(
+                self.get_results().items(), key=lambda item: str(item[0])))),
+            sum(fragment.timings.get('total', 0) for fragment in self.fragments) * 1000,
+        )]
+
+        slowest = sorted(enumerate(self.fragments),
+                         key=lambda entry: -entry[1].timings.get('total', 0))[:max_fragments]
+        for index, fragment in sorted(slowest):
+            details = ' '.join('%s=%.3f' % (step, duration * 1000) for step, duration in sorted(
+                dict(fragment.timings, lookup=fragment.lookup_time).items()) if step != 'total')
+            metrics.append('adv-cache-%d;desc=%s;dur=%.3f' % (
+                index,
+                self.quote('%s %s %s' % (fragment.fragment_name, fragment.result, details)),
+                fragment.timings.get('total', 0) * 1000,
+            ))
+
+        return ', '.join(metrics)
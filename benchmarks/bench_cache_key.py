@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of ``CacheTag.get_cache_key()`` for each algorithm
+available to hash the ``vary_on`` arguments (see the ``key_hash`` option),
+with and without keeping the hashes in memory.
+
+Usage: python benchmarks/bench_cache_key.py [--number 100000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(
+        INSTALLED_APPS=['adv_cache_tag'],
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+    )
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.template import Context, Template  # noqa: E402
+
+from adv_cache_tag.tag import CacheTag, xxhash  # noqa: E402
+
+
+TEMPLATE = """{% load adv_cache %}
+{% cache 3600 product_line product.pk product.updated_at product.slug 'fr' %}{% endcache %}"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=100000,
+                        help='Number of keys computed per measure')
+    args = parser.parse_args()
+
+    node = Template(TEMPLATE).nodelist[-1]
+    context = Context({'product': {
+        'pk': 1234,
+        'updated_at': datetime(2020, 1, 2, 3, 4, 5),
+        'slug': 'a-product-with-a-rather-long-slug',
+    }})
+    tag = CacheTag(node, context)
+
+    key_hashes = ['md5', 'blake2b']
+    if xxhash is not None:
+        key_hashes.append('xxhash')
+
+    print('%-8s %-5s %12s' % ('hash', 'memo', 'keys/s'))
+    for key_hash in key_hashes:
+        # the memo is only used with md5
+        for memo in ((0, 1000) if key_hash == 'md5' else (0, )):
+            CacheTag.options.key_hash = key_hash
+            CacheTag.options.key_hash_memo_max_entries = memo
+            CacheTag._key_hash_memos.clear()
+            duration = min(timeit.repeat(tag.get_cache_key, number=args.number, repeat=3))
+            print('%-8s %-5s %12.0f' % (key_hash, 'yes' if memo else 'no',
+                                        args.number / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Compare the codecs available to encode the cached content (see
+``adv_cache_tag/codecs.py``): encode and decode throughput, and compression
+ratio, on generated html similar to real templates fragments.
+
+Usage: python benchmarks/bench_codecs.py [--sizes 2000,20000,200000] [--number 200]
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure()
+
+from adv_cache_tag.codecs import codecs  # noqa: E402
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua').split()
+
+
+def generate_html(size, seed=42):
+    """Return some html (a list of products), of about `size` characters"""
+    rand = random.Random(seed)
+    parts = ['<div class="products">\n  <ul class="product-list">\n']
+    length = len(parts[0])
+    pk = 0
+    while length < size:
+        pk += 1
+        name = ' '.join(rand.choice(WORDS) for __ in range(rand.randint(2, 5))).title()
+        part = (
+            '    <li class="product" id="product-%(pk)d">\n'
+            '      <a href="/products/%(pk)d/%(slug)s/" title="%(name)s">\n'
+            '        <img src="/media/products/%(pk)d.jpg" alt="%(name)s" width="120" height="90">\n'
+            '        <span class="name">%(name)s</span>\n'
+            '      </a>\n'
+            '      <span class="price">%(price).2f &euro;</span>\n'
+            '      <p class="description">%(description)s</p>\n'
+            '    </li>\n'
+        ) % {
+            'pk': pk,
+            'slug': name.lower().replace(' ', '-'),
+            'name': name,
+            'price': rand.uniform(1, 500),
+            'description': ' '.join(rand.choice(WORDS) for __ in range(rand.randint(10, 40))),
+        }
+        parts.append(part)
+        length += len(part)
+    parts.append('  </ul>\n</div>\n')
+    return ''.join(parts)
+
+
+def bench(codec, content, level, number):
+    """Return the encoded size, and the time (in seconds) of one encode and one decode"""
+    data = codec.encode(content, level)
+    assert codec.decode(data) == content
+    encode = min(timeit.repeat(lambda: codec.encode(content, level), number=number, repeat=3))
+    decode = min(timeit.repeat(lambda: codec.decode(data), number=number, repeat=3))
+    return len(data), encode / number, decode / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--sizes', default='2000,20000,200000',
+                        help='Sizes, in characters, of the html to encode')
+    parser.add_argument('--number', type=int, default=200,
+                        help='Number of encodings/decodings per measure')
+    parser.add_argument('--level', type=int, default=zlib.Z_DEFAULT_COMPRESSION,
+                        help='Compression level passed to the codecs')
+    args = parser.parse_args()
+
+    print('%-6s %9s %9s %7s %12s %12s' % (
+        'codec', 'size', 'encoded', 'ratio', 'encode MB/s', 'decode MB/s'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        content = generate_html(size)
+        raw_size = len(content.encode('utf-8'))
+        for codec_id, codec in sorted(codecs.items()):
+            encoded_size, encode, decode = bench(codec, content, args.level, args.number)
+            print('%-6s %9d %9d %7.2f %12.1f %12.1f' % (
+                codec_id, raw_size, encoded_size, raw_size / encoded_size,
+                raw_size / encode / 1e6, raw_size / decode / 1e6))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Measure the time to render the cache templatetag in its main paths (hits,
+miss, nocache parts, compression, key derivation), with a local memory cache
+backend and with a backend simulating a network latency (see
+``fake_backend.py``). Results can be saved as JSON and compared between
+commits.
+
+Usage:
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(
+        INSTALLED_APPS=['adv_cache_tag'],
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+        CACHES={
+            'locmem': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'bench-locmem',
+            },
+            'latency': {
+                'BACKEND': 'fake_backend.LatencyCache',
+                'LOCATION': 'bench-latency',
+                'OPTIONS': {'LATENCY': 0.0005},
+            },
+        },
+    )
+
+import django  # noqa: E402
+
+django.setup()
+
+from django import VERSION as django_version  # noqa: E402
+from django.template import Context, Template  # noqa: E402
+from django.utils.safestring import mark_safe  # noqa: E402
+
+from adv_cache_tag.compat import get_cache  # noqa: E402
+from adv_cache_tag.tag import CacheTag  # noqa: E402
+
+from bench_codecs import generate_html  # noqa: E402
+
+
+BACKENDS = ('locmem', 'latency')
+
+
+class Case(object):
+    """
+    A path of the cache templatetag to measure: a template rendered with
+    some options, once to fill the cache, then measured
+    """
+
+    def __init__(self, name, template, options=None, context=None, regenerate=False,
+                 per_backend=True):
+        self.name = name
+        self.template = template
+        self.options = options or {}
+        self.context = context or {}
+        # to render the content each time (a miss), and save it in the cache
+        self.regenerate = regenerate
+        # if `False`, only measured with the first backend (the backend is not used)
+        self.per_backend = per_backend
+
+    def prepare(self):
+        """
+        Return the function to measure, with the cache filled
+        """
+        template = Template(self.template)
+        context = dict(self.context)
+        if self.regenerate:
+            context['__regenerate__'] = True
+        template.render(Context(context))
+        return lambda: template.render(Context(context))
+
+
+def get_cases(args):
+    html = mark_safe(generate_html(args.html_size))
+    large_html = mark_safe(generate_html(args.large_html_size).replace('\n', '\n        '))
+    vary_on = ' '.join('arg%d' % index for index in range(args.vary_on))
+
+    return [
+        Case('hit', '{% load adv_cache %}'
+                    '{% cache 3600 bench pk %}{{ html }}{% endcache %}',
+             context={'pk': 1, 'html': html}),
+        Case('versioned_hit', '{% load adv_cache %}'
+                              '{% cache 3600 bench pk version %}'
+                              '{{ html }}{% endcache %}',
+             options={'versioning': True}, context={'pk': 1, 'version': 3, 'html': html}),
+        Case('compressed_hit', '{% load adv_cache %}'
+                               '{% cache 3600 bench pk %}{{ html }}{% endcache %}',
+             options={'compress': True}, context={'pk': 1, 'html': html}),
+        Case('nocache_hit', '{% load adv_cache %}'
+                            '{% cache 3600 bench pk %}' +
+                            '{{ html }}{% nocache %}{{ pk }}{% endnocache %}' * args.holes +
+                            '{% endcache %}',
+             context={'pk': 1, 'html': mark_safe(html[:len(html) // args.holes])}),
+        Case('miss', '{% load adv_cache %}'
+                     '{% cache 3600 bench pk %}{{ html }}{% endcache %}',
+             context={'pk': 1, 'html': html}, regenerate=True),
+        Case('compress_spaces_miss', '{% load adv_cache %}'
+                                     '{% cache 3600 bench pk %}'
+                                     '{{ html }}{% endcache %}',
+             options={'compress_spaces': True}, context={'pk': 1, 'html': large_html},
+             regenerate=True),
+        Case('cache_key', '{% load adv_cache %}'
+                          '{% cache 3600 bench ' + vary_on + ' %}{% endcache %}',
+             context={'arg%d' % index: 'value %d' % index for index in range(args.vary_on)},
+             per_backend=False),
+    ]
+
+
+def measure_cache_key(case):
+    """
+    Return the function to measure for the key derivation: create the
+    `CacheTag` object, which computes the cache key
+    """
+    node = Template(case.template).nodelist[-1]
+    context = Context(case.context)
+    return lambda: CacheTag(node, context)
+
+
+def run_case(case, backend, repeat, min_time):
+    """
+    Return the stats of the given case, in microseconds per render
+    """
+    options = dict(case.options, cache_backend=backend)
+    saved_options = {name: getattr(CacheTag.options, name) for name in options}
+    for name, value in options.items():
+        setattr(CacheTag.options, name, value)
+    try:
+        get_cache(backend).clear()
+        if case.name == 'cache_key':
+            func = measure_cache_key(case)
+        else:
+            func = case.prepare()
+
+        timer = timeit.Timer(func)
+        number, duration = timer.autorange()
+        if duration < min_time:
+            number = max(1, int(number * min_time / duration))
+        timings = [value / number * 1e6 for value in timer.repeat(repeat=repeat, number=number)]
+    finally:
+        for name, value in saved_options.items():
+            setattr(CacheTag.options, name, value)
+
+    return {
+        'min': min(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, reference):
+    """
+    Print the ratio between the minimum times of the results and the
+    reference ones (> 1 means slower)
+    """
+    print()
+    print('Compared to %s:' % (reference['meta'].get('commit') or 'reference'))
+    print('%-30s %12s %12s %8s' % ('benchmark', 'before (us)', 'after (us)', 'ratio'))
+    for name, stats in results['benchmarks'].items():
+        before = reference['benchmarks'].get(name)
+        if before is None:
+            continue
+        print('%-30s %12.2f %12.2f %7.2fx' % (name, before['min'], stats['min'],
+                                              stats['min'] / before['min']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--output', help='Save the results in this JSON file')
+    parser.add_argument('--compare', help='Compare the results to this JSON file')
+    parser.add_argument('--filter', default='', help='Only run the benchmarks containing this')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of measures per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimum duration, in seconds, of each measure')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='Latency, in seconds, of each call to the "latency" backend')
+    parser.add_argument('--html-size', type=int, default=5000,
+                        help='Size, in characters, of the cached html')
+    parser.add_argument('--large-html-size', type=int, default=200000,
+                        help='Size, in characters, of the html for `compress_spaces`')
+    parser.add_argument('--holes', type=int, default=10, help='Number of nocache parts')
+    parser.add_argument('--vary-on', type=int, default=20,
+                        help='Number of arguments for the key derivation')
+    args = parser.parse_args()
+
+    get_cache('latency').latency = args.latency
+
+    results = {
+        'meta': {
+            'commit': get_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'django': '.'.join(str(part) for part in django_version[:3]),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'benchmarks': {},
+    }
+
+    print('%-30s %12s %12s %12s' % ('benchmark', 'min (us)', 'mean (us)', 'stdev (us)'))
+    for case in get_cases(args):
+        for backend in BACKENDS if case.per_backend else BACKENDS[:1]:
+            name = '%s[%s]' % (case.name, backend) if case.per_backend else case.name
+            if args.filter not in name:
+                continue
+            stats = results['benchmarks'][name] = run_case(case, backend, args.repeat,
+                                                           args.min_time)
+            print('%-30s %12.2f %12.2f %12.2f' % (name, stats['min'], stats['mean'],
+                                                  stats['stdev']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as reference:
+            compare(results, json.load(reference))
+
+
+if __name__ == '__main__':
+    main()
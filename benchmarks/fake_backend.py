@@ -0,0 +1,286 @@
+"""
+Cache backends used by the benchmarks.
+
+``LatencyCache`` is a local memory cache backend simulating a remote one
+(memcached, redis...): each call waits for the given latency (once for the
+``*_many`` calls, as for a real network round trip).
+
+    CACHES = {
+        'latency': {
+            'BACKEND': 'fake_backend.LatencyCache',
+            'LOCATION': 'latency',
+            'OPTIONS': {'LATENCY': 0.0005},  # in seconds
+        },
+    }
+
+``FakeRemoteCache`` is a cache backend whose data is kept in a server
+process, shared by many processes, simulating latency, failures and
+evictions (see ``load_test.py``).
+"""
+
+import random
+import threading
+import time
+
+from collections import Counter, OrderedDict
+from multiprocessing.managers import BaseManager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+# Used to authenticate the connections to the `StoreManager`
+AUTHKEY = b'adv-cache-tag'
+
+
+class LatencyCache(LocMemCache):
+
+    def __init__(self, name, params):
+        super(LatencyCache, self).__init__(name, params)
+        self.latency = params.get('OPTIONS', {}).get('LATENCY', 0.0005)
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key, default=None, version=None):
+        self.wait()
+        return super(LatencyCache, self).get(key, default, version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.wait()
+        return super(LatencyCache, self).set(key, value, timeout, version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.wait()
+        return super(LatencyCache, self).add(key, value, timeout, version)
+
+    def delete(self, key, version=None):
+        self.wait()
+        return super(LatencyCache, self).delete(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        self.wait()
+        return super(LatencyCache, self).incr(key, delta, version)
+
+    def get_many(self, keys, version=None):
+        self.wait()
+        data = {}
+        for key in keys:
+            value = LocMemCache.get(self, key, self._missing_key, version)
+            if value is not self._missing_key:
+                data[key] = value
+        return data
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.wait()
+        for key, value in data.items():
+            LocMemCache.set(self, key, value, timeout, version)
+        return []
+
+    # used by `get_many`, as `None` can be a cached value
+    _missing_key = object()
+
+
+class FakeStore(object):
+    """
+    The data of a fake remote cache backend, kept in a server process (see
+    `StoreManager`) to be shared by many processes. It can simulate
+    evictions: when there are more than `max_entries` entries (the least
+    recently set are removed), and randomly, for a part (`eviction_rate`)
+    of the saved entries.
+    """
+
+    def __init__(self):
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_entries = 0
+        self.eviction_rate = 0
+        self.ops = Counter()
+        self.evictions = 0
+
+    def configure(self, max_entries=0, eviction_rate=0):
+        self.max_entries = max_entries
+        self.eviction_rate = eviction_rate
+
+    def stats(self):
+        return {'entries': len(self.data), 'ops': dict(self.ops), 'evictions': self.evictions}
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return False, None
+        value, expire_at = entry
+        if expire_at is not None and expire_at <= time.time():
+            del self.data[key]
+            return False, None
+        return True, value
+
+    def _set(self, key, value, expire_at):
+        if self.eviction_rate and self.data and random.random() < self.eviction_rate:
+            del self.data[random.choice(list(self.data))]
+            self.evictions += 1
+        self.data[key] = (value, expire_at)
+        self.data.move_to_end(key)
+        while self.max_entries and len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        with self.lock:
+            self.ops['get'] += 1
+            return self._get(key)
+
+    def get_many(self, keys):
+        with self.lock:
+            self.ops['get_many'] += 1
+            data = {}
+            for key in keys:
+                found, value = self._get(key)
+                if found:
+                    data[key] = value
+            return data
+
+    def set(self, key, value, expire_at):
+        with self.lock:
+            self.ops['set'] += 1
+            self._set(key, value, expire_at)
+
+    def set_many(self, data, expire_at):
+        with self.lock:
+            self.ops['set_many'] += 1
+            for key, value in data.items():
+                self._set(key, value, expire_at)
+
+    def add(self, key, value, expire_at):
+        with self.lock:
+            self.ops['add'] += 1
+            if self._get(key)[0]:
+                return False
+            self._set(key, value, expire_at)
+            return True
+
+    def incr(self, key, delta):
+        with self.lock:
+            self.ops['incr'] += 1
+            found, value = self._get(key)
+            if not found:
+                raise ValueError("Key '%s' not found" % key)
+            self.data[key] = (value + delta, self.data[key][1])
+            return value + delta
+
+    def delete(self, key):
+        with self.lock:
+            self.ops['delete'] += 1
+            return self.data.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+_store = None
+
+
+def get_store():
+    """
+    Return the store of the server process, created on the first call
+    """
+    global _store
+    if _store is None:
+        _store = FakeStore()
+    return _store
+
+
+class StoreManager(BaseManager):
+    """
+    Run the server process holding the `FakeStore`, or connect to it
+    """
+
+
+StoreManager.register('get_store', callable=get_store)
+
+
+class FakeRemoteCache(BaseCache):
+    """
+    A cache backend using the `FakeStore` of a `StoreManager` server, like a
+    memcached or redis server, with a simulated latency for each call, and
+    simulated failures (`ConnectionError`) for a part (`FAILURE_RATE`) of
+    the calls. `ops` is the number of calls made with this object.
+
+        CACHES = {
+            'default': {
+                'BACKEND': 'fake_backend.FakeRemoteCache',
+                'LOCATION': '127.0.0.1:12345',  # address of the `StoreManager`
+                'OPTIONS': {'LATENCY': 0.0005, 'FAILURE_RATE': 0.01},
+            },
+        }
+    """
+
+    def __init__(self, server, params):
+        super(FakeRemoteCache, self).__init__(params)
+        host, port = server.rsplit(':', 1)
+        self.address = (host, int(port))
+        options = params.get('OPTIONS', {})
+        self.latency = options.get('LATENCY', 0.0005)
+        self.failure_rate = options.get('FAILURE_RATE', 0)
+        self.authkey = options.get('AUTHKEY', AUTHKEY)
+        self.ops = 0
+        self._store = None
+
+    def call(self, method, *args):
+        self.ops += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise ConnectionError('Simulated failure of the fake remote cache')
+        if self._store is None:
+            manager = StoreManager(self.address, self.authkey)
+            manager.connect()
+            self._store = manager.get_store()
+        return getattr(self._store, method)(*args)
+
+    def get_expire_at(self, timeout):
+        expire_at = self.get_backend_timeout(timeout)
+        return expire_at if expire_at is None or expire_at > 0 else time.time() - 1
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        found, value = self.call('get', key)
+        return value if found else default
+
+    def get_many(self, keys, version=None):
+        keys_map = {self.make_key(key, version): key for key in keys}
+        for key in keys_map:
+            self.validate_key(key)
+        data = self.call('get_many', list(keys_map))
+        return {keys_map[key]: value for key, value in data.items()}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        self.call('set', key, value, self.get_expire_at(timeout))
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.call('set_many', {self.make_key(key, version): value for key, value in data.items()},
+                  self.get_expire_at(timeout))
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        return self.call('add', key, value, self.get_expire_at(timeout))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        return self.call('incr', key, delta)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        return self.call('delete', key)
+
+    def clear(self):
+        self.call('clear')
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Render cache templatetags from many threads and processes at the same time,
+against a fake remote cache backend shared by all of them (see
+``fake_backend.FakeRemoteCache``), with a simulated latency, failures and
+evictions, to check the behavior under load (stampedes, lock contention...)
+of the options (``--lock``, ``--stale-ttl``, ``--early-expiry-beta``...).
+
+Report the number of renders per key, the latency of the renders and the
+number of calls to the cache backend per render.
+
+Usage: python benchmarks/load_test.py --processes 4 --threads 8 --keys 10 --lock
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+from collections import Counter
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_backend import AUTHKEY, StoreManager  # noqa: E402
+
+
+TEMPLATE = """{% load adv_cache %}
+{% cache expire fragment key %}{{ work.render }}{% endcache %}"""
+
+
+class Work(object):
+    """
+    The content of a fragment, slow to render, counting its renders by key
+    """
+
+    renders = Counter()
+    lock = threading.Lock()
+
+    def __init__(self, key, render_time, size):
+        self.key = key
+        self.render_time = render_time
+        self.size = size
+
+    def render(self):
+        with self.lock:
+            self.renders[self.key] += 1
+        time.sleep(self.render_time)
+        return 'x' * self.size
+
+
+def init_worker(address, args):
+    """
+    Configure django in a worker process, to use the fake remote cache
+    backend and the options to test
+    """
+    from django.conf import settings
+
+    settings.configure(
+        INSTALLED_APPS=['adv_cache_tag'],
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+        CACHES={
+            'default': {
+                'BACKEND': 'fake_backend.FakeRemoteCache',
+                'LOCATION': '%s:%d' % address,
+                'OPTIONS': {'LATENCY': args.latency, 'FAILURE_RATE': args.failure_rate},
+            },
+        },
+        LOGGING={
+            'version': 1,
+            'disable_existing_loggers': False,
+            'loggers': {'adv_cache_tag': {'level': 'CRITICAL'}},
+        },
+        ADV_CACHE_METRICS=True,
+        ADV_CACHE_LOCK=args.lock,
+        ADV_CACHE_STALE_TTL=args.stale_ttl,
+        ADV_CACHE_EARLY_EXPIRY_BETA=args.early_expiry_beta,
+        ADV_CACHE_COMPRESS=args.compress,
+        ADV_CACHE_LOCAL_MAX_ENTRIES=args.local_max_entries,
+    )
+
+    import django
+    django.setup()
+
+
+def run_thread(args, start_at, seed, results):
+    """
+    Render `args.requests` fragments, chosen randomly, and save the latency
+    and the number of calls to the cache backend of each render
+    """
+    from django.template import Context, Template
+
+    from adv_cache_tag.compat import get_cache
+
+    template = Template(TEMPLATE)
+    cache = get_cache('default')
+    rand = random.Random(seed)
+    keys = list(range(args.keys))
+    weights = [1 / (key + 1) ** args.zipf for key in keys]
+
+    time.sleep(max(0, start_at - time.time()))
+    for __ in range(args.requests):
+        key = rand.choices(keys, weights)[0]
+        context = Context({
+            'expire': args.expire,
+            'fragment': 'load_test',
+            'key': key,
+            'work': Work(key, args.render_time, args.size),
+        })
+        ops = cache.ops
+        start = time.time()
+        template.render(context)
+        results['latencies'].append(time.time() - start)
+        results['ops'].append(cache.ops - ops)
+        if args.pause:
+            time.sleep(args.pause)
+
+
+def run_worker(index, args, start_at):
+    """
+    Run the threads of a worker process, and return their results, with
+    the renders by key and the lookups and errors from the metrics
+    """
+    from adv_cache_tag.metrics import collector
+
+    results = {'latencies': [], 'ops': []}
+    threads = [
+        threading.Thread(target=run_thread,
+                         args=(args, start_at, index * 1000 + thread, results))
+        for thread in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results['renders'] = dict(Work.renders)
+    results['events'] = Counter()
+    for (__, __, event, value), count in collector.counters.items():
+        results['events']['%s %s' % (event, value)] += count
+    return results
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def report(results, duration, store_stats):
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    ops = [count for result in results for count in result['ops']]
+    renders = Counter()
+    events = Counter()
+    for result in results:
+        renders.update(result['renders'])
+        events.update(result['events'])
+
+    print('renders: %d in %.2fs (%.0f per second)' % (
+        len(latencies), duration, len(latencies) / duration))
+    print('latency (ms): p50 %.2f, p90 %.2f, p99 %.2f, max %.2f' % tuple(
+        percentile(latencies, percent) * 1000 for percent in (50, 90, 99, 100)))
+    print('backend calls per render: mean %.2f, max %d' % (sum(ops) / len(ops), max(ops)))
+    print('fragments rendered: %d (for %d keys), per key: mean %.2f, max %d' % (
+        sum(renders.values()), len(renders),
+        sum(renders.values()) / max(1, len(renders)), max(renders.values() or [0])))
+    print('most rendered keys: %s' % ', '.join(
+        '%s (%d)' % (key, count) for key, count in renders.most_common(5)))
+    print('lookups and errors: %s' % ', '.join(
+        '%s: %d' % (event, count) for event, count in sorted(events.items())))
+    print('backend: %d entries, %d evictions, calls: %s' % (
+        store_stats['entries'], store_stats['evictions'],
+        ', '.join('%s: %d' % item for item in sorted(store_stats['ops'].items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--processes', type=int, default=2, help='Number of processes')
+    parser.add_argument('--threads', type=int, default=4, help='Number of threads per process')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='Number of renders per thread')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='Time, in seconds, between two renders of a thread')
+    parser.add_argument('--keys', type=int, default=10, help='Number of distinct fragments')
+    parser.add_argument('--zipf', type=float, default=1,
+                        help='Exponent of the zipf distribution of the keys (0 for uniform)')
+    parser.add_argument('--render-time', type=float, default=0.05,
+                        help='Time, in seconds, to render a fragment')
+    parser.add_argument('--size', type=int, default=10000, help='Size of a fragment')
+    parser.add_argument('--expire', type=int, default=60, help='Expire time of the fragments')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='Latency, in seconds, of each call to the cache backend')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Part of the calls to the cache backend failing')
+    parser.add_argument('--max-entries', type=int, default=0,
+                        help='Maximum number of entries in the cache backend (0: no limit)')
+    parser.add_argument('--eviction-rate', type=float, default=0,
+                        help='Part of the saved entries evicting a random one')
+    parser.add_argument('--lock', action='store_true', help='Use the `lock` option')
+    parser.add_argument('--stale-ttl', type=int, default=0, help='Value of the `stale_ttl` option')
+    parser.add_argument('--early-expiry-beta', type=float, default=0,
+                        help='Value of the `early_expiry_beta` option')
+    parser.add_argument('--compress', action='store_true', help='Use the `compress` option')
+    parser.add_argument('--local-max-entries', type=int, default=0,
+                        help='Value of the `local_cache_max_entries` option')
+    args = parser.parse_args()
+
+    manager = StoreManager(('127.0.0.1', 0), AUTHKEY)
+    manager.start()
+    try:
+        store = manager.get_store()
+        store.configure(args.max_entries, args.eviction_rate)
+
+        with Pool(args.processes, initializer=init_worker,
+                  initargs=(manager.address, args)) as pool:
+            # all the threads start at the same time, on an empty cache
+            start_at = time.time() + 1
+            results = pool.starmap(run_worker, [
+                (index, args, start_at) for index in range(args.processes)
+            ])
+            duration = time.time() - start_at
+
+        report(results, duration, store.stats())
+    finally:
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()